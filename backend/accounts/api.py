@@ -2,6 +2,7 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.serializers import ModelSerializer
 
+from chartviz.queries import query_budget
 from taxonomies.api import PhecodeSerializer
 from .models import ConditionTabSpec
 
@@ -16,12 +17,15 @@ class ConditionTabSpecSerializer(ModelSerializer):
 
 def _list_tabs(user_id, patient_id):
     specs = ConditionTabSpecSerializer(
-        ConditionTabSpec.objects.filter(user=user_id, patient=patient_id),
+        ConditionTabSpec.objects
+        .filter(user=user_id, patient=patient_id)
+        .select_related('condition'),
         many=True
     )
     return Response({'tabspecs': specs.data})
 
 
+@query_budget(8)
 @api_view(['GET', 'POST'])
 def manage_tabs(request, patient_id=None):
     patient_id = int(patient_id)
@@ -39,6 +43,7 @@ def manage_tabs(request, patient_id=None):
     return _list_tabs(request.user.id, patient_id)
 
 
+@query_budget(4)
 @api_view(['DELETE'])
 def delete_tab(request, patient_id=None, condition_id=None):
     patient_id = int(patient_id)
@@ -52,6 +57,7 @@ def delete_tab(request, patient_id=None, condition_id=None):
     return _list_tabs(request.user.id, patient_id)
 
 
+@query_budget(2)
 @api_view()
 def current_user(request):
     return Response({
@@ -0,0 +1,42 @@
+"""
+Conditional GET support (ETag / Last-Modified) for the API views
+"""
+from functools import wraps
+from hashlib import md5
+
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
+
+
+def conditional(validators):
+    """
+    Decorates a viewset method so that a GET the client already has the
+    current response for is answered with 304 before the method runs.
+    `validators(view, request)` returns (version, last_modified): a cheaply
+    looked up version of everything the response is computed from, and the
+    aware datetime it last changed (or None).  The ETag also covers the path,
+    query and rendered format.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            version, modified = validators(self, request)
+            parts = (version, request.get_full_path(),
+                     request.accepted_renderer.format)
+            etag = quote_etag(md5(repr(parts).encode()).hexdigest())
+            last_modified = modified and int(modified.timestamp())
+            response = get_conditional_response(
+                request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = method(self, request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                response['ETag'] = etag
+                if last_modified:
+                    response['Last-Modified'] = http_date(last_modified)
+                # Always revalidate, and only in the user's own cache
+                patch_cache_control(response, private=True, no_cache=True)
+                patch_vary_headers(response, ('Accept',))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,149 @@
+"""
+Query instrumentation for the API views.
+
+A QueryLog records the queries made in a block (e.g. while serving a request)
+and groups them by their normalized SQL: a statement that keeps coming back
+with different parameters is usually a loop making one query per row (an
+N+1), which a join, select_related or a single IN query would replace.
+
+Views declare the most queries a request should need, whatever the size of
+the patient: a viewset as `query_budgets`, {action: queries}, a function
+view with the query_budget decorator.  Budgets count every query of the
+request, authentication's included, with the tab cache cold.
+
+QueryMiddleware applies them per settings.QUERY_BUDGETS: 'off', 'warn' (log
+any request over budget, or with repeated statements) or 'raise' (fail the
+request instead).  Every response then carries its X-Query-Count.  The
+check_query_budgets command runs each budgeted view and fails on any excess.
+"""
+import logging
+import re
+from collections import Counter
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# How often a statement may repeat in a request before it is reported
+REPEAT_LIMIT = 3
+
+# Literals, placeholders and lists of them, reduced to a ?
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'%s|%\(\w+\)s')
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised for a request over its view's budget (QUERY_BUDGETS 'raise')"""
+
+
+def normalize(sql):
+    """`sql` with its values replaced by ?, so repeats of it compare equal"""
+    sql = _STRINGS.sub('?', sql)
+    sql = _PLACEHOLDERS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _LISTS.sub('(?)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class QueryLog:
+    """
+    Records the (sql, seconds) of every query made on the connection while
+    in use as a context manager, whether or not DEBUG is on
+    """
+
+    def __init__(self, connection=connection):
+        self.connection = connection
+        self.queries = []
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._wrapper.__exit__(*exc)
+
+    def __call__(self, execute, sql, params, many, context):
+        t0 = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, perf_counter() - t0))
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(seconds for _, seconds in self.queries)
+
+    def repeated(self, limit=REPEAT_LIMIT):
+        """
+        [(normalized sql, times)] of the statements made more than `limit`
+        times, most repeated first
+        """
+        counts = Counter(normalize(sql) for sql, _ in self.queries)
+        return [(sql, n) for sql, n in counts.most_common() if n > limit]
+
+    def problems(self, budget=None):
+        """Descriptions of how the queries break `budget` or repeat"""
+        found = []
+        if budget is not None and len(self) > budget:
+            found.append(f'{len(self)} queries, over the budget of {budget}')
+        for sql, n in self.repeated():
+            found.append(f'{n} times: {sql}')
+        return found
+
+
+def query_budget(queries):
+    """Declares the budget of a function view (applied over @api_view)"""
+    def decorator(view):
+        view.query_budget = queries
+        return view
+    return decorator
+
+
+def budget_for(view, method):
+    """
+    The budget of the resolved `view` function for requests of `method`, or
+    None if it has none
+    """
+    if hasattr(view, 'query_budget'):
+        return view.query_budget
+    # A viewset's as_view() function knows its class and actions
+    actions = getattr(view, 'actions', None) or {}
+    action = actions.get(method.lower())
+    budgets = getattr(getattr(view, 'cls', None), 'query_budgets', {})
+    return budgets.get(action)
+
+
+class QueryMiddleware:
+    """Counts each request's queries and reports or enforces its budget"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.mode = getattr(settings, 'QUERY_BUDGETS', 'off')
+        if self.mode == 'off':
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        with QueryLog() as log:
+            response = self.get_response(request)
+        response['X-Query-Count'] = str(len(log))
+        problems = log.problems(getattr(request, 'query_budget', None))
+        if problems:
+            message = (f'{request.method} {request.get_full_path()}: '
+                       + '; '.join(problems))
+            if self.mode == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view, args, kwargs):
+        request.query_budget = budget_for(view, request.method)
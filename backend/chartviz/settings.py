@@ -74,6 +74,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it counts the queries of everything after it
+    'chartviz.queries.QueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -84,6 +86,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# What to do about requests making more queries than their view's budget, or
+# repeating a statement (see chartviz/queries.py): 'off', 'warn' or 'raise'
+QUERY_BUDGETS = getenv('QUERY_BUDGETS', 'warn' if DEBUG else 'off')
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
@@ -142,6 +148,45 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+# The `tabs` cache holds computed patient tabs (see patients/cache.py).
+# TAB_CACHE picks its backend: locmem (per process), file or db (shared by
+# every worker; run `manage.py createcachetable` first).  Entries beyond
+# TAB_CACHE_ENTRIES are culled.
+TAB_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tabs',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': getenv('TAB_CACHE_DIR', '/var/tmp/chartviz_tabs'),
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'tab_cache',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'tabs': {
+        **TAB_CACHE_BACKENDS[getenv('TAB_CACHE', 'locmem')],
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(getenv('TAB_CACHE_ENTRIES', 1000)),
+        },
+    },
+}
+
+# Concurrent misses on the same tab always wait for one computation within a
+# process; 'advisory' makes them wait across processes too (useful with a
+# shared TAB_CACHE)
+TAB_CACHE_LOCK = getenv('TAB_CACHE_LOCK', 'process')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
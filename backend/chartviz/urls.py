@@ -19,7 +19,7 @@ from rest_framework.routers import DefaultRouter
 
 from . import views as core
 from accounts.api import current_user, manage_tabs, delete_tab
-from patients.api import PatientViewSet
+from patients.api import PatientViewSet, tab_cache_stats
 from taxonomies.api import ICDViewSet
 
 
@@ -35,6 +35,7 @@ urlpatterns = [
     # Mount the API router & other API routes
     path('api/v1/', include(router.urls)),
     path('api/v1/users/me/', current_user),
+    path('api/v1/tab-cache/', tab_cache_stats),
 
     # Condition tab preference api
     path('api/v1/tabs/<int:patient_id>/', manage_tabs),
@@ -0,0 +1,147 @@
+"""
+Helpers for bulk loading tables through COPY
+"""
+from collections import Counter
+from contextlib import contextmanager
+from io import StringIO
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# Written for missing values; COPY reads it unquoted as NULL (and an empty
+# field as the empty string)
+NULL = r'\N'
+
+
+def copy_frame(cursor, table, frame):
+    """
+    Streams the rows of the DataFrame `frame` into `table` with COPY FROM
+    STDIN.  The frame's columns are the table's column names; any others are
+    left to their defaults.
+    """
+    buf = StringIO()
+    frame.to_csv(buf, index=False, header=False, na_rep=NULL)
+    buf.seek(0)
+    columns = ', '.join(frame.columns)
+    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN "
+                       f"WITH (FORMAT csv, NULL '{NULL}')", buf)
+
+
+def model_columns(model, frame):
+    """`frame`, with its columns renamed from model fields to table columns"""
+    return frame.rename(columns={name: model._meta.get_field(name).column
+                                 for name in frame.columns})
+
+
+def copy_models(frames):
+    """
+    Copies each of `frames` ({model: DataFrame of model fields}, in foreign
+    key order) into its model's table, in one transaction.  Date & datetime
+    strings are parsed in the current time zone.  Returns {table: (rows,
+    copy time)}.
+    """
+    stats = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL TIME ZONE %s', [settings.TIME_ZONE])
+        for model, frame in frames.items():
+            frame = model_columns(model, frame)
+            t0 = perf_counter()
+            copy_frame(cursor, model._meta.db_table, frame)
+            stats[model._meta.db_table] = (len(frame), perf_counter() - t0)
+    return stats
+
+
+def reserve_ids(model, n):
+    """
+    `n` ids taken from `model`'s sequence, so rows referencing them can be
+    written before (or alongside) the rows themselves
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                       "FROM generate_series(1, %s)",
+                       [model._meta.db_table, n])
+        return [pk for pk, in cursor.fetchall()]
+
+
+class Throughput:
+    """Rows & copy time per table, summed over the chunks of a load"""
+
+    def __init__(self):
+        self.rows = Counter()
+        self.copying = Counter()
+
+    def add(self, stats):
+        """Adds the {table: (rows, copy time)} of a chunk"""
+        for table, (n, seconds) in stats.items():
+            self.rows[table] += n
+            self.copying[table] += seconds
+
+    @property
+    def total(self):
+        return sum(self.rows.values())
+
+    def report(self, stdout):
+        # Copy rates are per connection; an overall rate is over all of them
+        stdout.write(f'{"table":<24}{"rows":>12}{"copy rows/s":>14}')
+        for table, n in self.rows.items():
+            rate = n / self.copying[table] if self.copying[table] else 0
+            stdout.write(f'{table:<24}{n:>12}{rate:>14.0f}')
+
+
+# Where deferred_indexes records the indexes it drops; see
+# initial_data/migrations/0014_deferred_indexes.py
+DEFERRED = 'bulk_deferred_index'
+
+
+def restore_indexes(tables):
+    """
+    Rebuilds the indexes of `tables` recorded as dropped by deferred_indexes,
+    each committed as it is built.  Returns their names.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT name, definition FROM {DEFERRED} '
+                       f'WHERE tablename = ANY(%s) ORDER BY name',
+                       [list(tables)])
+        indexes = cursor.fetchall()
+    for name, definition in indexes:
+        with transaction.atomic(), connection.cursor() as cursor:
+            # It may have been created again by hand meanwhile
+            cursor.execute('SELECT to_regclass(%s) IS NULL', [name])
+            if cursor.fetchone()[0]:
+                cursor.execute(definition)
+            cursor.execute(f'DELETE FROM {DEFERRED} WHERE name = %s', [name])
+    return [name for name, _ in indexes]
+
+
+@contextmanager
+def deferred_indexes(tables):
+    """
+    Drops the indexes of `tables` (other than those backing constraints) and
+    rebuilds them on exit, so a bulk load doesn't maintain them row by row.
+    The drops are committed straight away (outside a transaction), which lets
+    other connections (e.g. worker processes) load the tables meanwhile, so
+    the tables go without those indexes for the whole load.  Each index's
+    definition is recorded as it is dropped; should the rebuild not happen
+    (the process dies), restore_indexes rebuilds them later.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT I.indexname, I.tablename, I.indexdef
+            FROM pg_indexes I
+            WHERE I.tablename = ANY(%s) AND NOT EXISTS (
+                SELECT 1 FROM pg_constraint C
+                WHERE C.conindid = format('%%I.%%I', I.schemaname,
+                                          I.indexname)::regclass
+            )
+        """, [list(tables)])
+        indexes = cursor.fetchall()
+        for name, table, definition in indexes:
+            cursor.execute(f'INSERT INTO {DEFERRED} '
+                           f'(name, tablename, definition) '
+                           f'VALUES (%s, %s, %s)', [name, table, definition])
+            cursor.execute(f'DROP INDEX {name}')
+    try:
+        yield [name for name, _, _ in indexes]
+    finally:
+        restore_indexes(tables)
@@ -0,0 +1,166 @@
+"""
+Benchmark the original and single-pass definitions of v_patient_history_stats
+on a synthetic database.  Instances with real taxonomy codes are generated
+into a scratch schema, each definition is built, refreshed and queried by
+patient there, and everything is rolled back afterwards.
+"""
+from importlib import import_module
+from random import randint
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+MIGRATIONS = 'initial_data.migrations.'
+histories = import_module(MIGRATIONS + '0001_histories')
+unique_index = import_module(MIGRATIONS + '0003_history_view_unique_index')
+single_pass = import_module(MIGRATIONS + '0004_history_view_single_pass')
+
+DEFINITIONS = (
+    ('original', histories.CREATE + unique_index.CREATE),
+    ('single-pass', single_pass.CREATE + single_pass.INDEX),
+)
+
+# Share of the generated instances that go to each table
+SHARES = {
+    'patients_icdinstance': 0.4,
+    'patients_labinstance': 0.4,
+    'patients_cptinstance': 0.1,
+    'patients_medication': 0.1,
+}
+
+GENERATE = {
+    'patients_icdinstance': """
+        INSERT INTO patients_icdinstance (patient_id, code_id, date)
+        SELECT
+            1 + floor(random() * %(patients)s)::int,
+            C.ids[1 + floor(random() * C.n)::int],
+            DATE '2000-01-01' + floor(random() * 7000)::int
+        FROM
+            generate_series(1, %(rows)s),
+            (SELECT array_agg(id) AS ids, COUNT(*) AS n
+             FROM taxonomies_icd) C
+    """,
+    'patients_cptinstance': """
+        INSERT INTO patients_cptinstance (patient_id, code_id, date)
+        SELECT
+            1 + floor(random() * %(patients)s)::int,
+            C.ids[1 + floor(random() * C.n)::int],
+            DATE '2000-01-01' + floor(random() * 7000)::int
+        FROM
+            generate_series(1, %(rows)s),
+            (SELECT array_agg(id) AS ids, COUNT(*) AS n
+             FROM taxonomies_cpt) C
+    """,
+    'patients_labinstance': """
+        INSERT INTO patients_labinstance (patient_id, code_id, datetime)
+        SELECT
+            1 + floor(random() * %(patients)s)::int,
+            C.ids[1 + floor(random() * C.n)::int],
+            TIMESTAMPTZ '2000-01-01' + random() * INTERVAL '7000 days'
+        FROM
+            generate_series(1, %(rows)s),
+            (SELECT array_agg(id) AS ids, COUNT(*) AS n
+             FROM taxonomies_lab) C
+    """,
+    'patients_medication': """
+        INSERT INTO patients_medication
+            (patient_id, date, name, description)
+        SELECT
+            1 + floor(random() * %(patients)s)::int,
+            DATE '2000-01-01' + floor(random() * 7000)::int,
+            'MED' || M.n,
+            'MED' || M.n || ' ' || (1 + M.n %% 4) * 10 || ' MG ORAL DAILY'
+        FROM
+            (SELECT floor(random() * 500)::int AS n
+             FROM generate_series(1, %(rows)s)) M
+    """,
+}
+
+
+class Rollback(Exception):
+    """Raised to discard the scratch schema once the benchmark is done"""
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--instances',
+            type=int,
+            default=2000000,
+            help='Total number of synthetic instances to generate'
+        )
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=5000,
+            help='Number of synthetic patients to spread them over'
+        )
+        parser.add_argument(
+            '--lookups',
+            type=int,
+            default=200,
+            help='Number of per-patient lookups to time per definition'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                self.generate(cursor, options)
+                for name, definition in DEFINITIONS:
+                    self.bench(cursor, name, definition, options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def generate(self, cursor, options):
+        """Builds scratch instance tables shadowing the real ones"""
+        cursor.execute('CREATE SCHEMA bench_history')
+        cursor.execute('SET LOCAL search_path TO bench_history, public')
+        for table, share in SHARES.items():
+            rows = int(options['instances'] * share)
+            self.stdout.write(f'Generating {rows} rows for {table}...')
+            cursor.execute(f'CREATE TABLE {table} AS '
+                           f'SELECT * FROM public.{table} WITH NO DATA')
+            cursor.execute(GENERATE[table],
+                           {'patients': options['patients'], 'rows': rows})
+            # The same indexes django gives the foreign keys
+            cursor.execute(f'CREATE INDEX ON {table} (patient_id)')
+            if table != 'patients_medication':
+                cursor.execute(f'CREATE INDEX ON {table} (code_id)')
+            cursor.execute(f'ANALYZE {table}')
+
+    def bench(self, cursor, name, definition, options):
+        t0 = perf_counter()
+        cursor.execute(definition)
+        build = perf_counter() - t0
+
+        t0 = perf_counter()
+        cursor.execute('REFRESH MATERIALIZED VIEW v_patient_history_stats')
+        refresh = perf_counter() - t0
+        cursor.execute('ANALYZE v_patient_history_stats')
+
+        lookups = []
+        for _ in range(options['lookups']):
+            patient_id = randint(1, options['patients'])
+            t0 = perf_counter()
+            cursor.execute('SELECT * FROM v_patient_history_stats '
+                           'WHERE patient_id = %s', [patient_id])
+            cursor.fetchall()
+            lookups.append(perf_counter() - t0)
+        lookups.sort()
+
+        cursor.execute('SELECT COUNT(*) FROM v_patient_history_stats')
+        rows = cursor.fetchone()[0]
+        cursor.execute('DROP MATERIALIZED VIEW v_patient_history_stats')
+
+        median = lookups[len(lookups) // 2]
+        p99 = lookups[int(len(lookups) * 0.99) - 1]
+        self.stdout.write(self.style.SUCCESS(name))
+        self.stdout.write(f'  rows:          {rows}')
+        self.stdout.write(f'  build:         {build:.2f}s')
+        self.stdout.write(f'  refresh:       {refresh:.2f}s')
+        self.stdout.write(f'  lookup median: {median * 1e3:.2f}ms')
+        self.stdout.write(f'  lookup p99:    {p99 * 1e3:.2f}ms')
@@ -0,0 +1,155 @@
+"""
+Benchmark medication ingest against a large existing table.  A scratch copy
+of patients_medication is filled with synthetic rows, then the same batch of
+new rows is loaded with each way of computing the derived columns:
+
+* table-wide: COPY, then regenerate every row's columns (the old
+  gen_descriptions & gen_strength_nums);
+* null-only: COPY, then Medication.fill_derived on the rows without them;
+* at-parse: Medication.with_derived on the batch, then COPY.
+
+Each load is rolled back before the next, and everything afterwards.
+"""
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from patients.models import Medication
+from ...bulk import copy_frame
+
+TABLE = Medication._meta.db_table
+
+GENERATE = f"""
+    INSERT INTO {TABLE}
+        (patient_id, date, name, strength, route, frequency,
+         description, strength_num)
+    SELECT
+        1 + floor(random() * %(patients)s)::int,
+        DATE '2000-01-01' + floor(random() * 7000)::int,
+        'MED' || M.n,
+        (1 + M.n %% 4) * 10 || ' MG',
+        'ORAL',
+        'DAILY',
+        'MED' || M.n || ' ' || (1 + M.n %% 4) * 10 || ' MG ORAL DAILY',
+        (1 + M.n %% 4) * 10
+    FROM
+        (SELECT floor(random() * 500)::int AS n
+         FROM generate_series(1, %(rows)s)) M
+"""
+
+TABLE_WIDE = f"""
+    UPDATE {TABLE}
+    SET
+        description = CONCAT(name, ' ', strength, ' ', route, ' ', frequency),
+        strength_num = CAST (
+            SUBSTRING(strength from %s) AS DOUBLE PRECISION
+        )
+"""
+
+
+class Rollback(Exception):
+    """Raised to discard a load, or the scratch schema once done"""
+
+
+def batch(rows, patients):
+    """A DataFrame of `rows` new medications, without derived columns"""
+    rng = np.random.RandomState(0)
+    n = rng.randint(0, 500, rows)
+    return pd.DataFrame({
+        'patient_id': rng.randint(1, patients + 1, rows),
+        'date': (np.datetime64('2000-01-01')
+                 + rng.randint(0, 7000, rows)).astype(str),
+        'name': 'MED' + pd.Series(n).astype(str),
+        'strength': pd.Series((1 + n % 4) * 10).astype(str) + ' MG',
+        'route': 'ORAL',
+        'frequency': 'DAILY',
+    })
+
+
+def table_wide(cursor, frame):
+    copy_frame(cursor, TABLE, frame)
+    cursor.execute(TABLE_WIDE, [Medication.STRENGTH_RE])
+
+
+def null_only(cursor, frame):
+    copy_frame(cursor, TABLE, frame)
+    Medication.fill_derived()
+
+
+def at_parse(cursor, frame):
+    frame = Medication.with_derived(frame)
+    copy_frame(cursor, TABLE, frame)
+
+
+STRATEGIES = (
+    ('table-wide', table_wide),
+    ('null-only', null_only),
+    ('at-parse', at_parse),
+)
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--existing',
+            type=int,
+            default=10000000,
+            help='Number of medication rows already in the table'
+        )
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=100000,
+            help='Number of medication rows ingested'
+        )
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=100000,
+            help='Number of synthetic patients to spread them over'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                self.generate(cursor, options)
+                frame = batch(options['batch'], options['patients'])
+                for name, load in STRATEGIES:
+                    self.bench(cursor, name, load, frame)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def generate(self, cursor, options):
+        """Builds a scratch medication table shadowing the real one"""
+        cursor.execute('CREATE SCHEMA bench_meds')
+        cursor.execute('SET LOCAL search_path TO bench_meds, public')
+        # With the real table's indexes, but not its triggers or foreign keys
+        cursor.execute(f'CREATE TABLE {TABLE} '
+                       f'(LIKE public.{TABLE} INCLUDING ALL)')
+        self.stdout.write(f'Generating {options["existing"]} rows...')
+        cursor.execute(GENERATE, {'patients': options['patients'],
+                                  'rows': options['existing']})
+        cursor.execute(f'ANALYZE {TABLE}')
+
+    def bench(self, cursor, name, load, frame):
+        try:
+            with transaction.atomic():
+                t0 = perf_counter()
+                load(cursor, frame)
+                elapsed = perf_counter() - t0
+                cursor.execute(f'SELECT COUNT(*) FROM {TABLE} '
+                               f'WHERE description IS NULL')
+                missing = cursor.fetchone()[0]
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write(self.style.SUCCESS(name))
+        self.stdout.write(f'  time:      {elapsed:.2f}s')
+        self.stdout.write(f'  rows/s:    {len(frame) / elapsed:.0f}')
+        self.stdout.write(f'  unfilled:  {missing}')
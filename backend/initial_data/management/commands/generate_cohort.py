@@ -0,0 +1,492 @@
+"""
+Generate a synthetic cohort at production-like scale, for benchmarking: the
+patients' diagnoses, procedures, labs, medications, vital signs and notes,
+coded with the loaded taxonomies.
+
+Patient sizes are lognormal, so there is a long tail of heavy patients.  Each
+patient's events fall on a set of encounters across their history; their
+diagnoses come from a few conditions, each recurring from its own onset; lab
+values scatter around per-lab reference ranges.  Every chunk of patients is
+drawn with numpy in a worker process and streamed in with COPY, as
+load_patient_samples does, and the same --seed gives the same cohort.
+
+The patients are samples with MRNs starting SYN; --replace deletes the
+previous synthetic cohort first.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from faker import Faker
+from taxonomies.models import ICD, Lab, CPT
+from patients.digest import by_code, merge_by_code
+from patients.models import (Patient, ICDInstance, LabInstance, CPTInstance,
+                             ClinicalNote, Medication, HeartRate, BMI,
+                             BloodPressure, LabPercentiles)
+from ...bulk import (Throughput, copy_models, deferred_indexes,
+                     reserve_ids, restore_indexes)
+
+MRN_PREFIX = 'SYN'
+
+# In foreign key order
+MODELS = (Patient, CPTInstance, ClinicalNote, ICDInstance, LabInstance,
+          Medication, HeartRate, BloodPressure, BMI)
+
+# The mean number of events of each kind per patient (at --scale 1)
+EVENTS = {
+    ICDInstance: 400,
+    CPTInstance: 100,
+    LabInstance: 1500,
+    Medication: 300,
+    HeartRate: 400,
+    BloodPressure: 200,
+    BMI: 30,
+    ClinicalNote: 50,
+}
+
+# The spread of the patients' (lognormal) sizes
+SIZE_SIGMA = 1.0
+
+# Events per encounter, on average
+EVENTS_PER_VISIT = 10
+
+# (name, strengths, route, frequency)
+DRUGS = (
+    ('LISINOPRIL', ('5 MG', '10 MG', '20 MG', '40 MG'), 'ORAL', 'DAILY'),
+    ('METFORMIN', ('500 MG', '850 MG', '1000 MG'), 'ORAL', 'BID'),
+    ('ATORVASTATIN', ('10 MG', '20 MG', '40 MG', '80 MG'), 'ORAL', 'DAILY'),
+    ('LEVOTHYROXINE', ('25 MCG', '50 MCG', '100 MCG'), 'ORAL', 'DAILY'),
+    ('AMLODIPINE', ('2.5 MG', '5 MG', '10 MG'), 'ORAL', 'DAILY'),
+    ('METOPROLOL TARTRATE', ('25 MG', '50 MG', '100 MG'), 'ORAL', 'BID'),
+    ('OMEPRAZOLE', ('20 MG', '40 MG'), 'ORAL', 'DAILY'),
+    ('FUROSEMIDE', ('20 MG', '40 MG', '80 MG'), 'ORAL', 'DAILY'),
+    ('GABAPENTIN', ('100 MG', '300 MG', '600 MG'), 'ORAL', 'TID'),
+    ('INSULIN GLARGINE', ('10 UNITS', '20 UNITS', '30 UNITS'),
+     'SUBCUTANEOUS', 'NIGHTLY'),
+    ('HEPARIN', ('5000 UNITS',), 'SUBCUTANEOUS', 'Q8H'),
+    ('ONDANSETRON', ('4 MG', '8 MG'), 'INTRAVENOUS', 'Q6H PRN'),
+    ('ACETAMINOPHEN', ('325 MG', '500 MG', '650 MG'), 'ORAL', 'Q6H PRN'),
+    ('WARFARIN', ('1 MG', '2.5 MG', '5 MG'), 'ORAL', 'DAILY'),
+    ('PREDNISONE', ('5 MG', '10 MG', '20 MG'), 'ORAL', 'DAILY'),
+    ('ALBUTEROL', ('90 MCG',), 'INHALATION', 'Q4H PRN'),
+    ('SERTRALINE', ('50 MG', '100 MG'), 'ORAL', 'DAILY'),
+    ('VANCOMYCIN', ('1 G', '1.5 G'), 'INTRAVENOUS', 'Q12H'),
+)
+
+# (doc_type, sub_type)
+NOTES = (
+    ('PN', 'Progress Note'),
+    ('DS', 'Discharge Summary'),
+    ('HP', 'History and Physical'),
+    ('RAD', 'Radiology Report'),
+    ('CC', 'Clinical Communication'),
+)
+
+LAB_UNITS = ('mg/dL', 'mmol/L', 'g/dL', 'U/L', 'K/uL', '%')
+
+# (status, status_code) of blood pressures by range
+BP_STATUSES = (('NORMAL', 0), ('HIGH', 1), ('LOW', 2))
+
+# How many names & paragraphs each worker draws from
+POOL = 500
+
+# Set in each worker by init_worker
+_vocab = {}
+_pools = {}
+
+
+def init_worker(vocab):
+    _vocab.update(vocab)
+    factory = Faker()
+    factory.seed_instance(vocab['seed'])
+    _pools['male'] = np.array([factory.first_name_male()
+                               for _ in range(POOL)])
+    _pools['female'] = np.array([factory.first_name_female()
+                                 for _ in range(POOL)])
+    _pools['last'] = np.array([factory.last_name() for _ in range(POOL)])
+    _pools['note'] = np.array([factory.paragraph(nb_sentences=8)
+                               for _ in range(POOL)])
+
+
+def popularity(n, rng, skew=1.1):
+    """Zipf-like probabilities of `n` codes, in a random order"""
+    weights = 1 / np.arange(1, n + 1) ** skew
+    return rng.permutation(weights / weights.sum())
+
+
+def vocabulary(seed, today):
+    """
+    The codes events are drawn from, with their popularity, and a reference
+    range for each lab: everything the workers share
+    """
+    rng = np.random.RandomState(seed)
+    icds = np.array(ICD.objects.filter(phecode__isnull=False)
+                    .order_by('pk').values_list('pk', flat=True),
+                    dtype=np.int64)
+    labs = np.array(Lab.objects.order_by('pk').values_list('pk', flat=True),
+                    dtype=np.int64)
+    cpts = np.array(CPT.objects.order_by('pk').values_list('pk', flat=True),
+                    dtype=np.int64)
+    if not len(icds):
+        raise CommandError('No ICD codes with phecodes; run load_codes')
+    means = 10 ** rng.uniform(-1, 3, len(labs))
+    sds = means * rng.uniform(0.05, 0.25, len(labs))
+    drugs = [(name, strength, route, frequency)
+             for name, strengths, route, frequency in DRUGS
+             for strength in strengths]
+    return {
+        'seed': seed,
+        'today': today,
+        'icd': icds,
+        'icd_p': popularity(len(icds), rng),
+        'lab': labs,
+        'lab_p': popularity(len(labs), rng),
+        'lab_mean': means,
+        'lab_sd': sds,
+        'lab_unit': rng.choice(LAB_UNITS, len(labs)),
+        'cpt': cpts,
+        'cpt_p': popularity(len(cpts), rng),
+        'drugs': np.array(drugs, dtype=object),
+    }
+
+
+def pick(rng, counts, owners):
+    """
+    For each of `owners` (indices into `counts`, all non zero), a random
+    element of its run, as an index into the runs laid end to end
+    """
+    starts = np.cumsum(counts) - counts
+    return starts[owners] + (rng.random_sample(len(owners))
+                             * counts[owners]).astype(np.int64)
+
+
+def choose(rng, name, n):
+    """`n` random codes of the `name` taxonomy, by popularity"""
+    if not len(_vocab[name]):
+        return np.empty(0, dtype=np.int64)
+    return rng.choice(_vocab[name], n, p=_vocab[name + '_p'])
+
+
+def generate(index, ids):
+    """
+    The rows of every table for the patients `ids`, the `index`th chunk, as
+    DataFrames of model fields
+    """
+    rng = np.random.RandomState([_vocab['seed'], index])
+    n = len(ids)
+    patients = np.arange(n)
+    today = np.datetime64(_vocab['today'], 'D')
+
+    # Histories end up to two years ago and span one to thirty years
+    size = rng.lognormal(-SIZE_SIGMA ** 2 / 2, SIZE_SIGMA, n)
+    end = today - rng.randint(0, 2 * 365, n)
+    span = np.clip(rng.lognormal(np.log(8 * 365), 0.6, n),
+                   365, 30 * 365).astype(np.int64)
+    start = end - span
+    counts = {model: rng.poisson(mean * _vocab['scale'] * size)
+              for model, mean in EVENTS.items()}
+    if not len(_vocab['lab']):
+        counts[LabInstance][:] = 0
+    if not len(_vocab['cpt']):
+        counts[CPTInstance][:] = 0
+
+    # The encounters, each on a day of the history and at a daytime hour
+    visits = np.maximum(1, sum(counts.values()) // EVENTS_PER_VISIT)
+    owner = np.repeat(patients, visits)
+    visit_day = start[owner] + (rng.random_sample(len(owner))
+                                * (span[owner] + 1)).astype(np.int64)
+    visit_time = (visit_day.astype('datetime64[s]')
+                  + rng.randint(7 * 3600, 19 * 3600, len(owner)))
+
+    def events(model):
+        """Each event's patient & encounter"""
+        owner = np.repeat(patients, counts[model])
+        return owner, pick(rng, visits, owner)
+
+    rows = {}
+    birthdate = end - (rng.uniform(18, 90, n) * 365.25).astype(np.int64)
+    male = rng.random_sample(n) < 0.5
+    first = np.where(male, rng.choice(_pools['male'], n),
+                     rng.choice(_pools['female'], n))
+    rows[Patient] = pd.DataFrame({
+        'id': ids,
+        'mrn': [f'{MRN_PREFIX}{id_:09d}' for id_ in ids],
+        'first_name': first,
+        'middle_name': np.where(male, rng.choice(_pools['male'], n),
+                                rng.choice(_pools['female'], n)),
+        'last_name': rng.choice(_pools['last'], n),
+        'gender': np.where(male, 'male', 'female'),
+        'birthdate': birthdate.astype(str),
+        'is_sample': True,
+        'data_version': 0,
+        'date_offset': 0,
+    })
+
+    owner, visit = events(CPTInstance)
+    rows[CPTInstance] = pd.DataFrame({
+        'patient': ids[owner],
+        'date': visit_day[visit].astype(str),
+        'code': choose(rng, 'cpt', len(owner)),
+    })
+
+    owner, visit = events(ClinicalNote)
+    kind = rng.randint(0, len(NOTES), len(owner))
+    rows[ClinicalNote] = pd.DataFrame({
+        'patient': ids[owner],
+        'date': visit_day[visit].astype(str),
+        'doc_type': np.array([t for t, _ in NOTES])[kind],
+        'sub_type': np.array([s for _, s in NOTES])[kind],
+        'content': rng.choice(_pools['note'], len(owner)),
+    })
+
+    # Diagnoses: sicker (bigger) patients have more conditions, each coded
+    # from its onset on, most often soon after
+    conditions = 1 + rng.poisson(2 + 4 * size)
+    cond_owner = np.repeat(patients, conditions)
+    cond_code = choose(rng, 'icd', len(cond_owner))
+    onset = (rng.random_sample(len(cond_owner))
+             * span[cond_owner]).astype(np.int64)
+    owner = np.repeat(patients, counts[ICDInstance])
+    cond = pick(rng, conditions, owner)
+    since = onset[cond] + rng.exponential(span[owner] / 8).astype(np.int64)
+    rows[ICDInstance] = pd.DataFrame({
+        'patient': ids[owner],
+        'date': (start[owner] + np.minimum(since, span[owner])).astype(str),
+        'code': cond_code[cond],
+    })
+
+    # Lab results are timed by their encounter; each patient runs high or
+    # low across the board by their own margin
+    owner, visit = events(LabInstance)
+    lab = (rng.choice(len(_vocab['lab']), len(owner), p=_vocab['lab_p'])
+           if len(owner) else np.empty(0, dtype=np.int64))
+    mean, sd = _vocab['lab_mean'][lab], _vocab['lab_sd'][lab]
+    bias = rng.normal(0, 0.7, n)[owner]
+    rows[LabInstance] = pd.DataFrame({
+        'patient': ids[owner],
+        'datetime': visit_time[visit].astype(str),
+        'code': _vocab['lab'][lab],
+        'value': np.round(mean + sd * (rng.standard_normal(len(owner))
+                                       + bias), 2),
+        'unit': _vocab['lab_unit'][lab],
+        'normal_min': np.round(mean - 2 * sd, 2),
+        'normal_max': np.round(mean + 2 * sd, 2),
+    })
+
+    # Medications: each patient's few regular prescriptions, recorded at
+    # their encounters
+    drugs = _vocab['drugs']
+    regimen = 1 + rng.poisson(2 + 3 * size)
+    regimen_drug = rng.randint(0, len(drugs), regimen.sum())
+    owner, visit = events(Medication)
+    drug = drugs[regimen_drug[pick(rng, regimen, owner)]]
+    rows[Medication] = Medication.with_derived(pd.DataFrame({
+        'patient': ids[owner],
+        'date': visit_day[visit].astype(str),
+        'name': drug[:, 0],
+        'strength': drug[:, 1],
+        'route': drug[:, 2],
+        'frequency': drug[:, 3],
+    }))
+
+    # Vital signs, taken during the encounter
+    owner, visit = events(HeartRate)
+    pulse = rng.random_sample(len(owner)) < 0.5
+    taken = visit_time[visit] + rng.randint(0, 3600, len(owner))
+    rows[HeartRate] = pd.DataFrame({
+        'patient': ids[owner],
+        'entry_date': taken.astype(str),
+        'name': np.where(pulse, 'Pulse', 'RespRt'),
+        'value': np.where(pulse,
+                          np.clip(rng.normal(78, 12, len(owner)), 35, 180),
+                          np.clip(rng.normal(16, 3, len(owner)), 8, 40)
+                          ).astype(np.int64),
+    })
+
+    owner, visit = events(BloodPressure)
+    taken = visit_time[visit] + rng.randint(0, 3600, len(owner))
+    systolic = np.clip(rng.normal(124, 16, len(owner)), 70, 220)
+    diastolic = np.clip(rng.normal(78, 10, len(owner)), 40, 130)
+    systolic, diastolic = systolic.astype(np.int64), diastolic.astype(np.int64)
+    status = np.where((systolic >= 140) | (diastolic >= 90), 1,
+                      np.where(systolic < 90, 2, 0))
+    rows[BloodPressure] = pd.DataFrame({
+        'patient': ids[owner],
+        'entry_date': taken.astype(str),
+        'value': (pd.Series(systolic).astype(str) + '/'
+                  + pd.Series(diastolic).astype(str)).values,
+        'status': np.array([s for s, _ in BP_STATUSES])[status],
+        'status_code': np.array([c for _, c in BP_STATUSES])[status],
+        'systolic': systolic,
+        'diastolic': diastolic,
+    })
+
+    # Weights wander around each patient's own BMI, at a fixed height (kg
+    # and m)
+    height = np.clip(rng.normal(1.70, 0.10, n), 1.40, 2.05)
+    usual = rng.lognormal(np.log(27), 0.2, n)
+    owner, visit = events(BMI)
+    taken = visit_time[visit].astype(str)
+    weight = (usual[owner] * height[owner] ** 2
+              * (1 + rng.normal(0, 0.03, len(owner))))
+    rows[BMI] = pd.DataFrame({
+        'patient': ids[owner],
+        'weight': np.round(weight, 1),
+        'weight_date': taken,
+        'height': np.round(height[owner], 2),
+        'height_date': taken,
+        'bmi': np.round(weight / height[owner] ** 2, 1),
+    })
+    return rows
+
+
+def load_chunk(index, ids):
+    """
+    Generates and copies the `index`th chunk of patients, with ids `ids`, in
+    a worker.  Returns the generation time, {table: (rows, copy time)} and
+    {lab id: Digest} of the chunk's lab results.
+    """
+    try:
+        t0 = perf_counter()
+        rows = generate(index, np.asarray(ids, dtype=np.int64))
+        generated = perf_counter() - t0
+        stats = copy_models({model: rows[model] for model in MODELS})
+        labs = rows[LabInstance]
+        return generated, stats, by_code(labs.code.values, labs.value.values)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    # Reuse the module docstring
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=5000,
+            help='Number of patients to generate'
+        )
+        parser.add_argument(
+            '--scale',
+            type=float,
+            default=1.0,
+            help='Multiplies the mean number of events per patient'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the random draws'
+        )
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Delete the previously generated patients first'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of worker processes'
+        )
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=200,
+            help='Number of patients each worker generates per transaction'
+        )
+        parser.add_argument(
+            '--drop-indexes',
+            action='store_true',
+            help="Drop the tables' indexes for the load and rebuild them "
+                 "after, rather than maintain them (faster, but the tables "
+                 "go without them meanwhile: not for a live database)"
+        )
+
+    def handle(self, *args, **options):
+        deleted = 0
+        if options['replace']:
+            self.stdout.write('Deleting the previous cohort... ', ending='')
+            deleted, _ = (Patient.objects
+                          .filter(mrn__startswith=MRN_PREFIX).delete())
+            self.stdout.write(self.style.SUCCESS('DONE'))
+
+        vocab = vocabulary(options['seed'], date.today())
+        vocab['scale'] = options['scale']
+        for name in ('lab', 'cpt'):
+            if not len(vocab[name]):
+                self.stdout.write(self.style.WARNING(
+                    f'No {name.upper()} codes loaded; generating none'))
+
+        tables = [model._meta.db_table for model in MODELS]
+        t0 = perf_counter()
+        # Any left dropped by a load that died
+        restored = restore_indexes(tables)
+        if restored:
+            self.stdout.write(f'Restored {len(restored)} indexes')
+        if options['drop_indexes']:
+            with deferred_indexes(tables) as indexes:
+                self.stdout.write(f'Dropped {len(indexes)} indexes')
+                digests = self.load(vocab, options)
+                self.stdout.write('Rebuilding indexes...')
+        else:
+            digests = self.load(vocab, options)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE ' + ', '.join(tables))
+
+        # As in load_patient_samples: deleted results mean a rebuild
+        if deleted:
+            call_command('build_lab_percentiles', jobs=options['jobs'],
+                         stdout=self.stdout)
+        else:
+            self.stdout.write('Merging lab percentiles')
+            LabPercentiles.add(digests)
+        # The new patients' stored problem lists, ahead of their overviews
+        call_command('backfill_problem_lists', jobs=options['jobs'],
+                     stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {options["patients"]} patients in '
+            f'{perf_counter() - t0:.1f}s'
+        ))
+
+    def load(self, vocab, options):
+        """
+        Generates and copies the patients in parallel and reports throughput.
+        Returns {lab id: Digest} of the generated lab results.
+        """
+        n, size = options['patients'], options['chunk']
+        ids = reserve_ids(Patient, n)
+        chunks = [ids[i:i + size] for i in range(0, n, size)]
+
+        self.stdout.write(f'Generating {n} patients...')
+        # The workers are forked; each must open its own connection
+        connection.close()
+        t0 = perf_counter()
+        generating = 0
+        throughput = Throughput()
+        digests = {}
+        with ProcessPoolExecutor(options['jobs'], initializer=init_worker,
+                                 initargs=(vocab,)) as pool:
+            for done, (generated, stats, chunk_digests) in enumerate(
+                    pool.map(load_chunk, range(len(chunks)), chunks), 1):
+                generating += generated
+                digests = merge_by_code(digests, chunk_digests)
+                throughput.add(stats)
+                self.stdout.write(f'{min(done * size, n)}/{n} patients')
+        elapsed = perf_counter() - t0
+
+        throughput.report(self.stdout)
+        total = throughput.total
+        self.stdout.write(self.style.SUCCESS(
+            f'{total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s, '
+            f'{generating:.1f}s generating across {options["jobs"]} workers)'
+        ))
+        return digests
@@ -1,15 +1,21 @@
 """
 Load up all the code taxonomies (ICD, CPT, Labs)
+
+Safe to rerun, including against a live database: each taxonomy is copied
+into a staging table and diffed against the current one by code.  New codes
+are inserted and changed ones updated in place; codes no longer in the files
+are only reported, as deleting them would cascade to the patient histories.
 """
-import csv
-from datetime import timedelta
-from random import random, randint, sample
-from os.path import abspath, basename, dirname, join
+from os.path import abspath, dirname, join
+from time import perf_counter
 
+import pandas as pd
 from django.core.management.base import BaseCommand, CommandError
-from tqdm import tqdm
+from django.db import connection, transaction
 
+from patients import history
 from taxonomies.models import Chapter, Phecode, ICD, Lab, CPT
+from ...bulk import copy_frame, model_columns
 
 BASE = abspath(dirname(dirname(dirname(__file__))))
 CODES_DIR = join(BASE, 'resources', 'codes')
@@ -20,61 +26,150 @@ lab_category_map = {
     # Blood Count 2", "Complete Blood Count 3", and "Liver Function Tests"
 }
 
+# How many removed codes to list
+SHOW_REMOVED = 10
+
+
+def read(name):
+    """A codes csv file, every value as a string"""
+    return pd.read_csv(join(CODES_DIR, name), dtype=str,
+                       keep_default_na=False)
+
+
+def blank_to_null(values):
+    return values.where(values != '')
+
+
+def resolve(codes, model):
+    """The ids of the `model` codes in `codes`, None where blank"""
+    ids = dict(model.objects.values_list('code', 'pk'))
+    unknown = set(codes) - set(ids) - {''}
+    if unknown:
+        raise CommandError(f'Unknown {model.__name__} codes: '
+                           f'{", ".join(sorted(unknown)[:SHOW_REMOVED])}')
+    # object, so the ids stay integers alongside the nulls
+    return pd.Series([ids.get(code) for code in codes], index=codes.index,
+                     dtype=object)
+
+
+def chapters():
+    return read('chapters.csv')
+
+
+def phecodes():
+    return read('phecodes.csv')
+
+
+def icds():
+    frame = read('icds.csv')
+    return frame.assign(rank=blank_to_null(frame['rank']),
+                        phecode=resolve(frame.phecode, Phecode),
+                        chapter=resolve(frame.chapter, Chapter))
+
+
+def labs():
+    frame = read('labs.csv')
+    rank = frame['rank'].where(frame['rank'] != '', '0')
+    category = frame.code.map(lab_category_map).fillna('')
+    return frame.assign(rank=rank, category=category)
+
+
+def cpts():
+    return read('cpts.csv')
+
+
+# In foreign key order, each with the function reading its rows
+TAXONOMIES = (
+    (Chapter, chapters),
+    (Phecode, phecodes),
+    (ICD, icds),
+    (Lab, labs),
+    (CPT, cpts),
+)
+
+
 class Command(BaseCommand):
     # Reuse the module docstring
     help = __doc__
 
-    # wrap the command in a transaction
-    output_transaction = True
-
     def handle(self, *args, **options):
-        self.stdout.write('Loading ICD Chapters...')
-        with open(join(CODES_DIR, 'chapters.csv')) as fd:
-            Chapter.objects.bulk_create([
-                Chapter(**ch) for ch in tqdm(csv.DictReader(fd))
-            ])
-        self.stdout.write(self.style.SUCCESS('DONE'))
-
-        self.stdout.write('Loading Phecodes...')
-        with open(join(CODES_DIR, 'phecodes.csv')) as fd:
-            Phecode.objects.bulk_create([
-                Phecode(**ph) for ph in tqdm(csv.DictReader(fd))
-            ])
-        self.stdout.write(self.style.SUCCESS('DONE'))
-
-        self.stdout.write('Loading ICD Codes...')
-        icds = []
-        with open(join(CODES_DIR, 'icds.csv')) as fd:
-            _, *code_data = csv.reader(fd)
-        for (code, description, chapter, phecode, rank) in tqdm(code_data):
-            new_code = ICD(code=code, description=description)
-            if rank:
-                new_code.rank = int(rank)
-            if phecode:
-                new_code.phecode = Phecode.objects.get(code=phecode)
-            if chapter:
-                new_code.chapter = Chapter.objects.get(code=chapter)
-            icds.append(new_code)
-        ICD.objects.bulk_create(icds)
-        self.stdout.write(self.style.SUCCESS('DONE'))
-
-        self.stdout.write('Loading Lab Codes...')
-        labs = []
-        with open(join(CODES_DIR, 'labs.csv')) as fd:
-            data = list(csv.DictReader(fd))
-        for item in tqdm(data):
-            rank = item.pop('rank')
-            lab = Lab(**item)
-            if rank:
-                lab.rank = int(rank)
-            lab.category = lab_category_map.get(lab.code, '')
-            labs.append(lab)
-        Lab.objects.bulk_create(labs)
-        self.stdout.write(self.style.SUCCESS('DONE'))
-
-        self.stdout.write('Loading CPT Codes...')
-        with open(join(CODES_DIR, 'cpts.csv')) as fd:
-            CPT.objects.bulk_create([
-                CPT(**item) for item in tqdm(csv.DictReader(fd))
-            ])
-        self.stdout.write(self.style.SUCCESS('DONE'))
+        changed = False
+        with transaction.atomic():
+            for model, rows in TAXONOMIES:
+                changed |= self.apply(model, rows())
+
+        # Any write bumps the TaxonomyVersion (by trigger), which the cached
+        # tabs, the patient ETags and the stored problem lists are keyed on.
+        # The history stats triggers only watch the instance tables, so flag
+        # the stats as stale for the next refresh_patient_histories run
+        if changed:
+            history.request()
+
+    def apply(self, model, frame):
+        """
+        Brings `model`'s table in line with the rows of `frame` (of model
+        fields, keyed by code).  Returns whether anything was written.
+        """
+        t0 = perf_counter()
+        dupes = frame.code[frame.code.duplicated()]
+        if len(dupes):
+            raise CommandError(f'Duplicate {model.__name__} codes: '
+                               f'{", ".join(dupes.iloc[:SHOW_REMOVED])}')
+        table = model._meta.db_table
+        stage = f'stage_{table}'
+        frame = model_columns(model, frame)
+        columns = list(frame.columns)
+        values = [c for c in columns if c != 'code']
+        # N.B. row comparisons, so a change in any column counts
+        differs = (f'({", ".join("T." + c for c in values)}) IS DISTINCT FROM '
+                   f'({", ".join("S." + c for c in values)})')
+        missing = f'NOT EXISTS (SELECT 1 FROM {table} T WHERE T.code = S.code)'
+        removed = f'NOT EXISTS (SELECT 1 FROM {stage} S WHERE S.code = T.code)'
+
+        with connection.cursor() as cursor:
+            # Writers queue behind one another; readers are never blocked
+            cursor.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+            cursor.execute(f'CREATE TEMP TABLE {stage} ON COMMIT DROP AS '
+                           f'SELECT {", ".join(columns)} FROM {table} '
+                           f'WITH NO DATA')
+            copy_frame(cursor, stage, frame)
+            cursor.execute(f'ANALYZE {stage}')
+
+            # Counted first so that nothing is written (and no triggers fire)
+            # when the table is already current
+            cursor.execute(f"""
+                SELECT
+                    (SELECT COUNT(*) FROM {stage} S JOIN {table} T
+                     USING (code) WHERE {differs}),
+                    (SELECT COUNT(*) FROM {stage} S WHERE {missing})
+            """)
+            updated, inserted = cursor.fetchone()
+            if updated:
+                cursor.execute(f"""
+                    UPDATE {table} T
+                    SET {", ".join(f"{c} = S.{c}" for c in values)}
+                    FROM {stage} S
+                    WHERE T.code = S.code AND {differs}
+                """)
+            if inserted:
+                cursor.execute(f"""
+                    INSERT INTO {table} ({", ".join(columns)})
+                    SELECT {", ".join(columns)} FROM {stage} S
+                    WHERE {missing}
+                """)
+            cursor.execute(f'SELECT code FROM {table} T WHERE {removed} '
+                           f'ORDER BY code')
+            gone = [code for code, in cursor.fetchall()]
+
+        name = model._meta.verbose_name_plural
+        self.stdout.write(self.style.SUCCESS(
+            f'{name}: {len(frame)} codes, {inserted} new, {updated} changed, '
+            f'{len(gone)} removed ({perf_counter() - t0:.2f}s)'
+        ))
+        if gone:
+            shown = ', '.join(gone[:SHOW_REMOVED])
+            more = '...' if len(gone) > SHOW_REMOVED else ''
+            self.stdout.write(self.style.WARNING(
+                f'  Not in the files, left in place: {shown}{more}'
+            ))
+        return bool(updated or inserted)
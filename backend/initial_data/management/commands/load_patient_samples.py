@@ -1,220 +1,252 @@
 """
 Generate fake patients and load the data in the resources/patients dir for use
 in dev / prototyping.
+
+Patient directories are parsed in a pool of worker processes, each streaming
+its chunk of patients into the instance tables with COPY in one transaction.
+With --drop-indexes the tables' indexes are dropped for the load and rebuilt
+once at the end.  Derived columns are computed as the files are parsed:
+medication descriptions and strengths per row, and digests of each chunk's
+lab results, which are merged into the stored lab percentiles.
 """
-import csv
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
-from random import random, randint, sample
-from os.path import abspath, basename, dirname, join
-
-from django.core.management.base import BaseCommand, CommandError
-from django.utils.dateparse import parse_date, parse_datetime
-from django.utils.timezone import make_aware
+from random import randint
+from os.path import abspath, dirname, join
+from time import perf_counter
+
+import pandas as pd
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
 from faker import Faker
-from tqdm import tqdm
 from taxonomies.models import ICD, Lab, CPT
+from patients.digest import by_code, merge_by_code
 from patients.models import (Patient, ICDInstance, LabInstance, CPTInstance,
                              ClinicalNote, Medication, HeartRate, BMI,
-                             BloodPressure)
+                             BloodPressure, LabPercentiles)
+from ...bulk import (Throughput, copy_models, deferred_indexes,
+                     reserve_ids, restore_indexes)
 
 BASE = dirname(dirname(dirname(__file__)))
 PDIR = abspath(join(BASE, 'resources', 'patients'))
 
-
-def float_or_none(arg):
+# In foreign key order
+MODELS = (Patient, CPTInstance, ClinicalNote, ICDInstance, LabInstance,
+          Medication, HeartRate, BloodPressure, BMI)
+
+# Set in each worker by init_worker
+_factory = None
+_codes = {}
+
+
+def init_worker(codes):
+    global _factory
+    _factory = Faker()
+    _codes.update(codes)
+
+
+def read(path, columns):
+    """A patient's csv file, every value as a string, under `columns`"""
+    return pd.read_csv(path, dtype=str, keep_default_na=False, header=0,
+                       names=columns)
+
+
+def coded(frame, kind):
+    """The rows of `frame` with a known code, the codes replaced by ids"""
+    frame = frame[frame.code.isin(_codes[kind])]
+    return frame.assign(code=frame.code.map(_codes[kind]))
+
+
+def gen_patient(id_, mrn):
+    if randint(0, 1):
+        gender = 'male'
+        first_name = _factory.first_name_male()
+        middle_name = _factory.first_name_male()
+    else:
+        gender = 'female'
+        first_name = _factory.first_name_female()
+        middle_name = _factory.first_name_female()
+    offset = timedelta(days=randint(28, 67) * 365)
+    birthdate = (_factory.date_time_this_century() - offset).date()
+    return pd.DataFrame({
+        'id': [id_],
+        'mrn': [mrn],
+        'first_name': [first_name],
+        'middle_name': [middle_name],
+        'last_name': [_factory.last_name()],
+        'gender': [gender],
+        'birthdate': [birthdate.isoformat()],
+        'is_sample': [True],
+        'data_version': [0],
+        'date_offset': [0],
+    })
+
+
+def parse_patient(id_, name):
+    """
+    The rows of every table for the patient in directory `name`, as
+    DataFrames of model fields.  Dates & datetimes are left as the strings in
+    the files for postgres to parse (datetimes in the current time zone).
+    """
+    path = join(PDIR, name)
+    rows = {Patient: gen_patient(id_, name.replace('R', '#'))}
+
+    rows[CPTInstance] = coded(
+        read(join(path, 'cpts.csv'), ['date', 'code']), 'cpt')
+    rows[ClinicalNote] = read(join(path, 'docs.csv'),
+                              ['date', 'doc_type', 'sub_type', 'content'])
+    rows[ICDInstance] = coded(
+        read(join(path, 'icds.csv'), ['date', 'code']), 'icd')
+
+    labs = coded(read(join(path, 'labs.csv'),
+                      ['datetime', 'code', 'value', 'unit', 'normal_min',
+                       'normal_max']), 'lab')
+    # Anything that isn't a number is null
+    for field in ('value', 'normal_min', 'normal_max'):
+        labs[field] = pd.to_numeric(labs[field], errors='coerce')
+    rows[LabInstance] = labs
+
+    rows[Medication] = Medication.with_derived(
+        read(join(path, 'meds.csv'),
+             ['date', 'name', 'strength', 'route', 'frequency', 'dose',
+              'duration']))
+    rows[HeartRate] = read(join(path, 'vitals', 'heart_rate.csv'),
+                           ['entry_date', 'name', 'value'])
+    rows[BloodPressure] = read(join(path, 'vitals', 'bp.csv'),
+                               ['entry_date', 'value', 'status',
+                                'status_code', 'systolic', 'diastolic'])
+    rows[BMI] = read(join(path, 'vitals', 'bmi.csv'),
+                     ['weight', 'weight_date', 'height', 'height_date', 'bmi'])
+
+    for model in MODELS[1:]:
+        rows[model] = rows[model].assign(patient=id_)
+    return rows
+
+
+def load_chunk(patients):
+    """
+    Parses and copies a chunk of (id, directory) patients in a worker.
+    Returns the parse time, {table: (rows, copy time)} and {lab id: Digest}
+    of the chunk's lab results.
+    """
     try:
-        return float(arg)
-    except (TypeError, ValueError):
-        return None
+        t0 = perf_counter()
+        frames = {model: [] for model in MODELS}
+        for id_, name in patients:
+            for model, frame in parse_patient(id_, name).items():
+                frames[model].append(frame)
+        parsed = perf_counter() - t0
+
+        stats = copy_models({model: pd.concat(frames[model])
+                             for model in MODELS})
+        labs = pd.concat(frames[LabInstance])
+        return parsed, stats, by_code(labs.code.values, labs.value.values)
+    finally:
+        connection.close()
 
 
 class Command(BaseCommand):
     # Reuse the module docstring
     help = __doc__
 
-    # wrap the command in a transaction
-    output_transaction = True
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._factory = Faker()
-
-    @property
-    def icd_mapping(self):
-        if not hasattr(self, '_icd_mapping'):
-            self._icd_mapping = {icd.code: icd for icd in ICD.objects.all()}
-        return self._icd_mapping
-
-    @property
-    def lab_mapping(self):
-        if not hasattr(self, '_lab_mapping'):
-            self._lab_mapping = {lab.code: lab for lab in Lab.objects.all()}
-        return self._lab_mapping
-
-    @property
-    def cpt_mapping(self):
-        if not hasattr(self, '_cpt_mapping'):
-            self._cpt_mapping = {cpt.code: cpt for cpt in CPT.objects.all()}
-        return self._cpt_mapping
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of worker processes'
+        )
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=100,
+            help='Number of patients each worker copies per transaction'
+        )
+        parser.add_argument(
+            '--drop-indexes',
+            action='store_true',
+            help="Drop the tables' indexes for the load and rebuild them "
+                 "after, rather than maintain them (faster, but the tables "
+                 "go without them meanwhile: not for a live database)"
+        )
 
     def handle(self, *args, **options):
         self.stdout.write('Cleaning up old samples... ', ending='')
-        Patient.objects.filter(is_sample=True).delete()
-        self.stdout.write(self.style.SUCCESS('DONE'))
-        self.stdout.write('Generating new samples...')
-
-        ids = [x for x in os.listdir(PDIR) if x.startswith('R')]
-        for id_ in tqdm(ids):
-            grid = id_.replace('R', '#')
-            patient = self.gen_patient(grid)
-            patient.save()
-            self.load_cpts(patient, join(PDIR, id_, 'cpts.csv'))
-            self.load_docs(patient, join(PDIR, id_, 'docs.csv'))
-            self.load_icds(patient, join(PDIR, id_, 'icds.csv'))
-            self.load_labs(patient, join(PDIR, id_, 'labs.csv'))
-            self.load_meds(patient, join(PDIR, id_, 'meds.csv'))
-            self.load_hr(patient, join(PDIR, id_, 'vitals', 'heart_rate.csv'))
-            self.load_bp(patient, join(PDIR, id_, 'vitals', 'bp.csv'))
-            self.load_bmi(patient, join(PDIR, id_, 'vitals', 'bmi.csv'))
-
-        self.stdout.write(self.style.SUCCESS('DONE'))
-        self.stdout.write('Generating Lab IQRs from instances')
-        LabInstance.update_percentiles()
-        self.stdout.write('Generating Medication descriptions & strengths')
-        Medication.gen_descriptions()
-        Medication.gen_strength_nums()
+        deleted, _ = Patient.objects.filter(is_sample=True).delete()
         self.stdout.write(self.style.SUCCESS('DONE'))
 
-    def gen_patient(self, mrn):
-        patient = Patient()
-        patient.mrn = mrn
-        if randint(0, 1):
-            patient.gender = 'male'
-            patient.first_name = self._factory.first_name_male()
-            patient.middle_name = self._factory.first_name_male()
+        ids = sorted(x for x in os.listdir(PDIR) if x.startswith('R'))
+        codes = {
+            'icd': dict(ICD.objects.values_list('code', 'pk')),
+            'lab': dict(Lab.objects.values_list('code', 'pk')),
+            'cpt': dict(CPT.objects.values_list('code', 'pk')),
+        }
+        tables = [model._meta.db_table for model in MODELS]
+        t0 = perf_counter()
+        # Any left dropped by a load that died
+        restored = restore_indexes(tables)
+        if restored:
+            self.stdout.write(f'Restored {len(restored)} indexes')
+        if options['drop_indexes']:
+            with deferred_indexes(tables) as indexes:
+                self.stdout.write(f'Dropped {len(indexes)} indexes')
+                digests = self.load(ids, codes, options)
+                self.stdout.write('Rebuilding indexes...')
+        else:
+            digests = self.load(ids, codes, options)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE ' + ', '.join(tables))
+
+        # Digests can't forget values, so the old samples' results are only
+        # dropped by rebuilding them
+        if deleted:
+            call_command('build_lab_percentiles', jobs=options['jobs'],
+                         stdout=self.stdout)
         else:
-            patient.gender = 'female'
-            patient.first_name = self._factory.first_name_female()
-            patient.middle_name = self._factory.first_name_female()
-        patient.last_name = self._factory.last_name()
-        offset = timedelta(days=randint(28, 67) * 365)
-        patient.birthdate = (self._factory.date_time_this_century() - offset)
-        # Values are in centimeters
-        patient.height = randint(140, 180)
-        # Values are in kg
-        patient.weight = randint(60, 90) + round(random(), 2)
-        patient.is_sample = True
-        return patient
-
-    def load_cpts(self, patient, path):
-        instances = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader)  # toss the header
-            for (date, code) in reader:
-                if code not in self.cpt_mapping:
-                    continue
-                inst = CPTInstance(patient=patient)
-                inst.date = parse_date(date)
-                inst.code = self.cpt_mapping[code]
-                instances.append(inst)
-        CPTInstance.objects.bulk_create(instances)
-
-    def load_docs(self, patient, path):
-        docs = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader)
-            for (date, doc_type, sub_type, content) in reader:
-                inst = ClinicalNote(patient=patient)
-                inst.date = parse_date(date)
-                inst.doc_type = doc_type
-                inst.sub_type = sub_type
-                inst.content = content
-                docs.append(inst)
-        ClinicalNote.objects.bulk_create(docs)
-
-    def load_icds(self, patient, path):
-        instances = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader) # toss the header
-            for (date, code) in reader:
-                if code not in self.icd_mapping:
-                    continue
-                inst = ICDInstance(patient=patient)
-                inst.date = parse_date(date)
-                inst.code = self.icd_mapping[code]
-                instances.append(inst)
-        ICDInstance.objects.bulk_create(instances)
-
-    def load_labs(self, patient, path):
-        instances = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader)  # toss the header
-            for (dt, code, value, unit, normal_min, normal_max) in reader:
-                if code not in self.lab_mapping:
-                    continue
-                inst = LabInstance(patient=patient, unit=unit)
-                inst.datetime = make_aware(parse_datetime(dt))
-                inst.code = self.lab_mapping[code]
-                # For each of the following, if the field is defined, convert
-                # it to a float.  Otherwise it's None (i.e. null)
-                inst.value = float_or_none(value)
-                inst.normal_min = float_or_none(normal_min)
-                inst.normal_max = float_or_none(normal_max)
-                instances.append(inst)
-        LabInstance.objects.bulk_create(instances)
-
-    def load_meds(self, patient, path):
-        meds = []
-        with open(path, newline='') as fd:
-            for row in csv.DictReader(fd):
-                inst = Medication(patient=patient, **row)
-                inst.date = parse_date(row.pop('date'))
-                meds.append(inst)
-        Medication.objects.bulk_create(meds)
-
-    def load_hr(self, patient, path):
-        instances = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader) # Toss headers
-            for (dt, name, value) in reader:
-                inst = HeartRate(patient=patient, name=name, value=int(value))
-                inst.entry_date = make_aware(parse_datetime(dt))
-                instances.append(inst)
-        HeartRate.objects.bulk_create(instances)
-
-    def load_bp(self, patient, path):
-        instances = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader)
-            for (dt, value, status, code, syst, dias) in reader:
-                inst = BloodPressure(patient=patient)
-                inst.entry_date = make_aware(parse_datetime(dt))
-                inst.value = value
-                inst.status = status
-                inst.status_code = int(code)
-                inst.systolic = int(syst)
-                inst.diastolic = int(dias)
-                instances.append(inst)
-        BloodPressure.objects.bulk_create(instances)
-
-    def load_bmi(self, patient, path):
-        instances = []
-        with open(path, newline='') as fd:
-            reader = csv.reader(fd)
-            next(reader)
-            for (w, wdt, h, hdt, bmi) in reader:
-                inst = BMI(patient=patient)
-                inst.weight = float(w)
-                inst.weight_date = make_aware(parse_datetime(wdt))
-                inst.height = float(h)
-                inst.height_date = make_aware(parse_datetime(hdt))
-                inst.bmi = float(bmi)
-                instances.append(inst)
-        BMI.objects.bulk_create(instances)
+            self.stdout.write('Merging lab percentiles')
+            LabPercentiles.add(digests)
+        # The new patients' stored problem lists, ahead of their overviews
+        call_command('backfill_problem_lists', jobs=options['jobs'],
+                     stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {len(ids)} patients in {perf_counter() - t0:.1f}s'
+        ))
+
+    def load(self, ids, codes, options):
+        """
+        Copies the patients in `ids` in parallel and reports throughput.
+        Returns {lab id: Digest} of the loaded lab results.
+        """
+        # Reserve the patients' ids up front, so the workers can write their
+        # instances without reading any back
+        patients = list(zip(reserve_ids(Patient, len(ids)), ids))
+        chunks = [patients[i:i + options['chunk']]
+                  for i in range(0, len(patients), options['chunk'])]
+
+        self.stdout.write(f'Loading {len(ids)} patients...')
+        # The workers are forked; each must open its own connection
+        connection.close()
+        t0 = perf_counter()
+        parsing = 0
+        throughput = Throughput()
+        digests = {}
+        with ProcessPoolExecutor(options['jobs'], initializer=init_worker,
+                                 initargs=(codes,)) as pool:
+            for done, (parsed, stats, chunk_digests) in enumerate(
+                    pool.map(load_chunk, chunks), 1):
+                parsing += parsed
+                digests = merge_by_code(digests, chunk_digests)
+                throughput.add(stats)
+                self.stdout.write(f'{min(done * options["chunk"], len(ids))}'
+                                  f'/{len(ids)} patients')
+        elapsed = perf_counter() - t0
+
+        throughput.report(self.stdout)
+        total = throughput.total
+        self.stdout.write(self.style.SUCCESS(
+            f'{total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s, '
+            f'{parsing:.1f}s parsing across {options["jobs"]} workers)'
+        ))
+        return digests
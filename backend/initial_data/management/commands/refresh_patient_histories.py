@@ -1,9 +1,21 @@
 """
-Runs raw sql to refresh the materialized db view v_patient_history_stats, which
-aggregates a number of items per patient from other tables.
+Rebuilds the patient_history_stats table from the materialized db view
+v_patient_history_stats, which aggregates a number of items per patient from
+other tables.  The table is kept current by triggers, so this is only needed
+after changes the triggers can't see (e.g. reloading the taxonomies).  The
+view is refreshed concurrently, so searches are not blocked while it runs.
+
+Medications written without their derived columns (by anything other than
+the loaders, which compute them) are filled in first, as their stats are
+keyed by description.
 """
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection
+
+from patients import history
+from patients.models import Medication
+
 
 class Command(BaseCommand):
     # Reuse the module docstring
@@ -12,8 +24,49 @@ class Command(BaseCommand):
     # wrap the command in a transaction
     output_transaction = True
 
-    def handle(self, *args, **kwargs):
-        self.stdout.write('Refreshing patient history view...')
-        with connection.cursor() as cursor:
-            cursor.execute('REFRESH MATERIALIZED VIEW v_patient_history_stats')
-        self.stdout.write(self.style.SUCCESS('DONE'))
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--status',
+            action='store_true',
+            help='Only report how stale the history stats are'
+        )
+        parser.add_argument(
+            '--max-age',
+            type=int,
+            default=None,
+            help='Only rebuild if the last rebuild is older than this many '
+                 'seconds or a rebuild has been requested since'
+        )
+        parser.add_argument(
+            '--debounce',
+            type=float,
+            default=0,
+            help='Wait until no rebuild has been requested for this many '
+                 'seconds before each rebuild, so a burst of requests (e.g. '
+                 'from an ingest) is covered by one'
+        )
+
+    def handle(self, *args, **options):
+        status = history.staleness()
+        if options['status']:
+            for key, value in status.items():
+                self.stdout.write(f'{key}: {value}')
+            return
+        filled = Medication.fill_derived()
+        if filled:
+            self.stdout.write(f'Filled the derived columns of {filled} '
+                              f'medications')
+        max_age = options['max_age']
+        if (max_age is not None
+                and not status['pending']
+                and status['age'] is not None
+                and status['age'] < timedelta(seconds=max_age)):
+            self.stdout.write('Patient history stats are current')
+            return
+        self.stdout.write('Rebuilding patient history stats...')
+        history.request()
+        if history.refresh(options['debounce']):
+            self.stdout.write(self.style.SUCCESS('DONE'))
+        else:
+            self.stdout.write('A rebuild is already running in another '
+                              'process; it will pick up this request')
@@ -0,0 +1,216 @@
+# Hand written to replace the materialized view with a table that is kept up
+# to date incrementally by triggers on the instance tables
+from django.db import migrations
+
+# The stats table.  Rows are unique per patient & code; for medications the
+# "code" is the med name and the description distinguishes sigs, so the
+# description is part of the key (hashed since it can be long or NULL)
+CREATE_TABLE = """
+CREATE TABLE patient_history_stats (
+    id BIGSERIAL PRIMARY KEY,
+    patient_id BIGINT NOT NULL,
+    code_id BIGINT,
+    kind VARCHAR(16) NOT NULL,
+    code VARCHAR(64) NOT NULL,
+    description VARCHAR(4096),
+    count INTEGER NOT NULL,
+    earliest DATE,
+    latest DATE
+);
+CREATE UNIQUE INDEX patient_history_stats_key
+ON patient_history_stats (patient_id, kind, code, md5(COALESCE(description, '')));
+"""
+
+CONFLICT_KEY = "(patient_id, kind, code, md5(COALESCE(description, '')))"
+
+DROP_TABLE = """
+DROP TABLE IF EXISTS patient_history_stats;
+"""
+
+BACKFILL = """
+REFRESH MATERIALIZED VIEW v_patient_history_stats;
+INSERT INTO patient_history_stats
+    (patient_id, code_id, kind, code, description, count, earliest, latest)
+SELECT patient_id, code_id, kind, code, description, count, earliest, latest
+FROM v_patient_history_stats;
+"""
+
+# Per kind: the instance table, the columns identifying a stats row on the
+# instance table and on the stats table, and a query generating stats rows
+# from any relation `{src}` shaped like the instance table.  These mirror the
+# branches of v_patient_history_stats.
+KINDS = {
+    'icd': {
+        'table': 'patients_icdinstance',
+        'keys': ('patient_id', 'code_id'),
+        'stat_keys': ('patient_id', 'code_id'),
+        'stats': """
+            SELECT
+                B.patient_id, A.id, 'icd', A.code, A.description,
+                COUNT(*), MIN(B.date), MAX(B.date)
+            FROM taxonomies_icd A INNER JOIN {src} B ON A.id = B.code_id
+            WHERE A.phecode_id IS NOT NULL AND A.chapter_id IS NOT NULL
+            GROUP BY B.patient_id, A.id
+        """,
+    },
+    'cpt': {
+        'table': 'patients_cptinstance',
+        'keys': ('patient_id', 'code_id'),
+        'stat_keys': ('patient_id', 'code_id'),
+        'stats': """
+            SELECT
+                B.patient_id, A.id, 'cpt', A.code, A.description,
+                COUNT(*), MIN(B.date), MAX(B.date)
+            FROM taxonomies_cpt A INNER JOIN {src} B ON A.id = B.code_id
+            GROUP BY B.patient_id, A.id
+        """,
+    },
+    'lab': {
+        'table': 'patients_labinstance',
+        'keys': ('patient_id', 'code_id'),
+        'stat_keys': ('patient_id', 'code_id'),
+        'stats': """
+            SELECT
+                B.patient_id, A.id, 'lab', A.code, A.description,
+                COUNT(*), MIN(B.datetime)::date, MAX(B.datetime)::date
+            FROM taxonomies_lab A INNER JOIN {src} B ON A.id = B.code_id
+            GROUP BY B.patient_id, A.id
+        """,
+    },
+    'med': {
+        'table': 'patients_medication',
+        'keys': ('patient_id', 'name', 'description'),
+        'stat_keys': ('patient_id', 'code', 'description'),
+        'stats': """
+            SELECT
+                B.patient_id, NULL::bigint, 'med', B.name, B.description,
+                COUNT(*), MIN(B.date), MAX(B.date)
+            FROM {src} B
+            GROUP BY B.patient_id, B.name, B.description
+        """,
+    },
+}
+
+COLUMNS = ('(patient_id, code_id, kind, code, description, '
+           'count, earliest, latest)')
+
+# Inserts only ever add to a stats row, so they are applied as commutative
+# deltas; this keeps concurrent writers to the same patient & code correct
+INSERT_FUNC = """
+CREATE FUNCTION history_stats_{kind}_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO patient_history_stats AS S {columns}
+    {stats}
+    ON CONFLICT {conflict} DO UPDATE SET
+        count = S.count + EXCLUDED.count,
+        earliest = LEAST(S.earliest, EXCLUDED.earliest),
+        latest = GREATEST(S.latest, EXCLUDED.latest);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+# Updates & deletes can shrink a row's date range, so every touched row is
+# recomputed from the instance table
+RECOMPUTE_FUNC = """
+CREATE FUNCTION history_stats_{kind}_{event}() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM patient_history_stats S
+    USING ({touched}) T
+    WHERE S.kind = '{kind}' AND {stat_match};
+    INSERT INTO patient_history_stats {columns}
+    {stats};
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGER = """
+CREATE TRIGGER history_stats_{kind}_{name}
+AFTER {event} ON {table}
+REFERENCING {transitions}
+FOR EACH STATEMENT EXECUTE PROCEDURE history_stats_{kind}_{name}();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS history_stats_{kind}_{event} ON {table};
+DROP FUNCTION IF EXISTS history_stats_{kind}_{event}();
+"""
+
+
+def match(left, right, left_keys, right_keys):
+    """
+    Equality of the key columns between two aliases.  Only the medication
+    description may be NULL; the other keys use plain equality so the join can
+    use the instance tables' indexes.
+    """
+    return ' AND '.join(
+        f'{left}.{a} IS NOT DISTINCT FROM {right}.{b}' if b == 'description'
+        else f'{left}.{a} = {right}.{b}'
+        for a, b in zip(left_keys, right_keys)
+    )
+
+
+def maintenance_sql():
+    """Generates the trigger functions & triggers for each instance table"""
+    statements = []
+    for kind, spec in KINDS.items():
+        keys = ', '.join(spec['keys'])
+        touched = {
+            'delete': f'SELECT DISTINCT {keys} FROM old_rows',
+            'update': (f'SELECT {keys} FROM old_rows '
+                       f'UNION SELECT {keys} FROM new_rows'),
+        }
+        transitions = {
+            'insert': 'NEW TABLE AS new_rows',
+            'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+            'delete': 'OLD TABLE AS old_rows',
+        }
+        statements.append(INSERT_FUNC.format(
+            kind=kind,
+            columns=COLUMNS,
+            stats=spec['stats'].format(src='new_rows'),
+            conflict=CONFLICT_KEY,
+        ))
+        for event, rows in touched.items():
+            instances = (f'(SELECT I.* FROM {spec["table"]} I '
+                         f'INNER JOIN ({rows}) T '
+                         f'ON {match("I", "T", spec["keys"], spec["keys"])})')
+            statements.append(RECOMPUTE_FUNC.format(
+                kind=kind,
+                event=event,
+                touched=rows,
+                stat_match=match('S', 'T', spec['stat_keys'], spec['keys']),
+                columns=COLUMNS,
+                stats=spec['stats'].format(src=instances),
+            ))
+        for event, refs in transitions.items():
+            statements.append(TRIGGER.format(
+                kind=kind,
+                event=event.upper(),
+                name=event,
+                table=spec['table'],
+                transitions=refs,
+            ))
+    return '\n'.join(statements)
+
+
+def drop_maintenance_sql():
+    return '\n'.join(DROP_TRIGGER.format(kind=kind, event=event,
+                                         table=spec['table'])
+                     for kind, spec in KINDS.items()
+                     for event in ('insert', 'update', 'delete'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0001_histories'),
+        ('patients', '0006_auto_20190115_0111'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TABLE, DROP_TABLE),
+        migrations.RunSQL(BACKFILL, migrations.RunSQL.noop),
+        migrations.RunSQL(maintenance_sql(), drop_maintenance_sql()),
+    ]
@@ -0,0 +1,23 @@
+# Hand written: REFRESH MATERIALIZED VIEW CONCURRENTLY requires a unique index
+# over plain columns covering every row of the view
+from django.db import migrations
+
+CREATE = """
+CREATE UNIQUE INDEX v_patient_history_stats_key
+ON v_patient_history_stats (patient_id, kind, code, description);
+"""
+
+DROP = """
+DROP INDEX IF EXISTS v_patient_history_stats_key;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0002_history_stats_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE, DROP)
+    ]
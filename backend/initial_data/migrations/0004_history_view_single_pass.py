@@ -0,0 +1,133 @@
+# Hand written to regenerate v_patient_history_stats
+from importlib import import_module
+
+from django.db import migrations
+
+histories = import_module('initial_data.migrations.0001_histories')
+unique_index = import_module('initial_data.migrations.0003_history_view_unique_index')
+
+# Each branch aggregates its instance table once (count, earliest and latest
+# in the same GROUP BY) and only then joins the code taxonomy, rather than
+# running two correlated MIN/MAX subqueries per group.  The branches can't
+# overlap (they differ by kind) so they are combined with UNION ALL, which
+# skips the sort & dedup of UNION.
+CREATE = """
+CREATE MATERIALIZED VIEW v_patient_history_stats
+AS (
+    SELECT
+        B.patient_id,
+        A.id AS "code_id",
+        'icd' AS "kind",
+        A.code,
+        A.description,
+        B.count,
+        B.earliest,
+        B.latest
+    FROM
+        (
+            SELECT
+                patient_id,
+                code_id,
+                COUNT(*) AS "count",
+                MIN(date) AS earliest,
+                MAX(date) AS latest
+            FROM patients_icdinstance
+            GROUP BY patient_id, code_id
+        ) B
+        INNER JOIN taxonomies_icd A
+        ON A.id = B.code_id
+    WHERE
+        A.phecode_id IS NOT NULL AND
+        A.chapter_id IS NOT NULL
+)
+UNION ALL
+(
+    SELECT
+        B.patient_id,
+        A.id AS "code_id",
+        'cpt' AS "kind",
+        A.code,
+        A.description,
+        B.count,
+        B.earliest,
+        B.latest
+    FROM
+        (
+            SELECT
+                patient_id,
+                code_id,
+                COUNT(*) AS "count",
+                MIN(date) AS earliest,
+                MAX(date) AS latest
+            FROM patients_cptinstance
+            GROUP BY patient_id, code_id
+        ) B
+        INNER JOIN taxonomies_cpt A
+        ON A.id = B.code_id
+)
+UNION ALL
+(
+    SELECT
+        B.patient_id,
+        A.id AS "code_id",
+        'lab' AS "kind",
+        A.code,
+        A.description,
+        B.count,
+        B.earliest,
+        B.latest
+    FROM
+        (
+            SELECT
+                patient_id,
+                code_id,
+                COUNT(*) AS "count",
+                MIN(datetime)::date AS earliest,
+                MAX(datetime)::date AS latest
+            FROM patients_labinstance
+            GROUP BY patient_id, code_id
+        ) B
+        INNER JOIN taxonomies_lab A
+        ON A.id = B.code_id
+)
+UNION ALL
+(
+    SELECT
+        patient_id,
+        NULL AS "code_id",
+        'med' AS "kind",
+        name AS "code",
+        description,
+        COUNT(*) AS "count",
+        MIN(date) AS earliest,
+        MAX(date) AS latest
+    FROM patients_medication
+    GROUP BY patient_id, name, description
+);
+"""
+
+# The key: a code is unique per patient and kind, except that medications are
+# keyed by name *and* description (one row per sig).  patient_id leads so the
+# same index serves per-patient lookups.
+INDEX = """
+CREATE UNIQUE INDEX v_patient_history_stats_key
+ON v_patient_history_stats (patient_id, kind, code, description);
+"""
+
+DROP = """
+DROP MATERIALIZED VIEW IF EXISTS v_patient_history_stats;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0003_history_view_unique_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            DROP + CREATE + INDEX,
+            DROP + histories.CREATE + unique_index.CREATE,
+        )
+    ]
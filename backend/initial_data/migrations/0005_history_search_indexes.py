@@ -0,0 +1,32 @@
+# Hand written to index patient_history_stats for the code search
+from django.contrib.postgres.operations import (BtreeGinExtension,
+                                                TrigramExtension)
+from django.db import migrations
+
+# btree_gin lets patient_id share a GIN index with the trigram columns, so a
+# patient's matches come out of a single index scan
+CREATE = """
+CREATE INDEX patient_history_stats_trgm
+ON patient_history_stats
+USING gin (patient_id, code gin_trgm_ops, description gin_trgm_ops);
+CREATE INDEX patient_history_stats_code_prefix
+ON patient_history_stats (patient_id, upper(code::text) text_pattern_ops);
+"""
+
+DROP = """
+DROP INDEX IF EXISTS patient_history_stats_trgm;
+DROP INDEX IF EXISTS patient_history_stats_code_prefix;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0004_history_view_single_pass'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        BtreeGinExtension(),
+        migrations.RunSQL(CREATE, DROP),
+    ]
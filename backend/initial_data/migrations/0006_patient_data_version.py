@@ -0,0 +1,82 @@
+# Hand written to keep patients_patient.data_version current
+from django.db import migrations
+
+# The tables the patient tabs are computed from
+TABLES = (
+    'patients_icdinstance',
+    'patients_cptinstance',
+    'patients_labinstance',
+    'patients_medication',
+    'patients_heartrate',
+    'patients_bmi',
+    'patients_bloodpressure',
+)
+
+# Per event, the patients whose rows a statement wrote.  Statement level, so
+# a bulk load bumps each patient once rather than once per row.
+TOUCHED = {
+    'insert': 'SELECT patient_id FROM new_rows',
+    'update': ('SELECT patient_id FROM old_rows '
+               'UNION SELECT patient_id FROM new_rows'),
+    'delete': 'SELECT patient_id FROM old_rows',
+}
+
+TRANSITIONS = {
+    'insert': 'NEW TABLE AS new_rows',
+    'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+    'delete': 'OLD TABLE AS old_rows',
+}
+
+FUNC = """
+CREATE FUNCTION patient_data_version_{event}() RETURNS trigger AS $$
+BEGIN
+    UPDATE patients_patient SET data_version = data_version + 1
+    WHERE id IN ({touched});
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGER = """
+CREATE TRIGGER patient_data_version_{event}
+AFTER {EVENT} ON {table}
+REFERENCING {transitions}
+FOR EACH STATEMENT EXECUTE PROCEDURE patient_data_version_{event}();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS patient_data_version_{event} ON {table};
+"""
+
+DROP_FUNC = """
+DROP FUNCTION IF EXISTS patient_data_version_{event}();
+"""
+
+
+def create_sql():
+    statements = [FUNC.format(event=event, touched=touched)
+                  for event, touched in TOUCHED.items()]
+    statements += [TRIGGER.format(event=event, EVENT=event.upper(),
+                                  table=table, transitions=transitions)
+                   for table in TABLES
+                   for event, transitions in TRANSITIONS.items()]
+    return '\n'.join(statements)
+
+
+def drop_sql():
+    statements = [DROP_TRIGGER.format(event=event, table=table)
+                  for table in TABLES for event in TRANSITIONS]
+    statements += [DROP_FUNC.format(event=event) for event in TRANSITIONS]
+    return '\n'.join(statements)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0005_history_search_indexes'),
+        ('patients', '0009_patient_data_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_sql(), drop_sql()),
+    ]
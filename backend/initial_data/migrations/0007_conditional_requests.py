@@ -0,0 +1,82 @@
+# Hand written: the versions the API's ETag & Last-Modified headers come from
+from importlib import import_module
+
+from django.db import migrations
+
+data_version = import_module('initial_data.migrations.0006_patient_data_version')
+
+# The patient data version functions, now also stamping the time of the bump
+FUNC = """
+CREATE OR REPLACE FUNCTION patient_data_version_{event}() RETURNS trigger AS $$
+BEGIN
+    UPDATE patients_patient SET {assignments}
+    WHERE id IN ({touched});
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+BUMP = 'data_version = data_version + 1, data_modified = now()'
+OLD_BUMP = 'data_version = data_version + 1'
+
+# The tables the ICD endpoint is served from
+TAXONOMY_TABLES = ('taxonomies_icd', 'taxonomies_phecode')
+
+TAXONOMY = """
+INSERT INTO taxonomies_taxonomyversion (id, version, modified)
+VALUES (1, 0, now());
+
+CREATE FUNCTION taxonomy_version_bump() RETURNS trigger AS $$
+BEGIN
+    UPDATE taxonomies_taxonomyversion
+    SET version = version + 1, modified = now()
+    WHERE id = 1;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+TAXONOMY_TRIGGER = """
+CREATE TRIGGER taxonomy_version_bump
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+FOR EACH STATEMENT EXECUTE PROCEDURE taxonomy_version_bump();
+"""
+
+DROP_TAXONOMY_TRIGGER = """
+DROP TRIGGER IF EXISTS taxonomy_version_bump ON {table};
+"""
+
+DROP_TAXONOMY = """
+DROP FUNCTION IF EXISTS taxonomy_version_bump();
+DELETE FROM taxonomies_taxonomyversion;
+"""
+
+
+def functions_sql(assignments):
+    return '\n'.join(FUNC.format(event=event, assignments=assignments,
+                                 touched=touched)
+                     for event, touched in data_version.TOUCHED.items())
+
+
+def taxonomy_sql():
+    return TAXONOMY + '\n'.join(TAXONOMY_TRIGGER.format(table=table)
+                                for table in TAXONOMY_TABLES)
+
+
+def drop_taxonomy_sql():
+    return '\n'.join(DROP_TAXONOMY_TRIGGER.format(table=table)
+                     for table in TAXONOMY_TABLES) + DROP_TAXONOMY
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0006_patient_data_version'),
+        ('patients', '0010_patient_data_modified'),
+        ('taxonomies', '0005_taxonomyversion'),
+    ]
+
+    operations = [
+        migrations.RunSQL(functions_sql(BUMP), functions_sql(OLD_BUMP)),
+        migrations.RunSQL(taxonomy_sql(), drop_taxonomy_sql()),
+    ]
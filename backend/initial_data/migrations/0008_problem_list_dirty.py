@@ -0,0 +1,84 @@
+# Hand written: the queue of stored problem list entries needing a recompute
+from importlib import import_module
+
+from django.db import migrations
+
+data_version = import_module('initial_data.migrations.0006_patient_data_version')
+
+# (patient, phecode) pairs whose ICD instances have been written since their
+# patients_problemlistentry row was computed; see patients.problems.  Seeded
+# with every pair in the history, so entries are computed on first use even
+# if the backfill command is never run.
+CREATE_TABLE = """
+CREATE TABLE patient_problem_dirty (
+    patient_id INTEGER NOT NULL,
+    phecode_id INTEGER NOT NULL,
+    PRIMARY KEY (patient_id, phecode_id)
+);
+INSERT INTO patient_problem_dirty (patient_id, phecode_id)
+SELECT DISTINCT I.patient_id, C.phecode_id
+FROM patients_icdinstance I INNER JOIN taxonomies_icd C ON C.id = I.code_id
+WHERE C.phecode_id IS NOT NULL;
+"""
+
+DROP_TABLE = """
+DROP TABLE IF EXISTS patient_problem_dirty;
+"""
+
+TOUCHED = {
+    'insert': 'SELECT patient_id, code_id FROM new_rows',
+    'update': ('SELECT patient_id, code_id FROM old_rows '
+               'UNION SELECT patient_id, code_id FROM new_rows'),
+    'delete': 'SELECT patient_id, code_id FROM old_rows',
+}
+
+FUNC = """
+CREATE FUNCTION problem_list_dirty_{event}() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO patient_problem_dirty (patient_id, phecode_id)
+    SELECT DISTINCT T.patient_id, C.phecode_id
+    FROM ({touched}) T INNER JOIN taxonomies_icd C ON C.id = T.code_id
+    WHERE C.phecode_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGER = """
+CREATE TRIGGER problem_list_dirty_{event}
+AFTER {EVENT} ON patients_icdinstance
+REFERENCING {transitions}
+FOR EACH STATEMENT EXECUTE PROCEDURE problem_list_dirty_{event}();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS problem_list_dirty_{event} ON patients_icdinstance;
+DROP FUNCTION IF EXISTS problem_list_dirty_{event}();
+"""
+
+
+def create_sql():
+    return '\n'.join(
+        FUNC.format(event=event, touched=TOUCHED[event])
+        + TRIGGER.format(event=event, EVENT=event.upper(),
+                         transitions=transitions)
+        for event, transitions in data_version.TRANSITIONS.items()
+    )
+
+
+def drop_sql():
+    return '\n'.join(DROP_TRIGGER.format(event=event) for event in TOUCHED)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0007_conditional_requests'),
+        ('patients', '0011_problemlistentry'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TABLE, DROP_TABLE),
+        migrations.RunSQL(create_sql(), drop_sql()),
+    ]
@@ -0,0 +1,26 @@
+# Hand written so Medication.fill_derived finds the rows it has left to fill
+# without scanning the table
+from django.db import migrations
+
+# Holds only the rows written without their derived columns, which is
+# normally none of them
+CREATE = """
+CREATE INDEX patients_medication_underived
+ON patients_medication (id)
+WHERE description IS NULL;
+"""
+
+DROP = """
+DROP INDEX IF EXISTS patients_medication_underived;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0008_problem_list_dirty'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE, DROP),
+    ]
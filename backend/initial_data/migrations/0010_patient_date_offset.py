@@ -0,0 +1,36 @@
+# Hand written: a change of a patient's date_offset changes every date read
+# from their history, so it counts as a change of their data
+from django.db import migrations
+
+CREATE = """
+CREATE FUNCTION patient_date_offset_bump() RETURNS trigger AS $$
+BEGIN
+    NEW.data_version := OLD.data_version + 1;
+    NEW.data_modified := now();
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER patient_date_offset_bump
+BEFORE UPDATE OF date_offset ON patients_patient
+FOR EACH ROW
+WHEN (OLD.date_offset IS DISTINCT FROM NEW.date_offset)
+EXECUTE PROCEDURE patient_date_offset_bump();
+"""
+
+DROP = """
+DROP TRIGGER IF EXISTS patient_date_offset_bump ON patients_patient;
+DROP FUNCTION IF EXISTS patient_date_offset_bump();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0009_medication_underived_index'),
+        ('patients', '0013_date_offset'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE, DROP),
+    ]
@@ -0,0 +1,30 @@
+# Hand written: the tabs and problem lists read the lab, CPT & chapter codes
+# too, so writes to any taxonomy bump the version they are cached under
+from importlib import import_module
+
+from django.db import migrations
+
+conditional = import_module('initial_data.migrations.0007_conditional_requests')
+
+TABLES = ('taxonomies_chapter', 'taxonomies_lab', 'taxonomies_cpt')
+
+
+def create_sql():
+    return '\n'.join(conditional.TAXONOMY_TRIGGER.format(table=table)
+                     for table in TABLES)
+
+
+def drop_sql():
+    return '\n'.join(conditional.DROP_TAXONOMY_TRIGGER.format(table=table)
+                     for table in TABLES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0010_patient_date_offset'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_sql(), drop_sql()),
+    ]
@@ -0,0 +1,40 @@
+# Hand written: the view's unique index keyed the raw description, which can
+# be longer than a btree entry may be (about 2.7kB), failing the index build or
+# a refresh.  REFRESH ... CONCURRENTLY needs a unique index over plain columns,
+# so the view gains the description's hash as a column and is keyed on that,
+# as the stats table is.
+from importlib import import_module
+
+from django.db import migrations
+
+single_pass = import_module('initial_data.migrations.0004_history_view_single_pass')
+
+HEADER = 'CREATE MATERIALIZED VIEW v_patient_history_stats\nAS'
+assert single_pass.CREATE.strip().startswith(HEADER)
+
+# The single pass definition, with the hash of each row's description
+CREATE = f"""
+CREATE MATERIALIZED VIEW v_patient_history_stats
+AS
+SELECT S.*, md5(COALESCE(S.description, '')) AS description_md5
+FROM ({single_pass.CREATE.strip()[len(HEADER):].rstrip(';')}) S;
+"""
+
+INDEX = """
+CREATE UNIQUE INDEX v_patient_history_stats_key
+ON v_patient_history_stats (patient_id, kind, code, description_md5);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0011_taxonomy_version_all_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            single_pass.DROP + CREATE + INDEX,
+            single_pass.DROP + single_pass.CREATE + single_pass.INDEX,
+        )
+    ]
@@ -0,0 +1,94 @@
+# Hand written: the update & delete triggers of the history stats delete the
+# touched rows and insert them again.  Two statements touching the same stats
+# row could both delete it and then both insert it, failing the second on the
+# unique key; and each would recompute the row without the other's changes.
+from importlib import import_module
+
+from django.db import migrations
+
+stats_table = import_module('initial_data.migrations.0002_history_stats_table')
+
+# Key space of the advisory locks held on stats rows while they are recomputed
+STATS_LOCK = 0x6873_7461
+
+# Stats rows are locked by bucket of their keys' hash, one lock per bucket,
+# so that a statement touching a great many rows (deleting patients, say)
+# takes a bounded number of locks rather than running the shared lock table
+# out of memory (it holds max_locks_per_transaction * max_connections, 6400
+# by default)
+BUCKETS = 128
+
+# The touched rows are locked first (in a fixed order, so two statements
+# can't deadlock), so a concurrent recompute of the same rows waits for this
+# one to commit and then sees its changes.  The insert also upserts, for rows
+# an insert trigger (which takes no locks) wrote meanwhile.
+RECOMPUTE_FUNC = """
+CREATE OR REPLACE FUNCTION history_stats_{kind}_{event}() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock({lock}, K.key)
+    FROM (
+        SELECT DISTINCT
+            hashtext(concat_ws(':', '{kind}', {keys})) & {mask} AS key
+        FROM ({touched}) T
+        ORDER BY key
+    ) K;
+    DELETE FROM patient_history_stats S
+    USING ({touched}) T
+    WHERE S.kind = '{kind}' AND {stat_match};
+    INSERT INTO patient_history_stats {columns}
+    {stats}
+    ON CONFLICT {conflict} DO UPDATE SET
+        code_id = EXCLUDED.code_id,
+        count = EXCLUDED.count,
+        earliest = EXCLUDED.earliest,
+        latest = EXCLUDED.latest;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+# As created by 0002
+OLD_RECOMPUTE_FUNC = stats_table.RECOMPUTE_FUNC.replace(
+    'CREATE FUNCTION', 'CREATE OR REPLACE FUNCTION')
+
+
+def recompute_sql(template):
+    """The update & delete trigger functions of each kind, from `template`"""
+    match = stats_table.match
+    statements = []
+    for kind, spec in stats_table.KINDS.items():
+        keys = ', '.join(spec['keys'])
+        touched = {
+            'delete': f'SELECT DISTINCT {keys} FROM old_rows',
+            'update': (f'SELECT {keys} FROM old_rows '
+                       f'UNION SELECT {keys} FROM new_rows'),
+        }
+        for event, rows in touched.items():
+            instances = (f'(SELECT I.* FROM {spec["table"]} I '
+                         f'INNER JOIN ({rows}) T ON '
+                         f'{match("I", "T", spec["keys"], spec["keys"])})')
+            statements.append(template.format(
+                kind=kind,
+                event=event,
+                lock=STATS_LOCK,
+                mask=BUCKETS - 1,
+                keys=', '.join(f'T.{key}' for key in spec['keys']),
+                touched=rows,
+                stat_match=match('S', 'T', spec['stat_keys'], spec['keys']),
+                columns=stats_table.COLUMNS,
+                stats=spec['stats'].format(src=instances),
+                conflict=stats_table.CONFLICT_KEY,
+            ))
+    return '\n'.join(statements)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0012_history_view_description_hash'),
+    ]
+
+    operations = [
+        migrations.RunSQL(recompute_sql(RECOMPUTE_FUNC),
+                          recompute_sql(OLD_RECOMPUTE_FUNC)),
+    ]
@@ -0,0 +1,28 @@
+# Hand written: the definitions of the indexes a bulk load has dropped (see
+# initial_data.bulk.deferred_indexes), recorded as they are dropped and
+# deleted as each is rebuilt, so a load that dies in between leaves what to
+# restore behind rather than only the missing indexes
+from django.db import migrations
+
+CREATE_TABLE = """
+CREATE TABLE bulk_deferred_index (
+    name TEXT PRIMARY KEY,
+    tablename TEXT NOT NULL,
+    definition TEXT NOT NULL
+);
+"""
+
+DROP_TABLE = """
+DROP TABLE IF EXISTS bulk_deferred_index;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('initial_data', '0013_history_stats_recompute_locks'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TABLE, DROP_TABLE),
+    ]
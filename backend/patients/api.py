@@ -1,21 +1,30 @@
 """
 API Endpoints related to retrieving patient information and histories.
 """
-from datetime import timedelta
+from datetime import date, datetime, time, timedelta, timezone
 
-from django.db.models import F, Q
+from django.db.models import Subquery
 from django.utils.dateparse import parse_date
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import SearchFilter
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.serializers import (ModelSerializer,
                                         HyperlinkedModelSerializer,
                                         HyperlinkedIdentityField as Link,
                                         ReadOnlyField)
+from rest_framework.settings import api_settings
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
-from .models import Patient, HistoryStats
-from . import tabs
+from chartviz.conditional import conditional
+from chartviz.queries import query_budget
+from taxonomies.models import TaxonomyVersion
+from .renderers import compact_renderers
+from .timeline import PatientTimeline, Window
+from .downsample import METHODS
+from .models import Patient, HistoryStats, LabPercentiles
+from . import cache
 
 
 class PatientSerializer(HyperlinkedModelSerializer):
@@ -28,6 +37,7 @@ class PatientSerializer(HyperlinkedModelSerializer):
     cpts = Link(view_name='patient-cpts')
     conditions = Link(view_name='patient-condition')
     notes = Link(view_name='patient-notes')
+    bundle = Link(view_name='patient-bundle')
 
     class Meta:
         model = Patient
@@ -41,88 +51,219 @@ class HistoryStatsSerializer(ModelSerializer):
         fields = '__all__'
 
 
+# The single TaxonomyVersion row
+_taxonomy = TaxonomyVersion.objects.filter(pk=1)
+
+
+def patient_version(view, request):
+    """
+    Validators for the responses computed from a patient's history: its data
+    version, the taxonomy version, when the lab percentiles were last
+    written, and the day, as the default window ends today
+    """
+    patient = view.get_object()
+    taxonomy_version, taxonomy_modified = patient.taxonomy()
+    percentiles_modified = patient.percentiles()
+    today = date.today()
+    midnight = datetime.combine(today, time(), timezone.utc)
+    modified = max(filter(None, (patient.data_modified, taxonomy_modified,
+                                 percentiles_modified, midnight)))
+    version = (patient.pk, patient.data_version, taxonomy_version,
+               percentiles_modified, today)
+    return version, modified
+
+
 class PatientViewSet(ReadOnlyModelViewSet):
-    queryset = Patient.objects.all()
+    # With the taxonomy & percentiles versions the tabs are cached under (see
+    # Patient.taxonomy & Patient.percentiles), so they cost no query of their
+    # own
+    queryset = Patient.objects.annotate(
+        taxonomy_version=Subquery(_taxonomy.values('version')),
+        taxonomy_modified=Subquery(_taxonomy.values('modified')),
+        percentiles_modified=Subquery(LabPercentiles.latest()),
+    )
     serializer_class = PatientSerializer
     filter_backends = (SearchFilter,)
     search_fields = ('first_name', 'middle_name', 'last_name', 'mrn')
+    # JSON by default; the compact forms on request (see renderers.py)
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES,
+                        *compact_renderers]
+    max_search_results = 100
+    # Bounds on the max_points chart series can be downsampled to
+    min_points = 10
+    max_points = 10000
+    # The tabs that can be requested together from the bundle endpoint
+    bundle_tabs = ('overview', 'systems', 'labs', 'meds', 'vitals', 'cpts')
+    # The most queries a request to each action should make, whatever the
+    # patient (see chartviz.queries)
+    query_budgets = {
+        'list': 4,
+        'retrieve': 3,
+        'code_search': 4,
+        'overview': 18,
+        'systems': 6,
+        'labs': 6,
+        'meds': 5,
+        'vitals': 7,
+        'cpts': 5,
+        'condition': 9,
+        'bundle': 22,
+        'notes': 4,
+    }
+
+    def get_object(self):
+        """Memoized, so conditional checks and actions share one lookup"""
+        if not hasattr(self, '_object'):
+            self._object = super().get_object()
+        return self._object
+
+    def window(self):
+        """
+        The window the tabs are computed over, from the `start` and `end`
+        dates and `resolution` (number of grid points) in the query
+        """
+        params = self.request.query_params
+        try:
+            return Window.parse(params.get('start'), params.get('end'),
+                                params.get('resolution'))
+        except ValueError as exc:
+            raise ValidationError(str(exc))
+
+    def downsampling(self):
+        """
+        (max_points, method) for the chart series, from the query: by default
+        they are sent whole
+        """
+        params = self.request.query_params
+        method = params.get('method', METHODS[0])
+        if method not in METHODS:
+            raise ValidationError(f'method must be one of {", ".join(METHODS)}')
+        if not params.get('max_points'):
+            return None, method
+        try:
+            max_points = int(params['max_points'])
+        except ValueError:
+            raise ValidationError('max_points must be an integer')
+        if not self.min_points <= max_points <= self.max_points:
+            raise ValidationError(f'max_points must be from {self.min_points} '
+                                  f'to {self.max_points}')
+        return max_points, method
 
     @action(detail=True, url_path='code-search')
+    @conditional(patient_version)
     def code_search(self, request, pk=None):
-        """Returns all relevant / matching codes from the patient history"""
+        """
+        Returns the best matching codes from the patient history, ranked.  At
+        most `limit` results are sent; `next` is the cursor for the page after
+        (None once there are no more) and is passed back as `cursor`.  The
+        cursor is the rank, count and id of the page's last result, so a page
+        starts where the last ended rather than rescanning the ones before.
+        """
         ctx = dict(request=request)
-        term = request.query_params.get('term')
+        term = request.query_params.get('term', '').strip()
         if not term:
-            return Response({'results': []})
+            return Response({'results': [], 'next': None})
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            raise ValidationError('limit must be an integer')
+        after = None
+        if request.query_params.get('cursor'):
+            try:
+                rank, count, id_ = request.query_params['cursor'].split(',')
+                after = (float(rank), int(count), int(id_))
+            except ValueError:
+                raise ValidationError('cursor must be a `next` sent earlier')
+        limit = min(max(limit, 1), self.max_search_results)
         patient = self.get_object()
-        search = (Q(code__icontains=term)
-                  | Q(description__icontains=term)
-                  | Q(kind__icontains=term))
-        events = HistoryStats.objects.filter(search, patient_id=patient.id)
+        # Ask for one extra result to find out if there is another page
+        events = list(HistoryStats.search(patient.id, term, limit + 1, after,
+                                          patient.date_offset))
+        more = len(events) > limit
+        events = events[:limit]
         serialized = HistoryStatsSerializer(events, many=True, context=ctx)
-        return Response({'results': serialized.data})
+        last = events[-1] if events else None
+        return Response({
+            'results': serialized.data,
+            'next': f'{last.rank!r},{last.count},{last.id}' if more else None,
+        })
 
     @action(detail=True)
+    @conditional(patient_version)
     def overview(self, request, pk=None):
         patient = self.get_object()
-        response_data = tabs.overview(patient)
+        response_data = cache.tab(patient, 'overview', window=self.window())
         return Response(response_data)
 
     @action(detail=True)
+    @conditional(patient_version)
     def systems(self, request, pk=None):
-        return Response(tabs.systems(self.get_object()))
+        return Response(cache.tab(self.get_object(), 'systems',
+                                  window=self.window()))
 
     @action(detail=True)
+    @conditional(patient_version)
     def labs(self, request, pk=None):
-        return Response(tabs.labs(self.get_object()))
+        """Series downsampled per `max_points` & `method` if given"""
+        return Response(cache.tab(self.get_object(), 'labs',
+                                  *self.downsampling(),
+                                  window=self.window()))
 
     @action(detail=True)
+    @conditional(patient_version)
     def meds(self, request, pk=None):
-        return Response(tabs.meds(self.get_object()))
+        return Response(cache.tab(self.get_object(), 'meds',
+                                  window=self.window()))
 
     @action(detail=True)
+    @conditional(patient_version)
     def vitals(self, request, pk=None):
-        patient = self.get_object()
-        heart_rate = (patient.vitals_hr
-                      .filter(name='Pulse')
-                      .annotate(date=F('entry_date'))
-                      .order_by('date')
-                      .values('date', 'value'))
-        respiratory_rate = (patient.vitals_hr
-                            .filter(name='RespRt')
-                            .annotate(date=F('entry_date'))
-                            .order_by('date')
-                            .values('date', 'value'))
-        blood_pressure = (patient.vitals_bp
-                          .annotate(date=F('entry_date'))
-                          .order_by('date')
-                          .values('date', 'status', 'systolic', 'diastolic'))
-        bmi = (patient.vitals_bmi
-               .annotate(date=F('weight_date'),
-                         value=F('bmi'),
-                         weightDate=F('weight_date'),
-                         heightDate=F('height_date'))
-               .order_by('weightDate', 'heightDate')
-               .values('date', 'value',
-                       'weightDate', 'weight',
-                       'heightDate', 'height'))
-        return Response({'heartRate': heart_rate,
-                         'respiratoryRate': respiratory_rate,
-                         'bloodPressure': blood_pressure,
-                         'bmi': bmi})
+        """Series downsampled per `max_points` & `method` if given"""
+        return Response(cache.tab(self.get_object(), 'vitals',
+                                  *self.downsampling(),
+                                  window=self.window()))
 
     @action(detail=True)
+    @conditional(patient_version)
     def cpts(self, request, pk=None):
-        return Response(tabs.cpts(self.get_object()))
+        return Response(cache.tab(self.get_object(), 'cpts',
+                                  window=self.window()))
 
     @action(detail=True)
+    @conditional(patient_version)
     def condition(self, request, pk=None):
         """Sends back all the ICD events for a given Phecode"""
         code = request.query_params.get('code')
         if not code:
             return Response({})
         patient = self.get_object()
-        return Response(tabs.condition(patient, code, 0.2))
+        return Response(cache.tab(patient, 'condition', code, 0.2,
+                                  window=self.window()))
+
+    @action(detail=True)
+    @conditional(patient_version)
+    def bundle(self, request, pk=None):
+        """
+        Sends back several tabs at once, keyed by name, all computed from a
+        single fetch of the patient's events.  `tabs` is a comma separated
+        list of the tabs wanted (default: all of them).  Like every tab, takes
+        the window parameters `start`, `end` and `resolution`, and `max_points`
+        and `method` as for the labs & vitals.
+        """
+        names = request.query_params.get('tabs')
+        names = names.split(',') if names else self.bundle_tabs
+        unknown = set(names) - set(self.bundle_tabs)
+        if unknown:
+            raise ValidationError(f'Unknown tabs: {", ".join(sorted(unknown))}')
+        patient = self.get_object()
+        # Only fetched if some tab isn't cached
+        timeline = PatientTimeline(patient, self.window())
+        # The chart series are downsampled as by their own endpoints
+        params = {name: () for name in names}
+        params.update(dict.fromkeys(('labs', 'vitals'), self.downsampling()))
+        return Response({name: cache.tab(patient, name, *params[name],
+                                         timeline=timeline)
+                         for name in names})
 
     @action(detail=True)
     def notes(self, request, pk=None):
@@ -143,12 +284,29 @@ class PatientViewSet(ReadOnlyModelViewSet):
         #     | Q(doc_type='HP', sub_type__icontains='braden')
         # )
         notes_base = patient.docs
-        notes = notes_base.filter(date=date)
-        for i in range(1, 4):
+        # Notes are stored unshifted, see Patient.date_offset
+        date_offset = timedelta(days=patient.date_offset)
+        date -= date_offset
+        # The notes of the date, or else of the nearest days around it with
+        # any, up to three days either side: all fetched at once, then
+        # narrowed down
+        reach = timedelta(days=3)
+        nearby = list(notes_base
+                      .filter(date__range=(date - reach, date + reach))
+                      .values('date', 'doc_type', 'sub_type'))
+        for days in range(reach.days + 1):
+            notes = [note for note in nearby
+                     if abs((note['date'] - date).days) <= days]
             if notes:
                 break
-            offset = timedelta(days=i)
-            date_range = (date - offset, date + offset)
-            notes = notes_base.filter(date__range=date_range)
-        notes = notes.values('date', 'doc_type', 'sub_type')
+        notes = [dict(note, date=note['date'] + date_offset)
+                 for note in notes]
         return Response({'notes': notes})
+
+
+@query_budget(2)
+@api_view(['GET'])
+@permission_classes((IsAdminUser,))
+def tab_cache_stats(request):
+    """How this process has served tab requests, see patients.cache"""
+    return Response(dict(cache.counters))
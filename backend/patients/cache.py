@@ -0,0 +1,129 @@
+"""
+Cache of computed tabs.  Entries are keyed by patient, tab, parameters,
+window, the patient's data_version, which the instance table triggers bump
+on every write, the TaxonomyVersion, bumped likewise by writes to the codes,
+and the time the lab percentiles were last written; so a cached tab is never
+served for a history (or code descriptions, or percentiles) that has since
+changed.  Stale entries are simply never read again and age
+out of the cache.
+
+Misses are single-flight: concurrent requests for the same entry wait for the
+first one's computation rather than repeating it.  Within a process that is
+always the case; with settings.TAB_CACHE_LOCK = 'advisory' requests in other
+processes wait too, on a postgres advisory lock, and then read the result
+from the (shared) cache.
+"""
+from collections import Counter
+from concurrent.futures import Future
+from hashlib import md5
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from . import tabs
+from .timeline import PatientTimeline, Window
+
+TAB_CACHE = 'tabs'
+
+# How each tab request was served: hit (from the cache), computed, coalesced
+# (waited on a computation in this process) or shared (waited on the lock for
+# one in another process).  Per process, since start up.
+counters = Counter()
+_counters_lock = Lock()
+
+
+def count(outcome):
+    with _counters_lock:
+        counters[outcome] += 1
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time in this process; callers arriving
+    while it runs get its result (or exception) instead of calling again
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Returns (func(), whether this call waited on another's)"""
+        with self._lock:
+            future = self._calls.get(key)
+            waiting = future is not None
+            if not waiting:
+                future = self._calls[key] = Future()
+        if waiting:
+            return future.result(), True
+        try:
+            result = func()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+flights = SingleFlight()
+
+
+def tab_key(patient, name, params, window):
+    percentiles = patient.percentiles()
+    return ':'.join(['tab', str(patient.pk), str(patient.data_version),
+                     str(patient.taxonomy()[0]),
+                     str(percentiles and percentiles.timestamp()),
+                     window.start.isoformat(), window.end.isoformat(),
+                     str(window.resolution), name,
+                     md5(repr(params).encode()).hexdigest()])
+
+
+def lock_id(key):
+    """A 64 bit advisory lock id for a cache key"""
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big', signed=True)
+
+
+def tab(patient, name, *params, timeline=None, window=None):
+    """
+    Returns tabs.<name>(patient, *params) over `window` (or the timeline's)
+    from the cache, computing and storing it on a miss (from `timeline` if
+    given)
+    """
+    cache = caches[TAB_CACHE]
+    window = timeline.window if timeline else window or Window.parse()
+    key = tab_key(patient, name, params, window)
+    result = cache.get(key)
+    if result is not None:
+        count('hit')
+        return result
+
+    def compute():
+        timeline_ = timeline or PatientTimeline(patient, window)
+        result = getattr(tabs, name)(patient, *params, timeline=timeline_)
+        cache.set(key, result)
+        return result
+
+    def compute_once():
+        if getattr(settings, 'TAB_CACHE_LOCK', None) != 'advisory':
+            return compute(), False
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)', [lock_id(key)])
+            try:
+                # Another process may have stored it while we waited
+                result = cache.get(key)
+                if result is not None:
+                    return result, True
+                return compute(), False
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s)',
+                               [lock_id(key)])
+
+    (result, shared), coalesced = flights.do(key, compute_once)
+    count('coalesced' if coalesced else 'shared' if shared else 'computed')
+    return result
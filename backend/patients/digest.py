@@ -0,0 +1,105 @@
+"""
+Mergeable quantile sketches (t-digests) of lab values.
+
+A digest summarises any number of values as a few hundred weighted centroids,
+small near the extremes and larger in the middle, so tail quantiles stay
+accurate.  Digests of separate batches merge into the digest of their union,
+which lets each batch of lab results be folded into the stored digests
+without revisiting earlier values, and a backfill build its digests in
+parallel.
+
+Compression here is done in one pass over the sorted centroids: each is
+assigned to the cluster its cumulative weight falls in on the k1 scale
+(k = delta / 2pi * asin(2q - 1), with clusters one unit of k wide) and the
+clusters are summed with reduceat, rather than growing clusters one centroid
+at a time.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from .timeline import group_starts, spans
+
+# The compression: a digest has at most about DELTA / 2 centroids
+DELTA = 200
+
+
+class Digest(namedtuple('Digest', ('means', 'weights', 'low', 'high'))):
+    """Centroid means (ascending) & weights, and the extreme values"""
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, values):
+        """The digest of an array of finite values"""
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        if not len(values):
+            return cls.empty()
+        return cls(*compress(values, np.ones(len(values))),
+                   values[0], values[-1])
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0), np.nan, np.nan)
+
+    @classmethod
+    def merge(cls, digests):
+        digests = [d for d in digests if d.count]
+        if not digests:
+            return cls.empty()
+        means = np.concatenate([d.means for d in digests])
+        weights = np.concatenate([d.weights for d in digests])
+        order = np.argsort(means, kind='mergesort')
+        return cls(*compress(means[order], weights[order]),
+                   min(d.low for d in digests),
+                   max(d.high for d in digests))
+
+    @property
+    def count(self):
+        return int(self.weights.sum())
+
+    def quantiles(self, qs):
+        """The estimated values at each of the quantiles `qs` (NaN if empty)"""
+        if not self.count:
+            return np.full(len(qs), np.nan)
+        # Each centroid's weight is spread evenly around its mean, and the
+        # extremes are pinned to the ends
+        total = self.weights.sum()
+        centres = np.cumsum(self.weights) - self.weights / 2
+        return np.interp(np.asarray(qs) * total,
+                         np.concatenate(([0], centres, [total])),
+                         np.concatenate(([self.low], self.means,
+                                         [self.high])))
+
+
+def compress(means, weights, delta=DELTA):
+    """Merges sorted centroids into at most about delta / 2 clusters"""
+    total = weights.sum()
+    before = (np.cumsum(weights) - weights) / total
+    k = np.floor(delta / (2 * np.pi) * np.arcsin(2 * before - 1))
+    starts = group_starts(k)
+    sums = np.add.reduceat(weights, starts)
+    return np.add.reduceat(means * weights, starts) / sums, sums
+
+
+def by_code(codes, values):
+    """
+    {code: Digest} of the finite `values` grouped by the matching integer
+    `codes`
+    """
+    codes = np.asarray(codes)
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    codes, values = codes[finite], values[finite]
+    order = np.lexsort((values, codes))
+    codes, values = codes[order], values[order]
+    return {codes[begin].item(): Digest.of(values[begin:stop])
+            for begin, stop in spans(group_starts(codes), len(codes))}
+
+
+def merge_by_code(*batches):
+    """Merges several {code: Digest} into one"""
+    merged = {}
+    for batch in batches:
+        for code, digest in batch.items():
+            merged.setdefault(code, []).append(digest)
+    return {code: Digest.merge(digests) for code, digests in merged.items()}
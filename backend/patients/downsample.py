@@ -0,0 +1,106 @@
+"""
+Shape preserving downsampling of time series (labs & vitals) for charting.
+
+Both methods split the series into buckets and keep the first and last points
+plus a few points per bucket:
+
+* minmax: each bucket's lowest and highest point, with buckets of equal width
+  in time, so every peak & trough (in particular every out of normal range
+  extreme) survives;
+* lttb: one point per bucket, the one forming the largest triangle with its
+  neighbouring buckets (Largest Triangle Three Buckets).  Here the neighbours
+  are the buckets' averages on both sides, which lets every bucket be chosen
+  at once rather than one after another.  A bucket with out of normal range
+  points keeps the most abnormal of them instead.
+
+Points without a (finite) value are always kept, as they aren't part of the
+plotted line.
+"""
+import numpy as np
+
+METHODS = ('minmax', 'lttb')
+
+
+def downsample(x, y, max_points, method='minmax', low=None, high=None):
+    """
+    Returns the sorted indices of at most `max_points` points of the series
+    (plus any with no value), `x` being ascending floats.  `low` and `high`
+    optionally give each point's normal range (NaN for no bound).
+    """
+    if len(x) <= max_points:
+        return np.arange(len(x))
+    finite = np.isfinite(y)
+    kept = np.flatnonzero(finite)
+    if len(kept) > max_points:
+        if method == 'lttb':
+            severity = None
+            if low is not None and high is not None:
+                severity = abnormality(y[kept], low[kept], high[kept])
+            chosen = lttb(x[kept], y[kept], max_points, severity)
+        else:
+            chosen = minmax(x[kept], y[kept], max_points)
+        kept = kept[chosen]
+    return np.union1d(kept, np.flatnonzero(~finite))
+
+
+def days(values):
+    """datetime64 array -> float days since the epoch, for use as `x`"""
+    return values.astype('datetime64[s]').astype(np.int64) / 86400
+
+
+def abnormality(y, low, high):
+    """How far each value is outside its normal range (0 if inside)"""
+    with np.errstate(invalid='ignore'):
+        below = np.nan_to_num(low - y)
+        above = np.nan_to_num(y - high)
+    return np.maximum(np.maximum(below, above), 0)
+
+
+def segments(starts, n):
+    """The segment number of each of `n` elements, given segment starts"""
+    return np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+
+
+def minmax(x, y, max_points):
+    n = len(x)
+    buckets = max((max_points - 2) // 2, 1)
+    edges = np.linspace(x[0], x[-1], buckets + 1)[1:-1]
+    starts = np.unique(np.append(0, np.searchsorted(x, edges)))
+    starts = starts[starts < n]
+    # Sorting by bucket then value puts each bucket's min first & max last
+    order = np.lexsort((y, segments(starts, n)))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate(([0, n - 1], order[starts], order[ends])))
+
+
+def lttb(x, y, max_points, severity=None):
+    n = len(x)
+    buckets = max(max_points - 2, 1)
+    # Equal count buckets over the points between the first and last
+    starts = np.unique(np.linspace(1, n - 1, buckets + 1).astype(int)[:-1])
+    counts = np.diff(np.append(starts, n - 1))
+    avg_x = np.add.reduceat(x[:n - 1], starts) / counts
+    avg_y = np.add.reduceat(y[:n - 1], starts) / counts
+    # Each bucket's neighbours: the averages of the buckets either side (or
+    # the first & last points at the ends)
+    ax = np.append(x[0], avg_x[:-1])
+    ay = np.append(y[0], avg_y[:-1])
+    bx = np.append(avg_x[1:], x[-1])
+    by = np.append(avg_y[1:], y[-1])
+
+    seg = segments(starts - 1, n - 2)
+    px, py = x[1:n - 1], y[1:n - 1]
+    area = np.abs((ax[seg] - px) * (by[seg] - ay[seg])
+                  - (ax[seg] - bx[seg]) * (py - ay[seg]))
+    chosen = segment_argmax(area, seg, starts - 1, n - 2)
+    if severity is not None:
+        inner = severity[1:n - 1]
+        worst = segment_argmax(inner, seg, starts - 1, n - 2)
+        chosen = np.where(inner[worst] > 0, worst, chosen)
+    return np.concatenate(([0], chosen + 1, [n - 1]))
+
+
+def segment_argmax(values, seg, starts, n):
+    """The index of the largest of `values` in each segment"""
+    order = np.lexsort((values, seg))
+    return order[np.append(starts[1:], n) - 1]
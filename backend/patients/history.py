@@ -0,0 +1,91 @@
+"""
+Scheduling for rebuilds of the patient history stats.
+
+Rebuilds (see HistoryStats.rebuild) refresh the v_patient_history_stats view
+concurrently and apply the differences to the stats table, so readers are
+never blocked.  Requests are debounced and coalesced: across all processes at
+most one rebuild runs at a time, any number of requests made while it runs
+collapse into a single pending rebuild that starts when it finishes, and with
+a debounce that rebuild waits for a lull in the requests (e.g. the end of an
+ingest) first.
+"""
+from datetime import timedelta
+from time import sleep
+
+from django.db import connection
+from django.utils.timezone import now
+
+from .models import HistoryStats, HistoryStatsRefresh
+
+# Key for the postgres advisory lock held by whichever process is rebuilding
+REFRESH_LOCK = 0x6869_7374
+
+
+def _state():
+    state, _ = HistoryStatsRefresh.objects.get_or_create(pk=1)
+    return state
+
+
+def request():
+    """Records that the stats are out of date and need a rebuild"""
+    _state()
+    HistoryStatsRefresh.objects.filter(pk=1).update(requested_at=now())
+
+
+def staleness():
+    """
+    Returns a dict describing how current the history stats are: the times of
+    the latest request, start and finish, whether a request is still waiting
+    on a rebuild, and the age of the last finished rebuild (a timedelta, or
+    None if there has never been one).
+    """
+    state = _state()
+    pending = (state.requested_at is not None
+               and (state.started_at is None
+                    or state.requested_at > state.started_at))
+    age = now() - state.finished_at if state.finished_at else None
+    return {
+        'requested_at': state.requested_at,
+        'started_at': state.started_at,
+        'finished_at': state.finished_at,
+        'pending': pending,
+        'age': age,
+    }
+
+
+def settle(debounce):
+    """Waits until no request has been made for `debounce` seconds"""
+    quiet = timedelta(seconds=debounce)
+    while True:
+        requested_at = _state().requested_at
+        if requested_at is None or now() - requested_at >= quiet:
+            return
+        sleep((quiet - (now() - requested_at)).total_seconds())
+
+
+def refresh(debounce=0):
+    """
+    Rebuilds the stats until no requests are pending, each rebuild waiting
+    until no request has been made for `debounce` seconds.  If another
+    process is already rebuilding, returns False immediately: it will see any
+    request recorded before this call and run again to cover it.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [REFRESH_LOCK])
+        if not cursor.fetchone()[0]:
+            return False
+        try:
+            while True:
+                settle(debounce)
+                started = now()
+                HistoryStatsRefresh.objects.filter(pk=1).update(
+                    started_at=started
+                )
+                HistoryStats.rebuild()
+                HistoryStatsRefresh.objects.filter(pk=1).update(
+                    finished_at=now()
+                )
+                if not staleness()['pending']:
+                    return True
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [REFRESH_LOCK])
@@ -0,0 +1,83 @@
+"""
+Compute the stored problem lists (see patients.problems) of the patients
+whose entries are out of date (the grid has moved on, or their ICDs have
+changed), of every patient with --full, or of the given ones, in parallel.
+Only out of date entries are recomputed unless --full.  Until it has run,
+overviews compute the out of date patients' lists from their histories, so
+run it after loading patients and daily, as the grid moves on.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from patients import problems
+from patients.models import Patient
+
+
+def refresh_patients(ids, full):
+    """Refreshes a chunk of patients in a worker process"""
+    try:
+        return sum(problems.refresh(patient, full)
+                   for patient in Patient.objects.filter(pk__in=ids))
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'patients',
+            nargs='*',
+            type=int,
+            help='Patient ids to backfill (default: those out of date)'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Recompute every entry of every patient (or the given '
+                 'ones), not just the out of date ones'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of worker processes'
+        )
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=100,
+            help='Number of patients handed to a worker at a time'
+        )
+
+    def handle(self, *args, **options):
+        if options['patients']:
+            ids = options['patients']
+        elif options['full']:
+            ids = list(Patient.objects.order_by('pk')
+                       .values_list('pk', flat=True))
+        else:
+            ids = problems.outdated()
+        chunks = [ids[i:i + options['chunk']]
+                  for i in range(0, len(ids), options['chunk'])]
+        # The workers are forked; each must open its own connection
+        connection.close()
+        t0 = perf_counter()
+        phecodes = 0
+        with ProcessPoolExecutor(options['jobs']) as pool:
+            results = pool.map(refresh_patients, chunks,
+                               repeat(options['full']))
+            for done, n in enumerate(results, 1):
+                phecodes += n
+                self.stdout.write(f'{min(done * options["chunk"], len(ids))}'
+                                  f'/{len(ids)} patients')
+        self.stdout.write(self.style.SUCCESS(
+            f'Recomputed {phecodes} phecodes for {len(ids)} patients '
+            f'in {perf_counter() - t0:.1f}s'
+        ))
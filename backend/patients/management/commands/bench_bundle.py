@@ -0,0 +1,53 @@
+"""
+Compare computing every tab through its own endpoint (each fetching its own
+events) with computing them all from one shared fetch, as the bundle endpoint
+does.  Reports queries, DB time and wall time per patient.
+"""
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from patients import tabs
+from patients.api import PatientViewSet
+from patients.timeline import PatientTimeline
+from patients.models import Patient
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'patients',
+            nargs='*',
+            type=int,
+            help='Patient ids to benchmark (default: every sample patient)'
+        )
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.filter(is_sample=True)
+        if options['patients']:
+            patients = Patient.objects.filter(pk__in=options['patients'])
+        names = PatientViewSet.bundle_tabs
+        self.stdout.write(f'{"patient":>10} {"mode":>10} {"queries":>8} '
+                          f'{"db (ms)":>9} {"wall (ms)":>10}')
+        for patient in patients:
+            self.report(patient, 'separate', lambda: [
+                getattr(tabs, name)(patient) for name in names
+            ])
+            timeline = PatientTimeline(patient)
+            self.report(patient, 'bundle', lambda: [
+                getattr(tabs, name)(patient, timeline=timeline) for name in names
+            ])
+
+    def report(self, patient, mode, func):
+        with CaptureQueriesContext(connection) as ctx:
+            t0 = perf_counter()
+            func()
+            wall = perf_counter() - t0
+        db = sum(float(q['time']) for q in ctx.captured_queries)
+        self.stdout.write(f'{patient.id:>10} {mode:>10} '
+                          f'{len(ctx.captured_queries):>8} {db * 1e3:>9.1f} '
+                          f'{wall * 1e3:>10.1f}')
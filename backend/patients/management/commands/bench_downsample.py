@@ -0,0 +1,65 @@
+"""
+Measure the labs & vitals tabs of the patients with the most lab and vital
+sign rows, whole and downsampled: time to fetch, compute and render the JSON,
+and its size.
+"""
+from collections import Counter
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from rest_framework.renderers import JSONRenderer
+
+from patients import tabs
+from patients.downsample import METHODS
+from patients.models import BloodPressure, HeartRate, LabInstance, Patient
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=5,
+            help='Number of patients to benchmark (most rows first)'
+        )
+        parser.add_argument(
+            '--max-points',
+            type=int,
+            nargs='+',
+            default=[200, 1000],
+            help='max_points values to compare with the whole series'
+        )
+
+    def handle(self, *args, **options):
+        rows = Counter()
+        for model in (LabInstance, HeartRate, BloodPressure):
+            rows.update(dict(model.objects
+                             .values_list('patient')
+                             .annotate(n=Count('id'))
+                             .order_by()))
+        top = dict(rows.most_common(options['patients']))
+        patients = Patient.objects.in_bulk(top).values()
+        renderer = JSONRenderer()
+        self.stdout.write(f'{"patient":>10} {"rows":>8} {"tab":>7} '
+                          f'{"max_points":>10} {"method":>7} {"bytes":>10} '
+                          f'{"total (ms)":>11}')
+        for patient in patients:
+            runs = [(None, METHODS[0])]
+            runs += [(n, method) for n in options['max_points']
+                     for method in METHODS]
+            for name in ('labs', 'vitals'):
+                for max_points, method in runs:
+                    # A fresh fetch each time, as for an uncached request
+                    t0 = perf_counter()
+                    data = getattr(tabs, name)(patient, max_points, method)
+                    payload = renderer.render(data)
+                    total = perf_counter() - t0
+                    self.stdout.write(
+                        f'{patient.id:>10} {top[patient.id]:>8} {name:>7} '
+                        f'{max_points or "-":>10} '
+                        f'{method if max_points else "-":>7} '
+                        f'{len(payload):>10} {total * 1e3:>11.1f}'
+                    )
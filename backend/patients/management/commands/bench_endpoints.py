@@ -0,0 +1,262 @@
+"""
+Benchmark every PatientViewSet action and every tab function for a small, a
+median and the heaviest patient (by number of events): wall time (median and
+95th percentile over --repeat runs), queries and DB time.  The actions are
+run through the view, rendered as JSON, with the tab cache disabled (unless
+--warm) so each request computes its tabs.
+
+The results are saved as JSON named for the current commit under --output;
+--compare reports the change from an earlier results file.  Run it against a
+cohort from generate_cohort for production-like sizes.
+"""
+import json
+import os
+import subprocess
+from collections import Counter
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from patients import tabs
+from patients.api import PatientViewSet
+from patients.cache import TAB_CACHE
+from patients.models import (Patient, ICDInstance, LabInstance, CPTInstance,
+                             ClinicalNote, Medication, HeartRate, BMI,
+                             BloodPressure)
+
+# The tables counted towards a patient's size
+EVENT_MODELS = (ICDInstance, LabInstance, CPTInstance, ClinicalNote,
+                Medication, HeartRate, BMI, BloodPressure)
+
+# Each benchmarked patient, by quantile of size
+SIZES = (('small', 0.10), ('median', 0.50), ('heavy', 1.00))
+
+# The per-patient actions; the list is benchmarked too, with a search
+ACTIONS = ('retrieve', 'code_search', 'overview', 'systems', 'labs', 'meds',
+           'vitals', 'cpts', 'condition', 'bundle', 'notes')
+
+TABS = ('overview', 'systems', 'labs', 'meds', 'vitals', 'cpts', 'condition')
+
+
+def sizes():
+    """{patient id: number of events} of every patient with any"""
+    events = Counter()
+    for model in EVENT_MODELS:
+        events.update(dict(model.objects
+                           .values_list('patient')
+                           .annotate(n=Count('id'))
+                           .order_by()))
+    return events
+
+
+def pick_patients(events):
+    """[(size name, patient, events)] of the patients benchmarked"""
+    ranked = sorted(events, key=events.get)
+    picked = []
+    for name, q in SIZES:
+        pk = ranked[int(q * (len(ranked) - 1))]
+        picked.append((name, Patient.objects.get(pk=pk), events[pk]))
+    return picked
+
+
+def top_phecode(patient):
+    """The id of the phecode the patient is most often coded with"""
+    top = (ICDInstance.objects
+           .filter(patient=patient, code__phecode__isnull=False)
+           .values_list('code__phecode')
+           .annotate(n=Count('id'))
+           .order_by('-n')
+           .first())
+    return top and top[0]
+
+
+def query_params(patient):
+    """{action: query parameters} for a realistic request of each action"""
+    phecode = top_phecode(patient)
+    icd = (ICDInstance.objects.filter(patient=patient)
+           .values_list('code__code', flat=True).first())
+    note = (patient.docs.order_by('-date')
+            .values_list('date', flat=True).first())
+    params = {action: {} for action in ACTIONS}
+    params['list'] = {'search': patient.last_name}
+    params['code_search'] = {'term': (icd or 'E1')[:2]}
+    params['condition'] = {'code': phecode or 0}
+    if note:
+        shown = note + timedelta(days=patient.date_offset)
+        params['notes'] = {'date': shown.isoformat()}
+    return params
+
+
+def measure(func, repeat):
+    """Runs `func` `repeat` times; its timings, queries & last result"""
+    walls, dbs, queries = [], [], []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as ctx:
+            t0 = perf_counter()
+            result = func()
+            walls.append(perf_counter() - t0)
+        queries.append(len(ctx.captured_queries))
+        dbs.append(sum(float(q['time']) for q in ctx.captured_queries))
+    return {
+        'wall_ms': np.median(walls) * 1e3,
+        'p95_ms': np.percentile(walls, 95) * 1e3,
+        'db_ms': np.median(dbs) * 1e3,
+        'queries': max(queries),
+    }, result
+
+
+def git_revision():
+    """(commit, whether the tree has uncommitted changes), if in git"""
+    def git(*args):
+        return subprocess.run(('git',) + args, cwd=settings.BASE_DIR,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    try:
+        return git('rev-parse', 'HEAD') or 'unknown', bool(
+            git('status', '--porcelain', '--untracked-files=no'))
+    except OSError:
+        return 'unknown', False
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Number of timed runs of each action & tab'
+        )
+        parser.add_argument(
+            '--warm',
+            action='store_true',
+            help='Keep the tab cache, so repeated requests are served from it'
+        )
+        parser.add_argument(
+            '--output',
+            default=os.path.join(settings.BASE_DIR, 'bench_results'),
+            help='Directory the results are saved in'
+        )
+        parser.add_argument(
+            '--compare',
+            metavar='FILE',
+            help='Earlier results to report the changes from'
+        )
+
+    def handle(self, *args, **options):
+        events = sizes()
+        if not events:
+            raise CommandError('No patients with events; run '
+                               'generate_cohort or load_patient_samples')
+        results = {}
+        patients = {}
+        caches = dict(settings.CACHES)
+        if not options['warm']:
+            caches[TAB_CACHE] = {
+                'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+        with override_settings(CACHES=caches):
+            for size, patient, n in pick_patients(events):
+                patients[size] = {'id': patient.pk, 'events': n}
+                self.stdout.write(f'{size}: patient {patient.pk}, '
+                                  f'{n} events')
+                params = query_params(patient)
+                for action in ('list',) + ACTIONS:
+                    results[f'{size}/api.{action}'] = self.bench_action(
+                        patient, action, params[action], options['repeat'])
+                for name in TABS:
+                    extra = ((params['condition']['code'],)
+                             if name == 'condition' else ())
+                    results[f'{size}/tabs.{name}'], _ = measure(
+                        lambda: getattr(tabs, name)(patient, *extra),
+                        options['repeat'])
+
+        self.report(results)
+        commit, dirty = git_revision()
+        saved = {
+            'commit': commit,
+            'dirty': dirty,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'repeat': options['repeat'],
+            'warm': options['warm'],
+            'patients': patients,
+            'results': results,
+        }
+        os.makedirs(options['output'], exist_ok=True)
+        path = os.path.join(options['output'],
+                            f'{commit[:12]}{"-dirty" if dirty else ""}.json')
+        with open(path, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f'Saved {path}'))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), saved)
+
+    def bench_action(self, patient, action, params, repeat):
+        """Times the `action` of the view, rendered, as one request would"""
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        user = User(username='bench', is_staff=True)
+        if action == 'list':
+            view = PatientViewSet.as_view({'get': 'list'})
+            path, kwargs = reverse('patient-list'), {}
+        else:
+            view = PatientViewSet.as_view({'get': action})
+            url_name = 'detail' if action == 'retrieve' else action
+            path = reverse(f'patient-{url_name.replace("_", "-")}',
+                           args=[patient.pk])
+            kwargs = {'pk': patient.pk}
+
+        def request():
+            request = factory.get(path, params)
+            force_authenticate(request, user=user)
+            response = view(request, **kwargs)
+            response.render()
+            if response.status_code != 200:
+                raise CommandError(f'{action} for patient {patient.pk}: '
+                                   f'{response.status_code}')
+            return response
+
+        stats, response = measure(request, repeat)
+        stats['bytes'] = len(response.content)
+        return stats
+
+    def report(self, results):
+        self.stdout.write(f'{"":<24}{"wall (ms)":>10}{"p95 (ms)":>10}'
+                          f'{"db (ms)":>9}{"queries":>8}{"bytes":>10}')
+        for key, stats in results.items():
+            self.stdout.write(
+                f'{key:<24}{stats["wall_ms"]:>10.1f}{stats["p95_ms"]:>10.1f}'
+                f'{stats["db_ms"]:>9.1f}{stats["queries"]:>8}'
+                f'{stats.get("bytes", ""):>10}'
+            )
+
+    def compare(self, before, after):
+        """Reports the change in wall time & queries of each result"""
+        self.stdout.write(f'Compared with {before["commit"][:12]} '
+                          f'({before["date"]}):')
+        for size in after['patients']:
+            if before['patients'].get(size) != after['patients'][size]:
+                self.stdout.write(self.style.WARNING(
+                    f'  The {size} patient differs; compare with care'))
+        self.stdout.write(f'{"":<24}{"wall":>9}{"queries":>10}')
+        for key, stats in after['results'].items():
+            old = before['results'].get(key)
+            if not old:
+                continue
+            change = stats['wall_ms'] / old['wall_ms'] - 1
+            queries = stats['queries'] - old['queries']
+            line = f'{key:<24}{change:>+9.0%}{queries:>+10}'
+            if queries > 0 or change > 0.2:
+                line = self.style.WARNING(line)
+            self.stdout.write(line)
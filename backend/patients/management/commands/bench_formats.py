@@ -0,0 +1,59 @@
+"""
+Compare the plain JSON rendering of each tab with the compact renderings.
+Reports payload size (raw and gzipped) and render time per patient and tab.
+"""
+import gzip
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from patients import tabs
+from patients.api import PatientViewSet
+from patients.models import Patient
+from patients.renderers import compact_renderers
+from patients.timeline import PatientTimeline
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'patients',
+            nargs='*',
+            type=int,
+            help='Patient ids to benchmark (default: every sample patient)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Render repetitions per tab; the best run is reported'
+        )
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.filter(is_sample=True)
+        if options['patients']:
+            patients = Patient.objects.filter(pk__in=options['patients'])
+        renderers = [JSONRenderer(), *(cls() for cls in compact_renderers)]
+        self.stdout.write(f'{"patient":>10} {"tab":>9} {"format":>8} '
+                          f'{"bytes":>10} {"gzipped":>9} {"render (ms)":>12}')
+        for patient in patients:
+            timeline = PatientTimeline(patient)
+            for name in PatientViewSet.bundle_tabs:
+                data = getattr(tabs, name)(patient, timeline=timeline)
+                for renderer in renderers:
+                    self.report(patient, name, renderer, data,
+                                options['repeat'])
+
+    def report(self, patient, name, renderer, data, repeat):
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = perf_counter()
+            payload = renderer.render(data)
+            best = min(best, perf_counter() - t0)
+        self.stdout.write(f'{patient.id:>10} {name:>9} {renderer.format:>8} '
+                          f'{len(payload):>10} '
+                          f'{len(gzip.compress(payload)):>9} '
+                          f'{best * 1e3:>12.2f}')
@@ -0,0 +1,82 @@
+"""
+Benchmark per-phecode intensity inference against the batched engine on the
+patients with the most distinct phecodes in their history.  The kernel column
+times the fast_intensity calls alone, on events already split by phecode: the
+least any engine built on fast_intensity.infer_intensity (one 1D call per
+phecode) could take.
+"""
+from itertools import groupby
+from operator import itemgetter
+from time import perf_counter
+
+import fast_intensity
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from patients.models import Patient
+from patients.timeline import Window
+from patients.util import infer_intensity, infer_intensities, to_days
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=10,
+            help='Number of patients to benchmark (most phecodes first)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Timing repetitions per patient; the best run is reported'
+        )
+
+    def handle(self, *args, **options):
+        patients = (Patient.objects
+                    .filter(icdinstance__code__phecode__isnull=False)
+                    .annotate(n=Count('icdinstance__code__phecode',
+                                      distinct=True))
+                    .order_by('-n')[:options['patients']])
+        self.stdout.write(f'{"patient":>10} {"phecodes":>9} {"events":>8} '
+                          f'{"single (ms)":>12} {"batched (ms)":>13} '
+                          f'{"kernel (ms)":>12} {"speedup":>8}')
+        grid_days = Window.parse().grid_days
+        for patient in patients:
+            evts = list(patient.icdinstance_set
+                        .filter(code__phecode__isnull=False)
+                        .values_list('code__phecode', 'date')
+                        .order_by('code__phecode', 'date')
+                        .distinct())
+            groups = [(_id, {d for _, d in g})
+                      for _id, g in groupby(evts, key=itemgetter(0))]
+            single = self.best_of(options['repeat'], lambda: [
+                infer_intensity(dates) for _, dates in groups
+            ])
+            batched = self.best_of(options['repeat'], lambda: (
+                infer_intensities(to_days(d for _, d in evts),
+                                  [_id for _id, _ in evts])
+            ))
+            split = [np.sort(to_days(dates)) for _, dates in groups]
+            kernel = self.best_of(options['repeat'], lambda: [
+                fast_intensity.infer_intensity(days, grid_days)
+                for days in split
+            ])
+            self.stdout.write(f'{patient.id:>10} {len(groups):>9} '
+                              f'{len(evts):>8} {single * 1e3:>12.2f} '
+                              f'{batched * 1e3:>13.2f} '
+                              f'{kernel * 1e3:>12.2f} '
+                              f'{single / batched:>7.1f}x')
+
+    @staticmethod
+    def best_of(repeat, func):
+        times = []
+        for _ in range(repeat):
+            t0 = perf_counter()
+            func()
+            times.append(perf_counter() - t0)
+        return np.min(times)
@@ -0,0 +1,75 @@
+"""
+Rebuild the lab percentiles (see LabPercentiles) from every lab result.  The
+results are split into ranges of ids, each digested in a worker process, and
+the digests merged.  Only needed after results are deleted or changed;
+loaders merge in the digests of the results they add.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from patients.digest import by_code, merge_by_code
+from patients.models import LabInstance, LabPercentiles
+
+
+def digest_range(first, last):
+    """{lab id: Digest} of the results with ids in [first, last)"""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT code_id, value '
+                           f'FROM {LabInstance._meta.db_table} '
+                           f'WHERE id >= %s AND id < %s '
+                           f'AND value IS NOT NULL', [first, last])
+            rows = cursor.fetchall()
+        codes = np.array([r[0] for r in rows], dtype=np.int64)
+        values = np.array([r[1] for r in rows], dtype=np.float64)
+        return by_code(codes, values)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of worker processes'
+        )
+        parser.add_argument(
+            '--chunk',
+            type=int,
+            default=1000000,
+            help='Number of result ids handed to a worker at a time'
+        )
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT MIN(id), MAX(id) '
+                           f'FROM {LabInstance._meta.db_table}')
+            low, high = cursor.fetchone()
+        starts = (list(range(low, high + 1, options['chunk']))
+                  if low is not None else [])
+        stops = [start + options['chunk'] for start in starts]
+
+        # The workers are forked; each must open its own connection
+        connection.close()
+        t0 = perf_counter()
+        digests = {}
+        with ProcessPoolExecutor(options['jobs']) as pool:
+            for done, batch in enumerate(
+                    pool.map(digest_range, starts, stops), 1):
+                digests = merge_by_code(digests, batch)
+                self.stdout.write(f'{done}/{len(starts)} ranges')
+        LabPercentiles.rebuild(digests)
+        count = sum(digest.count for digest in digests.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Digested {count} results of {len(digests)} labs '
+            f'in {perf_counter() - t0:.1f}s'
+        ))
@@ -0,0 +1,128 @@
+"""
+Check the API views against their query budgets (see chartviz.queries).
+Every action of the patient & ICD viewsets and the account views is
+requested through the URLconf for a small, a median and the heaviest patient
+(or the given ones), as a logged in staff user with the tab cache disabled.
+A request fails the check if it makes more queries than its view's budget or
+repeats a statement; any failure is an error, so the check can gate local
+test runs.
+
+The requests run as they would in production, outside any transaction (a
+transaction around them would add savepoints to their counts); the user the
+check logs in as is deleted afterwards.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import resolve, reverse
+
+from chartviz.queries import QueryLog, budget_for
+from patients.cache import TAB_CACHE
+from patients.models import Patient
+from taxonomies.models import ICD
+from .bench_endpoints import (ACTIONS, pick_patients, query_params, sizes,
+                              top_phecode)
+
+
+def requests(patient):
+    """(method, path, data) of each request made for `patient`"""
+    params = query_params(patient)
+    made = [('get', reverse('patient-list'), params['list'])]
+    for action in ACTIONS:
+        name = 'detail' if action == 'retrieve' else action
+        made.append(('get', reverse(f'patient-{name.replace("_", "-")}',
+                                    args=[patient.pk]), params[action]))
+    tabs = f'/api/v1/tabs/{patient.pk}/'
+    phecode = top_phecode(patient)
+    made.append(('get', tabs, {}))
+    if phecode:
+        made.append(('post', tabs, {'condition_id': phecode}))
+        made.append(('delete', f'{tabs}{phecode}/', ''))
+    return made
+
+
+def shared_requests():
+    """(method, path, data) of the requests not about a patient"""
+    made = [
+        ('get', reverse('icd-list'), {}),
+        ('get', '/api/v1/users/me/', {}),
+        ('get', '/api/v1/tab-cache/', {}),
+    ]
+    icd = ICD.objects.filter(phecode__isnull=False).first()
+    if icd:
+        made.append(('get', reverse('icd-detail', args=[icd.pk]), {}))
+    return made
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'patients',
+            nargs='*',
+            type=int,
+            help='Patient ids to check (default: a small, a median and the '
+                 'heaviest patient)'
+        )
+
+    def handle(self, *args, **options):
+        if options['patients']:
+            patients = list(Patient.objects.filter(pk__in=options['patients']))
+        else:
+            events = sizes()
+            patients = ([patient for _, patient, _ in pick_patients(events)]
+                        if events else [])
+        if not patients:
+            raise CommandError('No patients to check')
+
+        # The middleware would enforce the budgets itself; it is left out,
+        # and the requests counted here instead
+        caches = dict(settings.CACHES)
+        caches[TAB_CACHE] = {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+        self.failures = 0
+        self.unbudgeted = set()
+        with override_settings(CACHES=caches, QUERY_BUDGETS='off'):
+            user = User.objects.create(username='query-budget-check',
+                                       is_staff=True)
+            client = Client(HTTP_HOST='localhost')
+            client.force_login(user)
+            try:
+                for request in shared_requests():
+                    self.check_request(client, *request)
+                for patient in patients:
+                    self.stdout.write(f'Patient {patient.pk}')
+                    for request in requests(patient):
+                        self.check_request(client, *request)
+            finally:
+                client.logout()
+                user.delete()
+
+        for view in sorted(self.unbudgeted):
+            self.stdout.write(self.style.WARNING(f'No budget for {view}'))
+        if self.failures:
+            raise CommandError(f'{self.failures} requests failed the check')
+        self.stdout.write(self.style.SUCCESS('All requests within budget'))
+
+    def check_request(self, client, method, path, data):
+        match = resolve(path)
+        budget = budget_for(match.func, method)
+        if budget is None:
+            self.unbudgeted.add(f'{method.upper()} {match.view_name}')
+        with QueryLog() as log:
+            response = getattr(client, method)(path, data)
+        problems = log.problems(budget)
+        if response.status_code >= 400:
+            problems.append(f'status {response.status_code}')
+        line = (f'  {method.upper():<7}{path:<48}{len(log):>5} '
+                f'/ {budget if budget is not None else "-"}')
+        if problems:
+            self.failures += 1
+            self.stdout.write(self.style.ERROR(line))
+            for problem in problems:
+                self.stdout.write(f'    {problem}')
+        else:
+            self.stdout.write(line)
@@ -0,0 +1,176 @@
+"""
+Check that every per-patient query the tabs, code search and notes make is
+served from the index meant for it.  The queries are captured while computing
+each tab for the given patients (by default a few sample patients), then
+EXPLAINed.  The check fails on any sequential scan of a per-patient table,
+and on any read of a table of events other than through its composite
+(patient, date) index with the date range in the index condition (rather
+than filtered row by row).
+
+By default sequential scans are priced out of the planner (enable_seqscan =
+off), so a scan that remains has no usable index whatever the table sizes,
+and the check holds on small seeded databases.  With --planner-costs the
+plans are the ones the planner actually picks for the current data.
+"""
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from patients import problems, tabs
+from patients.models import (Patient, HistoryStats, ProblemListEntry,
+                             ICDInstance, LabInstance, CPTInstance,
+                             ClinicalNote, Medication, HeartRate, BMI,
+                             BloodPressure)
+from patients.timeline import PatientTimeline
+from .dateshift_patients import DATE_COLUMNS
+
+# The tables holding rows of every patient
+CHECKED = {model._meta.db_table for model in (
+    HistoryStats, ProblemListEntry, ICDInstance, LabInstance, CPTInstance,
+    ClinicalNote, Medication, HeartRate, BMI, BloodPressure,
+)}
+
+# {table: (its composite index, the date column)} of the tables of events
+DATE_INDEXES = {
+    model._meta.db_table: (model._meta.indexes[0].name, column)
+    for model, column, _ in DATE_COLUMNS
+}
+
+# The tabs checked, each computed from its own timeline
+TABS = ('overview', 'systems', 'labs', 'meds', 'vitals', 'cpts')
+
+# Code search terms taking the prefix and the trigram paths
+SEARCH_TERMS = ('E1', 'diabetes')
+
+
+def seq_scans(plan):
+    """The checked tables sequentially scanned anywhere in `plan`"""
+    found = []
+    if (plan.get('Node Type') == 'Seq Scan'
+            and plan.get('Relation Name') in CHECKED):
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        found += seq_scans(child)
+    return found
+
+
+def index_scans(plan):
+    """The index scan nodes of a scan node, under a bitmap scan's included"""
+    if 'Index Name' in plan:
+        yield plan
+    for child in plan.get('Plans', ()):
+        if child.get('Node Type') in ('Bitmap Index Scan', 'BitmapAnd',
+                                      'BitmapOr'):
+            yield from index_scans(child)
+
+
+def index_misses(plan):
+    """
+    How the tables of events are read anywhere in `plan` other than by a
+    range of their composite index
+    """
+    found = []
+    table = plan.get('Relation Name')
+    if table in DATE_INDEXES and plan.get('Node Type') != 'Seq Scan':
+        index, column = DATE_INDEXES[table]
+        # The column, not a ::date cast
+        mentioned = re.compile(rf'(?<![:\w]){column}\b').search
+        for scan in index_scans(plan):
+            if scan['Index Name'] != index:
+                found.append(f'{table} read through {scan["Index Name"]}, '
+                             f'not {index}')
+        if mentioned(plan.get('Filter', '')):
+            found.append(f'{table}.{column} filtered, not in the condition '
+                         f'of {index}')
+    for child in plan.get('Plans', ()):
+        found += index_misses(child)
+    return found
+
+
+def queries(patient):
+    """The SQL of the per-patient queries made for `patient`"""
+    with CaptureQueriesContext(connection) as ctx:
+        for name in TABS:
+            getattr(tabs, name)(patient, timeline=PatientTimeline(patient))
+        problems.problem_list(patient)
+        for term in SEARCH_TERMS:
+            list(HistoryStats.search(patient.pk, term,
+                                     date_offset=patient.date_offset))
+        list(patient.docs.filter(date__range=PatientTimeline(patient)
+                                 .stored.date_range)
+             .values('date', 'doc_type', 'sub_type'))
+    return [q['sql'] for q in ctx.captured_queries
+            if q['sql'].lstrip().upper().startswith('SELECT')
+            and any(table in q['sql'] for table in CHECKED)]
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'patients',
+            nargs='*',
+            type=int,
+            help='Patient ids to check (default: the first sample patients)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=3,
+            help='Number of sample patients checked by default'
+        )
+        parser.add_argument(
+            '--planner-costs',
+            action='store_true',
+            help='Check the plans chosen for the current data instead'
+        )
+
+    def handle(self, *args, **options):
+        if options['patients']:
+            patients = Patient.objects.filter(pk__in=options['patients'])
+        else:
+            patients = (Patient.objects.filter(is_sample=True)
+                        .order_by('pk')[:options['limit']])
+        patients = list(patients)
+        if not patients:
+            raise CommandError('No patients to check')
+
+        failures = []
+        checked = 0
+        for patient in patients:
+            # Rolled back, so the planner settings go with it
+            with transaction.atomic(), connection.cursor() as cursor:
+                statements = queries(patient)
+                if not options['planner_costs']:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                for sql in statements:
+                    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    misses = [
+                        f'sequential scan of {table}'
+                        for table in sorted(set(seq_scans(plan[0]['Plan'])))
+                    ] + index_misses(plan[0]['Plan'])
+                    checked += 1
+                    if misses:
+                        failures.append((patient.pk, misses, sql, plan))
+                transaction.set_rollback(True)
+
+        for patient_id, misses, sql, plan in failures:
+            self.stdout.write(self.style.ERROR(
+                f'Patient {patient_id}: {"; ".join(misses)}'))
+            self.stdout.write(f'  {sql}')
+            if options['verbosity'] > 1:
+                self.stdout.write(json.dumps(plan, indent=2))
+        if failures:
+            raise CommandError(f'{len(failures)} of {checked} queries '
+                               f'miss the index meant for them')
+        self.stdout.write(self.style.SUCCESS(
+            f'All {checked} queries for {len(patients)} patients use the '
+            f'intended indexes'
+        ))
@@ -0,0 +1,18 @@
+# Hand written: the table itself is created by
+# initial_data/migrations/0002_history_stats_table.py
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0006_auto_20190115_0111'),
+    ]
+
+    operations = [
+        migrations.AlterModelTable(
+            name='historystats',
+            table='patient_history_stats',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_historystatsrefresh'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='data_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
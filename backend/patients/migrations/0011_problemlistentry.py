@@ -0,0 +1,37 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxonomies', '0005_taxonomyversion'),
+        ('patients', '0010_patient_data_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProblemListEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('icds', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('first_date', models.DateField()),
+                ('last_date', models.DateField()),
+                ('date_spread', models.IntegerField()),
+                ('intensity', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None)),
+                ('final_intensity', models.FloatField()),
+                ('auc', models.FloatField()),
+                ('grid_end', models.DateField()),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='patients.Patient')),
+                ('phecode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='taxonomies.Phecode')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='problemlistentry',
+            unique_together={('patient', 'phecode')},
+        ),
+    ]
@@ -0,0 +1,127 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields
+import numpy as np
+from django.db import migrations, models
+import django.db.models.deletion
+
+from patients.digest import by_code, merge_by_code
+
+# As LabPercentiles.QUANTILES
+QUANTILES = (0.10, 0.25, 0.50, 0.75, 0.90)
+PERCS = ('perc_10', 'perc_25', 'perc_50', 'perc_75', 'perc_90')
+
+# Lab result ids digested at a time
+CHUNK = 1000000
+
+
+def build_percentiles(apps, schema_editor):
+    """
+    Digests the existing lab results into the new rows (as
+    build_lab_percentiles does), before the instances' percentile columns go.
+    Labs without any values keep the percentiles their instances had.
+    """
+    LabInstance = apps.get_model('patients', 'LabInstance')
+    LabPercentiles = apps.get_model('patients', 'LabPercentiles')
+    instances = LabInstance._meta.db_table
+    digests = {}
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'SELECT MIN(id), MAX(id) FROM {instances}')
+        low, high = cursor.fetchone()
+        starts = range(low, high + 1, CHUNK) if low is not None else ()
+        for start in starts:
+            cursor.execute(f'SELECT code_id, value FROM {instances} '
+                           f'WHERE id >= %s AND id < %s '
+                           f'AND value IS NOT NULL', [start, start + CHUNK])
+            rows = cursor.fetchall()
+            codes = np.array([r[0] for r in rows], dtype=np.int64)
+            values = np.array([r[1] for r in rows], dtype=np.float64)
+            digests = merge_by_code(digests, by_code(codes, values))
+
+    rows = []
+    for lab, digest in digests.items():
+        percs = digest.quantiles(QUANTILES)
+        rows.append(LabPercentiles(
+            lab_id=lab,
+            means=digest.means.tolist(),
+            weights=digest.weights.tolist(),
+            low=float(digest.low),
+            high=float(digest.high),
+            count=digest.count,
+            **{name: float(p) for name, p in zip(PERCS, percs)},
+        ))
+    LabPercentiles.objects.bulk_create(rows, batch_size=1000)
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {LabPercentiles._meta.db_table}
+                (lab_id, means, weights, count, {", ".join(PERCS)})
+            SELECT DISTINCT ON (code_id) code_id, '{{}}', '{{}}', 0,
+                {", ".join(PERCS)}
+            FROM {instances}
+            WHERE COALESCE({", ".join(PERCS)}) IS NOT NULL
+            ORDER BY code_id
+            ON CONFLICT DO NOTHING
+        """)
+
+
+def restore_instance_percentiles(apps, schema_editor):
+    """Copies each lab's percentiles back onto its instances"""
+    LabInstance = apps.get_model('patients', 'LabInstance')
+    LabPercentiles = apps.get_model('patients', 'LabPercentiles')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {LabInstance._meta.db_table} I
+            SET {", ".join(f"{name} = P.{name}" for name in PERCS)}
+            FROM {LabPercentiles._meta.db_table} P
+            WHERE P.lab_id = I.code_id
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxonomies', '0005_taxonomyversion'),
+        ('patients', '0011_problemlistentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabPercentiles',
+            fields=[
+                ('lab', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='percentiles', serialize=False, to='taxonomies.Lab')),
+                ('means', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                ('weights', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), default=list, size=None)),
+                ('low', models.FloatField(null=True)),
+                ('high', models.FloatField(null=True)),
+                ('count', models.BigIntegerField(default=0)),
+                ('perc_10', models.FloatField(null=True)),
+                ('perc_25', models.FloatField(null=True)),
+                ('perc_50', models.FloatField(null=True)),
+                ('perc_75', models.FloatField(null=True)),
+                ('perc_90', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.RunPython(build_percentiles,
+                             restore_instance_percentiles),
+        migrations.RemoveField(
+            model_name='labinstance',
+            name='perc_10',
+        ),
+        migrations.RemoveField(
+            model_name='labinstance',
+            name='perc_25',
+        ),
+        migrations.RemoveField(
+            model_name='labinstance',
+            name='perc_50',
+        ),
+        migrations.RemoveField(
+            model_name='labinstance',
+            name='perc_75',
+        ),
+        migrations.RemoveField(
+            model_name='labinstance',
+            name='perc_90',
+        ),
+    ]
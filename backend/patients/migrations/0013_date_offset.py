@@ -0,0 +1,23 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0012_labpercentiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='date_offset',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='problemlistentry',
+            name='date_offset',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0013_date_offset'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='icdinstance',
+            index=models.Index(fields=['patient', 'date', 'code'], name='icdinstance_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='cptinstance',
+            index=models.Index(fields=['patient', 'date', 'code'], name='cptinstance_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='labinstance',
+            index=models.Index(fields=['patient', 'datetime'], name='labinstance_patient_datetime'),
+        ),
+        migrations.AddIndex(
+            model_name='clinicalnote',
+            index=models.Index(fields=['patient', 'date'], name='clinicalnote_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(fields=['patient', 'date'], name='medication_patient_date'),
+        ),
+        migrations.AddIndex(
+            model_name='heartrate',
+            index=models.Index(fields=['patient', 'entry_date'], name='heartrate_patient_entry_date'),
+        ),
+        migrations.AddIndex(
+            model_name='bmi',
+            index=models.Index(fields=['patient', 'weight_date'], name='bmi_patient_weight_date'),
+        ),
+        migrations.AddIndex(
+            model_name='bloodpressure',
+            index=models.Index(fields=['patient', 'entry_date'], name='bloodpressure_patient_date'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0014_tab_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bloodpressure',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='vitals_bp', to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='bmi',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='vitals_bmi', to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='clinicalnote',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='docs', to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='cptinstance',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='heartrate',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='vitals_hr', to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='icdinstance',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='labinstance',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='patients.Patient'),
+        ),
+        migrations.AlterField(
+            model_name='medication',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='meds', to='patients.Patient'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0016_problemlistentry_taxonomy_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='labpercentiles',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
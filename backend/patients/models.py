@@ -2,14 +2,20 @@
 Provides models to represent Patients and the concrete information we have
 about them.
 """
+import re
 from textwrap import dedent
-from django.db import connection
+
+import numpy as np
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.db import connection, transaction
 from django.db.models import (
     Model, CASCADE,
-    ForeignKey, ManyToManyField, BigIntegerField, BooleanField,
-    CharField, DateField, DateTimeField, FloatField, IntegerField, TextField
+    ForeignKey, ManyToManyField, BigAutoField, BigIntegerField, BooleanField,
+    CharField, DateField, DateTimeField, FloatField, IntegerField, TextField,
+    Index, OneToOneField, Max,
 )
-from taxonomies.models import ICD, Lab, CPT
+from taxonomies.models import ICD, Lab, CPT, Phecode, TaxonomyVersion
+from .digest import Digest
 
 
 class Patient(Model):
@@ -42,6 +48,44 @@ class Patient(Model):
     cpts = ManyToManyField(CPT, through='CPTInstance')
     # Also available: meds, docs
 
+    # Bumped by triggers on the instance tables whenever any of this patient's
+    # events are written (see
+    # initial_data/migrations/0006_patient_data_version.py), so results
+    # computed from the history can be cached under it.  data_modified is the
+    # time of the last bump.
+    data_version = IntegerField(default=0)
+    data_modified = DateTimeField(null=True)
+
+    # Days added to every date in the history when it is read, so a history
+    # is shifted (e.g. to look recent) by changing this alone; the events are
+    # stored unshifted.  Changing it bumps data_version, see
+    # initial_data/migrations/0010_patient_date_offset.py
+    date_offset = IntegerField(default=0)
+
+    def taxonomy(self):
+        """
+        (version, modified) of the taxonomies, which results computed from
+        the history depend on as well; read with the patient where its query
+        is annotated with taxonomy_version & taxonomy_modified (as the API's
+        is), otherwise read once
+        """
+        if not hasattr(self, 'taxonomy_version'):
+            current = TaxonomyVersion.current()
+            self.taxonomy_version = current.version
+            self.taxonomy_modified = current.modified
+        return self.taxonomy_version, self.taxonomy_modified
+
+    def percentiles(self):
+        """
+        When the lab percentiles (see LabPercentiles) were last written,
+        which the lab results are shown against; read with the patient where
+        its query is annotated with percentiles_modified (as the API's is),
+        otherwise read once
+        """
+        if not hasattr(self, 'percentiles_modified'):
+            self.percentiles_modified = LabPercentiles.modified()
+        return self.percentiles_modified
+
     def __repr__(self):
         fmt = '{}(first_name={}, last_name={})'
         cls_name = self.__class__.__name__
@@ -55,59 +99,220 @@ class HistoryStats(Model):
     """
     HistoryStats gives a convenient way to search all Code / Instance types and
     retrieve some very basic aggregate information about them on a per patient
-    basis.  This is a materialized view, not a table.
+    basis.  This is a table maintained by triggers on the instance tables (see
+    initial_data/migrations/0002_history_stats_table.py), so it is always
+    current and never needs a table-wide refresh after a write.
     """
     # N.B. - icd codes MUST have an associated Phecode to be included in this
-    # view
+    # table
+    id = BigAutoField(primary_key=True)
     patient_id = BigIntegerField()
-    code_id = BigIntegerField()
+    code_id = BigIntegerField(null=True)
     kind = CharField(max_length=16)
-    code = CharField(max_length=64, primary_key=True)
-    description = CharField(max_length=4096)
+    code = CharField(max_length=64)
+    description = CharField(max_length=4096, null=True)
     count = IntegerField()
-    earliest = DateField()
-    latest = DateField()
+    earliest = DateField(null=True)
+    latest = DateField(null=True)
 
-    # we're working with a view, not a real table
+    # Search terms that look like the start of an ICD / CPT code
+    code_re = re.compile(r'^[A-Za-z]?\d')
+
+    # the table and its triggers are hand written
     class Meta:
         managed = False
-        db_table = 'v_patient_history_stats'
+        db_table = 'patient_history_stats'
 
+    @classmethod
+    def rebuild(cls):
+        """
+        Table-wide rebuild from the v_patient_history_stats view.  Only needed
+        when something the triggers can't see changes, e.g. the taxonomies.
+        Use patients.history to schedule this rather than calling it directly.
+        """
+        table = cls._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Block the instance table triggers (but not readers) so writes
+            # that land during the rebuild are applied after it, not lost
+            cursor.execute(f'LOCK TABLE {table} IN EXCLUSIVE MODE')
+            cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY '
+                           'v_patient_history_stats')
+            # Apply only the differences, so unchanged rows aren't rewritten
+            cursor.execute(dedent(f"""\
+                DELETE FROM {table} S
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM v_patient_history_stats V
+                    WHERE
+                        V.patient_id = S.patient_id AND
+                        V.kind = S.kind AND
+                        V.code = S.code AND
+                        V.description IS NOT DISTINCT FROM S.description
+                )
+            """))
+            cursor.execute(dedent(f"""\
+                INSERT INTO {table} AS S
+                    (patient_id, code_id, kind, code, description,
+                     count, earliest, latest)
+                SELECT
+                    patient_id, code_id, kind, code, description,
+                    count, earliest, latest
+                FROM v_patient_history_stats
+                ON CONFLICT (patient_id, kind, code,
+                             md5(COALESCE(description, '')))
+                DO UPDATE SET
+                    code_id = EXCLUDED.code_id,
+                    count = EXCLUDED.count,
+                    earliest = EXCLUDED.earliest,
+                    latest = EXCLUDED.latest
+                WHERE
+                    (S.code_id, S.count, S.earliest, S.latest)
+                    IS DISTINCT FROM
+                    (EXCLUDED.code_id, EXCLUDED.count,
+                     EXCLUDED.earliest, EXCLUDED.latest)
+            """))
 
-class ICDInstance(Model):
+    @classmethod
+    def search(cls, patient_id, term, limit=20, after=None, date_offset=0):
+        """
+        Ranked search of a patient's history.  Terms that look like the start
+        of a code (or are too short for trigrams to discriminate) match codes
+        by prefix (ranked by how closely) and descriptions by substring, as
+        ILIKE; anything else is matched by trigram similarity against both
+        the code and the description.  Either way the kind (icd, lab, ...)
+        also matches by prefix.  Results are ordered by rank, count and id;
+        `after` is the (rank, count, id) of the last result of the previous
+        page.  The dates are shifted by `date_offset` (the patient's, see
+        Patient.date_offset).
+        """
+        term = term.strip()
+        escaped = (term.replace('\\', '\\\\')
+                       .replace('%', '\\%')
+                       .replace('_', '\\_'))
+        rank, count, id_ = after or (None, None, None)
+        params = {'patient': patient_id, 'term': term,
+                  'pattern': escaped + '%', 'contains': f'%{escaped}%',
+                  'limit': limit, 'rank': rank, 'count': count, 'id': id_,
+                  'date_offset': date_offset}
+        columns = ('id, patient_id, code_id, kind, code, description, count, '
+                   'earliest + %(date_offset)s AS earliest, '
+                   'latest + %(date_offset)s AS latest')
+        if len(term) < 3 or cls.code_re.match(term):
+            search = f"""
+                SELECT {columns}, CASE
+                    WHEN upper(code) = upper(%(term)s) THEN 2
+                    WHEN upper(code::text) LIKE upper(%(pattern)s) THEN 1
+                    ELSE 0
+                END::float8 AS rank
+                FROM {cls._meta.db_table}
+                WHERE patient_id = %(patient)s AND (
+                    upper(code::text) LIKE upper(%(pattern)s) OR
+                    description ILIKE %(contains)s OR
+                    kind LIKE lower(%(pattern)s)
+                )
+            """
+        else:
+            search = f"""
+                SELECT {columns}, GREATEST(
+                    similarity(code, %(term)s),
+                    word_similarity(%(term)s, description)
+                )::float8 AS rank
+                FROM {cls._meta.db_table}
+                WHERE patient_id = %(patient)s AND (
+                    code %% %(term)s OR
+                    description %%> %(term)s OR
+                    kind LIKE lower(%(pattern)s)
+                )
+            """
+        # The rows after `after` in the order of the results
+        keyset = ''
+        if after is not None:
+            keyset = """
+                WHERE rank < %(rank)s OR (rank = %(rank)s AND (
+                    count < %(count)s OR (count = %(count)s AND id > %(id)s)
+                ))
+            """
+        statement = f"""
+            SELECT * FROM ({search}) R
+            {keyset}
+            ORDER BY rank DESC, count DESC, id
+            LIMIT %(limit)s
+        """
+        return cls.objects.raw(dedent(statement), params)
+
+
+class HistoryStatsRefresh(Model):
+    """
+    A single row recording when a rebuild of the history stats was last
+    requested, started and finished; see patients.history.
+    """
+    requested_at = DateTimeField(null=True)
+    started_at = DateTimeField(null=True)
+    finished_at = DateTimeField(null=True)
+
+
+class ProblemListEntry(Model):
+    """
+    One phecode of a patient's stored problem list: the summary computed by
+    util.summarize_phecodes over the default window, on the grid ending on
+    `grid_end`.  Every phecode in the history has a row, whether or not it
+    makes the list; see patients.problems for how they are kept current.
+    """
     patient = ForeignKey(Patient, on_delete=CASCADE)
+    phecode = ForeignKey(Phecode, on_delete=CASCADE)
+    # The constituent ICDs: [{code, description, events: [ISO dates]}]
+    icds = JSONField()
+    first_date = DateField()
+    last_date = DateField()
+    date_spread = IntegerField()
+    intensity = ArrayField(FloatField())
+    final_intensity = FloatField()
+    auc = FloatField()
+    grid_end = DateField()
+    # The patient's date_offset the entry's dates are shifted by
+    date_offset = IntegerField(default=0)
+    # The TaxonomyVersion the entry's codes & descriptions were read at
+    taxonomy_version = IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('patient', 'phecode'),)
+
+
+class ICDInstance(Model):
+    patient = ForeignKey(Patient, on_delete=CASCADE, db_index=False)
     date = DateField()
     code = ForeignKey(ICD, on_delete=CASCADE)
 
+    class Meta:
+        # The tab queries select a patient's events over a date range; with
+        # the code, the instance columns are all in the index.  It serves
+        # lookups by patient alone too, so (as for every table of events)
+        # the foreign key has no index of its own for the planner to prefer
+        indexes = [Index(fields=['patient', 'date', 'code'],
+                         name='icdinstance_patient_date')]
+
     def __repr__(self):
         fmt = '{}(patient={}, code={})'
         cls_name = self.__class__.__name__
         return fmt.format(cls_name, self.patient, self.code)
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        with connection.cursor() as cursor:
-            cursor.execute('REFRESH MATERIALIZED VIEW v_patient_history_stats')
-
 
 class CPTInstance(Model):
-    patient = ForeignKey(Patient, on_delete=CASCADE)
+    patient = ForeignKey(Patient, on_delete=CASCADE, db_index=False)
     date = DateField()
     code = ForeignKey(CPT, on_delete=CASCADE)
 
+    class Meta:
+        indexes = [Index(fields=['patient', 'date', 'code'],
+                         name='cptinstance_patient_date')]
+
     def __repr__(self):
         fmt = '{}(patient={}, code={})'
         cls_name = self.__class__.__name__
         return fmt.format(cls_name, self.patient, self.code)
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        with connection.cursor() as cursor:
-            cursor.execute('REFRESH MATERIALIZED VIEW v_patient_history_stats')
-
 
 class LabInstance(Model):
-    patient = ForeignKey(Patient, on_delete=CASCADE)
+    patient = ForeignKey(Patient, on_delete=CASCADE, db_index=False)
     # For many metrics, a granularity at the date level is sufficient, labs
     # however need to include the time
     datetime = DateTimeField()
@@ -121,11 +326,9 @@ class LabInstance(Model):
     normal_min = FloatField(null=True)
     normal_max = FloatField(null=True)
 
-    perc_10 = FloatField(null=True)
-    perc_25 = FloatField(null=True)
-    perc_50 = FloatField(null=True)
-    perc_75 = FloatField(null=True)
-    perc_90 = FloatField(null=True)
+    class Meta:
+        indexes = [Index(fields=['patient', 'datetime'],
+                         name='labinstance_patient_datetime')]
 
     # same as with Instance subtypes
     def __repr__(self):
@@ -133,51 +336,119 @@ class LabInstance(Model):
         cls_name = self.__class__.__name__
         return fmt.format(cls_name, self.patient, self.code)
 
-    # same as with Instance subtypes
-    def save(self, *args, **kwargs):
-        super(LabInstance, self).save(*args, **kwargs)
-        with connection.cursor() as cursor:
-            cursor.execute('REFRESH MATERIALIZED VIEW v_patient_history_stats')
+
+class LabPercentiles(Model):
+    """
+    The distribution of a lab's values across every patient: a t-digest (see
+    patients.digest) and the percentiles read from it.  Batches of new
+    results are merged in with `add` rather than recomputing from the
+    instances.
+    """
+    QUANTILES = (0.10, 0.25, 0.50, 0.75, 0.90)
+
+    lab = OneToOneField(Lab, on_delete=CASCADE, primary_key=True,
+                        related_name='percentiles')
+    means = ArrayField(FloatField(), default=list)
+    weights = ArrayField(FloatField(), default=list)
+    low = FloatField(null=True)
+    high = FloatField(null=True)
+    count = BigIntegerField(default=0)
+
+    perc_10 = FloatField(null=True)
+    perc_25 = FloatField(null=True)
+    perc_50 = FloatField(null=True)
+    perc_75 = FloatField(null=True)
+    perc_90 = FloatField(null=True)
+
+    # Set on every write, so the latest is the version of the percentiles
+    # that results computed with them can be cached under
+    updated = DateTimeField(auto_now=True, db_index=True)
 
     @classmethod
-    def update_percentiles(cls):
-        statement = dedent(f"""\
-            UPDATE {cls._meta.db_table} AS A
-            SET
-                perc_10 = B.p10,
-                perc_25 = B.p25,
-                perc_50 = B.p50,
-                perc_75 = B.p75,
-                perc_90 = B.p90
-            FROM (
-                SELECT
-                    code_id,
-                    percentile_disc(0.10) WITHIN GROUP (ORDER BY value) AS p10,
-                    percentile_disc(0.25) WITHIN GROUP (ORDER BY value) AS p25,
-                    percentile_disc(0.50) WITHIN GROUP (ORDER BY value) AS p50,
-                    percentile_disc(0.75) WITHIN GROUP (ORDER BY value) AS p75,
-                    percentile_disc(0.90) WITHIN GROUP (ORDER BY value) AS p90
-                FROM {cls._meta.db_table}
-                GROUP BY code_id
-            ) AS B
-            WHERE A.code_id = B.code_id
-        """)
-        with connection.cursor() as cursor:
-            cursor.execute(statement)
+    def latest(cls):
+        """The time of the last write, as a query (for Subquery)"""
+        return cls.objects.order_by('-updated').values('updated')[:1]
+
+    @classmethod
+    def modified(cls):
+        """The time of the last write (None without any rows)"""
+        return cls.objects.aggregate(Max('updated'))['updated__max']
+
+    @property
+    def digest(self):
+        return Digest(np.array(self.means), np.array(self.weights),
+                      np.nan if self.low is None else self.low,
+                      np.nan if self.high is None else self.high)
+
+    @digest.setter
+    def digest(self, digest):
+        self.means = digest.means.tolist()
+        self.weights = digest.weights.tolist()
+        self.count = digest.count
+        self.low, self.high = (None if np.isnan(v) else float(v)
+                               for v in (digest.low, digest.high))
+        percs = digest.quantiles(self.QUANTILES)
+        (self.perc_10, self.perc_25, self.perc_50,
+         self.perc_75, self.perc_90) = (None if np.isnan(p) else float(p)
+                                        for p in percs)
+
+    @classmethod
+    def add(cls, digests):
+        """Merges {lab id: Digest} of newly loaded results into the rows"""
+        cls._write(digests, replace=False)
+
+    @classmethod
+    def rebuild(cls, digests):
+        """Replaces the rows with {lab id: Digest} of every result"""
+        cls._write(digests, replace=True)
+
+    @classmethod
+    def _write(cls, digests, replace):
+        if not digests and not replace:
+            return
+        with transaction.atomic():
+            # Create any missing rows first, so that concurrent writers queue
+            # on the row locks below instead of racing to insert
+            with connection.cursor() as cursor:
+                cursor.execute(dedent(f"""\
+                    INSERT INTO {cls._meta.db_table} (lab_id, means, weights,
+                                                      count, updated)
+                    SELECT unnest(%s::int[]), '{{}}', '{{}}', 0, now()
+                    ON CONFLICT DO NOTHING
+                """), [list(digests)])
+                if replace:
+                    cursor.execute(f'DELETE FROM {cls._meta.db_table} '
+                                   f'WHERE NOT lab_id = ANY(%s)',
+                                   [list(digests)])
+            rows = (cls.objects.select_for_update()
+                    .filter(lab__in=list(digests))
+                    .order_by('lab'))
+            for row in rows:
+                digest = digests[row.lab_id]
+                if not replace:
+                    digest = Digest.merge([row.digest, digest])
+                row.digest = digest
+                row.save()
 
 
 class ClinicalNote(Model):
     """Represents a clinical note / doc"""
-    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='docs')
+    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='docs',
+                         db_index=False)
     date = DateField()
     doc_type = CharField(max_length=8)
     sub_type = CharField(max_length=128)
     content = TextField()
 
+    class Meta:
+        indexes = [Index(fields=['patient', 'date'],
+                         name='clinicalnote_patient_date')]
+
 
 class Medication(Model):
     """Represents a medication usage"""
-    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='meds')
+    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='meds',
+                         db_index=False)
     date = DateField()
     name = CharField(max_length=64)
     strength = CharField(max_length=64)
@@ -186,36 +457,70 @@ class Medication(Model):
     dose = CharField(max_length=64, null=True)
     duration = CharField(max_length=64, null=True)
 
-    # Computed columns stored in db for access speed reasons
-    # After loading the samples run the pursuant classmethods
+    # Computed columns stored in db for access speed reasons.  Loaders fill
+    # them in as rows are written (see with_derived); for any rows written
+    # without them, refresh_patient_histories runs fill_derived.
     description = CharField(null=True, max_length=64*4)
     strength_num = FloatField(null=True)
 
+    class Meta:
+        indexes = [Index(fields=['patient', 'date'],
+                         name='medication_patient_date')]
+
+    # The number a strength starts with, e.g. 2.5 in '2.5 MG'
+    STRENGTH_RE = r'\d+\.?\d*'
+
     @classmethod
-    def gen_descriptions(cls):
-        """Table-wide update the computed description column"""
-        with connection.cursor() as cursor:
-            cursor.execute(dedent(f"""\
-                UPDATE {cls._meta.db_table}
-                SET description = CONCAT(
+    def with_derived(cls, frame):
+        """
+        A DataFrame of medication fields with description & strength_num
+        computed the way fill_derived does
+        """
+        strength = frame.strength.str.extract(f'({cls.STRENGTH_RE})',
+                                              expand=False)
+        return frame.assign(
+            description=frame.name.str.cat(
+                [frame.strength, frame.route, frame.frequency], sep=' '),
+            strength_num=strength.astype(float),
+        )
+
+    @classmethod
+    def fill_derived(cls, batch_size=50000):
+        """
+        Computes the derived columns of the rows without them (description is
+        NULL), a batch at a time so that no statement rewrites more than
+        `batch_size` rows.  Returns the number of rows filled.
+        """
+        statement = dedent(f"""\
+            WITH batch AS (
+                SELECT id FROM {cls._meta.db_table}
+                WHERE description IS NULL
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {cls._meta.db_table} AS M
+            SET
+                description = CONCAT(
                     name,     ' ',
                     strength, ' ',
                     route,    ' ',
                     frequency
-                )
-            """))
-
-    @classmethod
-    def gen_strength_nums(cls):
-        """Table-wide update the computed strength_num column"""
-        with connection.cursor() as cursor:
-            cursor.execute(dedent(f"""\
-                UPDATE {cls._meta.db_table}
-                SET strength_num = CAST (
-                    SUBSTRING(strength from '\d+\.?\d*')
+                ),
+                strength_num = CAST (
+                    SUBSTRING(strength from %(strength_re)s)
                     AS DOUBLE PRECISION
                 )
-            """))
+            FROM batch
+            WHERE M.id = batch.id
+        """)
+        params = {'batch_size': batch_size, 'strength_re': cls.STRENGTH_RE}
+        filled = 0
+        with connection.cursor() as cursor:
+            while True:
+                cursor.execute(statement, params)
+                filled += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    return filled
 
     def __repr__(self):
         desc = ', '.join([f'patient={self.patient}',
@@ -223,19 +528,20 @@ class Medication(Model):
                           f'description={self.description}'])
         return f'{self.__class__.__name__}({desc})'
 
-    def save(self, *args, **kwargs):
-        super(Medication, self).save(*args, **kwargs)
-        with connection.cursor() as cursor:
-            cursor.execute('REFRESH MATERIALIZED VIEW v_patient_history_stats')
-
 
 class HeartRate(Model):
-    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='vitals_hr')
+    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='vitals_hr',
+                         db_index=False)
     entry_date = DateTimeField()
     # Always RespRt or Pulse
     name = CharField(max_length=32)
     value = IntegerField()
 
+    class Meta:
+        # Both kinds are read together, so the name isn't part of the key
+        indexes = [Index(fields=['patient', 'entry_date'],
+                         name='heartrate_patient_entry_date')]
+
     @property
     def unit(self):
         """Always BMP for these two tests"""
@@ -243,19 +549,29 @@ class HeartRate(Model):
 
 
 class BMI(Model):
-    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='vitals_bmi')
+    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='vitals_bmi',
+                         db_index=False)
     weight = FloatField()
     weight_date = DateTimeField()
     height = FloatField()
     height_date = DateTimeField()
     bmi = FloatField()
 
+    class Meta:
+        indexes = [Index(fields=['patient', 'weight_date'],
+                         name='bmi_patient_weight_date')]
+
 
 class BloodPressure(Model):
-    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='vitals_bp')
+    patient = ForeignKey(Patient, on_delete=CASCADE, related_name='vitals_bp',
+                         db_index=False)
     entry_date = DateTimeField()
     value = CharField(max_length=32)
     status = CharField(max_length=32)
     status_code = IntegerField()
     systolic = IntegerField()
     diastolic = IntegerField()
+
+    class Meta:
+        indexes = [Index(fields=['patient', 'entry_date'],
+                         name='bloodpressure_patient_date')]
@@ -0,0 +1,157 @@
+"""
+Stored problem lists.
+
+Each patient's phecode summaries over the default window are kept in
+ProblemListEntry rows, so an overview reads its problem list instead of
+inferring every phecode's intensity again.  Triggers on the ICD instance table
+queue the (patient, phecode) pairs that writes touch in patient_problem_dirty
+(see initial_data/migrations/0008_problem_list_dirty.py).  When the day
+changes the default grid moves on and a patient's entries are out of date in
+full, as they are when the patient's date_offset or the taxonomies (see
+TaxonomyVersion) change.
+
+Reads never write: a patient whose entries are out of date, or who has
+queued pairs, has their problem list computed from the history as if nothing
+were stored.  The entries are brought up to date on the write side, by the
+backfill_problem_lists command (run after loads, and daily for the grid).
+"""
+from datetime import date
+
+import numpy as np
+from django.db import connection, transaction
+
+from taxonomies.models import TaxonomyVersion
+from .models import ProblemListEntry
+from .timeline import PatientTimeline, Window
+from . import util
+from .util import PROBLEM_CUTOFF, summarize_phecodes
+
+# Key space of the per-patient advisory locks held while entries are written
+PROBLEM_LOCK = 0x7072_6f62
+
+# Entries computed on another grid, date_offset or taxonomy than the current
+# ones (of patient P, or of every patient if the condition on it is dropped)
+STALE = """
+    SELECT E.patient_id FROM patients_problemlistentry E
+    INNER JOIN patients_patient P ON P.id = E.patient_id
+    WHERE {patient} (
+        E.grid_end <> %(grid_end)s OR
+        E.date_offset <> P.date_offset OR
+        E.taxonomy_version <> %(taxonomy_version)s
+    )
+"""
+
+
+def entry(patient, summary, window):
+    """A ProblemListEntry from one of summarize_phecodes' dicts"""
+    first, last = summary['date_range']
+    return ProblemListEntry(
+        patient=patient,
+        phecode_id=summary['id'],
+        icds=[dict(icd, events=[d.isoformat() for d in icd['events']])
+              for icd in summary['icds']],
+        first_date=first,
+        last_date=last,
+        date_spread=summary['date_spread'],
+        intensity=summary['intensity'].tolist(),
+        final_intensity=float(summary['final_intensity']),
+        auc=float(summary['auc']),
+        grid_end=window.end,
+        date_offset=patient.date_offset,
+        taxonomy_version=patient.taxonomy()[0],
+    )
+
+
+def refresh(patient, full=False):
+    """
+    Brings the patient's entries up to date: all of them if the default grid
+    has moved on, the patient has been date shifted or the taxonomies have
+    changed since they were computed (or if `full`), otherwise those for the
+    dirty phecodes.
+    Returns the number of phecodes recomputed.
+    """
+    window = Window.parse()
+    timeline = PatientTimeline(patient, window)
+    entries = ProblemListEntry.objects.filter(patient=patient)
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Writers of the same patient's entries take turns
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                       [PROBLEM_LOCK, patient.pk])
+        # Pairs queued after this are left for the next refresh
+        cursor.execute('DELETE FROM patient_problem_dirty '
+                       'WHERE patient_id = %s RETURNING phecode_id',
+                       [patient.pk])
+        dirty = [phecode for phecode, in cursor.fetchall()]
+        stale = entries.exclude(grid_end=window.end,
+                                date_offset=patient.date_offset,
+                                taxonomy_version=patient.taxonomy()[0])
+        if full or stale.exists():
+            icds = timeline.icds
+            entries.delete()
+        elif dirty:
+            icds = timeline.icd_columns(dirty)
+            entries.filter(phecode__in=dirty).delete()
+        else:
+            return 0
+        summaries = summarize_phecodes(icds, window)
+        ProblemListEntry.objects.bulk_create(
+            entry(patient, summary, window) for summary in summaries
+        )
+    return len(summaries)
+
+
+def outdated():
+    """The ids of the patients whose entries need a refresh"""
+    params = {'grid_end': Window.parse().end,
+              'taxonomy_version': TaxonomyVersion.current().version}
+    with connection.cursor() as cursor:
+        cursor.execute(STALE.format(patient='') + """
+            UNION SELECT patient_id FROM patient_problem_dirty
+            ORDER BY 1
+        """, params)
+        return [patient for patient, in cursor.fetchall()]
+
+
+def current(patient):
+    """Whether the patient's entries are up to date; a read only check"""
+    params = {'patient': patient.pk, 'grid_end': Window.parse().end,
+              'taxonomy_version': patient.taxonomy()[0]}
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT NOT EXISTS (
+                {STALE.format(patient='E.patient_id = %(patient)s AND')}
+            ) AND NOT EXISTS (
+                SELECT 1 FROM patient_problem_dirty
+                WHERE patient_id = %(patient)s
+            )
+        """, params)
+        return cursor.fetchone()[0]
+
+
+def problem_list(patient, timeline=None):
+    """
+    util.problem_list over the default window: from the stored entries if
+    they are up to date, otherwise computed from the history
+    """
+    if not current(patient):
+        return util.problem_list(patient, timeline)
+    entries = (ProblemListEntry.objects
+               .filter(patient=patient, final_intensity__gt=PROBLEM_CUTOFF)
+               .select_related('phecode')
+               .order_by('-final_intensity', 'phecode'))
+    return [
+        {
+            'id': e.phecode_id,
+            'code': e.phecode.code,
+            'description': e.phecode.description,
+            'icds': [dict(icd, events=[date.fromisoformat(d)
+                                       for d in icd['events']])
+                     for icd in e.icds],
+            'date_range': (e.first_date, e.last_date),
+            'date_spread': e.date_spread,
+            'intensity': np.array(e.intensity),
+            'final_intensity': e.final_intensity,
+            'auc': e.auc,
+        }
+        for e in entries
+    ]
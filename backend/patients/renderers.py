@@ -0,0 +1,136 @@
+"""
+Compact renderings of the tab responses, selected by the Accept header or by
+`?format=compact` / `?format=msgpack`.
+
+The compact form has the same structure as the plain JSON, except that lists
+are rewritten as typed objects where that saves space:
+
+* a list of dicts with the same keys becomes
+  `{"type": "table", "columns": {key: [values...]}}`, each column compacted in
+  turn;
+* a list of dates becomes `{"type": "date", "days": [...]}` and a list of
+  datetimes `{"type": "datetime", "seconds": [...]}`, as integer offsets from
+  the Unix epoch (UTC);
+* a list of strings with repeats becomes
+  `{"type": "dict", "values": [distinct...], "codes": [index...]}`;
+* float arrays (the intensities) are rounded to float32, which in msgpack are
+  sent as `{"type": "float32", "data": <little endian bytes>}`;
+* the evenly spaced dategrid becomes
+  `{"type": "linspace", "start": s, "stop": s, "num": n}` in epoch seconds.
+
+Scalars are left as they are.  msgpack is in the requirements, but its
+renderer is only offered when the package is installed, so an environment
+without it still serves the JSON forms.
+"""
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def compact(value, binary=False):
+    """Rewrites a response's data in the compact form"""
+    if isinstance(value, dict):
+        return {key: compact(val, binary) for key, val in value.items()}
+    if isinstance(value, pd.DatetimeIndex):
+        return grid_points(value)
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'f':
+            return float32s(value, binary)
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return column(list(value), binary)
+    return value
+
+
+def column(values, binary=False):
+    """Compacts a list of values"""
+    if not values:
+        return values
+    if all(isinstance(v, dict) for v in values):
+        keys = list(values[0])
+        if all(list(v) == keys for v in values):
+            return {'type': 'table',
+                    'columns': {key: column([v[key] for v in values], binary)
+                                for key in keys}}
+    # N.B. datetime is a subclass of date
+    if all(isinstance(v, datetime) for v in values):
+        return {'type': 'datetime',
+                'seconds': [int(v.timestamp()) for v in values]}
+    if all(isinstance(v, date) and not isinstance(v, datetime)
+           for v in values):
+        return {'type': 'date',
+                'days': [v.toordinal() - EPOCH for v in values]}
+    if all(isinstance(v, str) for v in values):
+        distinct = {}
+        codes = [distinct.setdefault(v, len(distinct)) for v in values]
+        if len(distinct) < len(values):
+            return {'type': 'dict', 'values': list(distinct), 'codes': codes}
+        return values
+    return [compact(v, binary) for v in values]
+
+
+def float32s(values, binary=False):
+    """A float array rounded to single precision"""
+    values = values.astype('<f4')
+    if binary:
+        return {'type': 'float32', 'data': values.tobytes()}
+    # str gives the shortest repr that round trips as a float32
+    return [float(str(v)) for v in values]
+
+
+def grid_points(index):
+    """A DatetimeIndex as a linspace when it is evenly spaced"""
+    ns = index.asi8
+    steps = np.diff(ns)
+    if len(steps) and (np.abs(steps - steps[0]) <= 1).all():
+        return {'type': 'linspace',
+                'start': ns[0] / 1e9,
+                'stop': ns[-1] / 1e9,
+                'num': len(ns)}
+    return {'type': 'datetime', 'seconds': (ns // 10**9).tolist()}
+
+
+class CompactJSONRenderer(JSONRenderer):
+    media_type = 'application/vnd.chartviz.compact+json'
+    format = 'compact'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(compact(data), accepted_media_type,
+                              renderer_context)
+
+
+def msgpack_default(obj):
+    """Packs the scalars msgpack doesn't know about"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f'Cannot pack {type(obj).__name__}')
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(compact(data, binary=True), use_bin_type=True,
+                             default=msgpack_default)
+
+
+# The renderers offered in addition to the defaults
+compact_renderers = [CompactJSONRenderer]
+if msgpack is not None:
+    compact_renderers.append(MessagePackRenderer)
@@ -1,61 +1,76 @@
 """
 Functions of a patient
+
+Each takes an optional PatientTimeline; pass the same one to several functions
+to compute them all from a single fetch of the patient's history.  Otherwise
+each fetches the events in `window` (a timeline.Window, by default the whole
+history).
 """
 from collections import defaultdict
 from datetime import timedelta
-from itertools import groupby
 from operator import itemgetter
 
-from django.db.models import F
+import numpy as np
 
 from taxonomies.embedding import most_similar, disjoin_word
-from taxonomies.models import Chapter, Phecode
-from .util import (add_dategrid, grid_range, infer_intensity, problem_list,
-                   rollup_meds, rollup_labs, CHEM_CODES)
-from .models import HeartRate, BMI, BloodPressure
+from taxonomies.models import Chapter
+from . import problems
+from .downsample import days, downsample
+from .timeline import (PatientTimeline, Window, dates, datetimes,
+                       group_starts, in_range, nest, spans)
+from .util import (add_dategrid, infer_intensity, infer_intensities,
+                   problem_list, rollup_meds, rollup_labs, to_days,
+                   CHEM_CODES)
+
+
+def latest(table, mask=None):
+    """
+    The last row of the date ordered `table` (of those selected by `mask`) as
+    a dict, or an empty dict if there is none
+    """
+    if mask is not None:
+        table = table[mask]
+    rows = table[-1:].rows()
+    return rows[0] if rows else {}
 
 
 @add_dategrid
-def overview(patient):
+def overview(patient, timeline=None):
     one_week = timedelta(days=7)
-    phecodes = problem_list(patient)
-
-    # Medications
-    latest_med = patient.meds.latest('date').date
-    med_range = (latest_med - one_week, latest_med)
-    med_raw = patient.meds.filter(date__range=med_range)
-    meds = rollup_meds(med_raw)
-
-    # Labs
-    latest_lab = patient.labinstance_set.latest('datetime').datetime.date()
-    lab_range = (latest_lab - one_week, latest_lab)
-    lab_codes = (patient.labinstance_set
-                 .filter(datetime__date__range=lab_range)
-                 .values_list('code', flat=True))
-    lab_insts = patient.labinstance_set.filter(code__in=lab_codes)
-    labs = rollup_labs(lab_insts)
+    # The default window's problem list is stored
+    if timeline.window == Window.parse():
+        phecodes = problems.problem_list(patient, timeline)
+    else:
+        phecodes = problem_list(patient, timeline)
+
+    # Medications of the window's last week with any (no range if none)
+    meds = timeline.meds
+    med_range = None
+    if len(meds):
+        latest_med = meds.date.max().item()
+        med_range = (latest_med - one_week, latest_med)
+        meds = meds[in_range(meds.date, med_range)]
+    meds = rollup_meds(meds)
+
+    # Labs, likewise
+    labs = timeline.labs
+    lab_range = None
+    if len(labs):
+        latest_lab = labs.datetime.max().astype('datetime64[D]').item()
+        lab_range = (latest_lab - one_week, latest_lab)
+        lab_codes = np.unique(labs.code[in_range(labs.datetime, lab_range)])
+        labs = labs[np.isin(labs.code, lab_codes)]
+    labs = rollup_labs(labs)
 
     # Get the latest vitals
-    # If we have no measurements for a given metric, an empty object will
-    # return None for all its attributes, so setting bmi = BMI() is a kind of
-    # shorthand for saying weight = bmi.weight if bmi else None when we build
-    # the vitals dict below
-    try:
-        bmi = patient.vitals_bmi.latest('weight_date')
-    except BMI.DoesNotExist:
-        bmi = BMI()
-    try:
-        pulse = patient.vitals_hr.filter(name='Pulse').latest('entry_date')
-    except HeartRate.DoesNotExist:
-        pulse = HeartRate()
-    try:
-        resp = patient.vitals_hr.filter(name='RespRt').latest('entry_date')
-    except HeartRate.DoesNotExist:
-        resp = HeartRate()
-    try:
-        bp = patient.vitals_bp.latest('entry_date')
-    except BloodPressure.DoesNotExist:
-        bp = BloodPressure()
+    # If we have no measurements for a given metric we get an empty dict, so
+    # each .get below is a kind of shorthand for saying
+    # weight = bmi['weight'] if bmi else None when we build the vitals dict
+    heart_rates = timeline.heart_rates
+    bmi = latest(timeline.bmis)
+    pulse = latest(heart_rates, heart_rates.name == 'Pulse')
+    resp = latest(heart_rates, heart_rates.name == 'RespRt')
+    bp = latest(timeline.blood_pressures)
 
     return {
         'phecodes': phecodes,
@@ -64,24 +79,24 @@ def overview(patient):
         'meds': meds,
         'med_range': med_range,
         'vitals': {
-            'weight': bmi.weight,
-            'weight_date': bmi.weight_date,
-            'height': bmi.height,
-            'height_date': bmi.height_date,
-            'bmi': bmi.bmi,
-            'pulse': pulse.value,
-            'pulse_date': pulse.entry_date,
-            'resp': resp.value,
-            'resp_date': resp.entry_date,
-            'blood_pressure': bp.value,
-            'bp_date': bp.entry_date,
-            'bp_status': bp.status,
+            'weight': bmi.get('weight'),
+            'weight_date': bmi.get('weight_date'),
+            'height': bmi.get('height'),
+            'height_date': bmi.get('height_date'),
+            'bmi': bmi.get('bmi'),
+            'pulse': pulse.get('value'),
+            'pulse_date': pulse.get('entry_date'),
+            'resp': resp.get('value'),
+            'resp_date': resp.get('entry_date'),
+            'blood_pressure': bp.get('value'),
+            'bp_date': bp.get('entry_date'),
+            'bp_status': bp.get('status'),
         }
     }
 
 
 @add_dategrid
-def systems(patient):
+def systems(patient, timeline=None):
     """Generate phecode lists and intensity per chapter for the patient"""
     chapters = (Chapter.objects
                 .exclude(description='Procedures')
@@ -93,130 +108,156 @@ def systems(patient):
         ch.update({'phecodes': [], 'intensity': []})
         chapter_by_id[ch['id']] = ch
 
-    # dereference ICD's by phecode n chapter since we're rolling up by them
-    events = (patient.icdinstance_set
-              .filter(code__chapter__isnull=False,
-                      code__phecode__isnull=False,
-                      date__range=grid_range)
-              .annotate(phe_code=F('code__phecode__code'),
-                        phe_desc=F('code__phecode__description'),
-                        phe_id=F('code__phecode_id'),
-                        icd_code=F('code__code'),
-                        icd_desc=F('code__description'),
-                        chapter_id=F('code__chapter'))
-              .values()
-              .order_by('chapter_id', 'phe_code', 'icd_code', 'date')
-              .distinct())
-
-    # The items within each of these keys should vary together
-    by_chap = itemgetter('chapter_id')
-    by_phe = itemgetter('phe_code', 'phe_desc', 'phe_id')
-    by_icd = itemgetter('icd_code', 'icd_desc')
-
-    # Index set so we can update the chapter data dicts by ID
-    chapter_by_id = {c['id']: c for c in chapters}
-
-    # Three tiers of processing: by chapter, by phecode, by icd
-    for id_, chap_codes in groupby(events, key=by_chap):
-        chapter_dates = set()
-        # Generate the chapter's phecodes
-        phecodes = []
-        for phe_key, phe_events in groupby(chap_codes, key=by_phe):
-            phecode_data = {
-                'code': phe_key[0],
-                'description': phe_key[1],
-                'id': phe_key[2],
-                'icds': [],
-                'total': 0
-            }
-            for icd_key, icd_events in groupby(phe_events, key=by_icd):
-                event_dates = [e['date'] for e in icd_events]
-                chapter_dates |= set(event_dates)
-                phecode_data['total'] += len(event_dates)
-                phecode_data['icds'].append({
-                    'code': icd_key[0],
-                    'description': icd_key[1],
-                    'events': event_dates
-                })
-            phecodes.append(phecode_data)
-        intensity = infer_intensity(chapter_dates)
-        chapter_by_id[id_].update({
-            'phecodes': phecodes,
-            'intensity': intensity
+    # we're rolling up ICD's by chapter n phecode, ordered by chapter, then
+    # phecode and ICD code (as the database sorts them), then date
+    icds = timeline.icds
+    icds = icds[icds.chapter != -1]
+    order = np.lexsort((icds.date, icds.icd_rank, icds.phecode_rank,
+                        icds.chapter))
+    icds = icds[order]
+
+    # Three tiers of groups: by chapter, by phecode, by icd
+    chap_starts = group_starts(icds.chapter)
+    phe_starts = group_starts(icds.chapter, icds.phecode)
+    icd_starts = group_starts(icds.chapter, icds.phecode, icds.icd)
+
+    icd_data = []
+    for begin, stop in spans(icd_starts, len(icds)):
+        code, description = icds.info['icd'][icds.icd[begin]]
+        icd_data.append({'code': code,
+                         'description': description,
+                         'events': dates(icds.date[begin:stop])})
+    icd_data = nest(icd_data, icd_starts, phe_starts)
+
+    phecodes = []
+    for (begin, stop), phe_icds in zip(spans(phe_starts, len(icds)),
+                                       icd_data):
+        id_ = icds.phecode[begin].item()
+        code, description = icds.info['phecode'][id_]
+        phecodes.append({
+            'code': code,
+            'description': description,
+            'id': id_,
+            'icds': phe_icds,
+            'total': stop - begin
         })
 
+    for begin, chap_phecodes in zip(chap_starts.tolist(),
+                                    nest(phecodes, phe_starts, chap_starts)):
+        chapter_by_id[icds.chapter[begin].item()]['phecodes'] = chap_phecodes
+
+    # Infer every chapter's intensity (over its distinct dates) in one batch
+    window = timeline.window
+    ids, intensities = infer_intensities(to_days(icds.date, window),
+                                         icds.chapter, window)
+    for id_, intensity in zip(ids.tolist(), intensities):
+        chapter_by_id[id_]['intensity'] = intensity
+
     chapter_list = sorted(chapter_by_id.values(), key=itemgetter('code'))
     return {'chapters': chapter_list}
 
 
 @add_dategrid
-def labs(patient):
-    raw = patient.labinstance_set.filter(datetime__date__range=grid_range)
-    return {'labs': rollup_labs(raw)}
+def labs(patient, max_points=None, method='minmax', timeline=None):
+    return {'labs': rollup_labs(timeline.labs, max_points, method)}
 
 
 @add_dategrid
-def meds(patient):
-    qset = patient.meds.filter(date__range=grid_range)
-    return {'meds': rollup_meds(qset)}
+def meds(patient, timeline=None):
+    return {'meds': rollup_meds(timeline.meds)}
+
+
+def series(table, date, *values, max_points=None, method='minmax'):
+    """
+    The rows of the date ordered `table`, downsampled to about `max_points`
+    if given (keeping the points chosen for any of the value columns)
+    """
+    if not max_points or len(table) <= max_points:
+        return table
+    x = days(getattr(table, date))
+    # Share the points out between the columns
+    max_points //= len(values)
+    keep = [downsample(x, getattr(table, v).astype(float), max_points, method)
+            for v in values]
+    return table[np.unique(np.concatenate(keep))]
+
+
+def vitals(patient, max_points=None, method='minmax', timeline=None,
+           window=None):
+    """
+    Every vital sign measurement for the patient, by kind; each series
+    downsampled to about `max_points` if given
+    """
+    timeline = timeline or PatientTimeline(patient, window)
+    options = dict(max_points=max_points, method=method)
+    heart_rates = timeline.heart_rates
+    pulse = series(heart_rates[heart_rates.name == 'Pulse'], 'entry_date',
+                   'value', **options)
+    resp = series(heart_rates[heart_rates.name == 'RespRt'], 'entry_date',
+                  'value', **options)
+    blood_pressures = series(timeline.blood_pressures, 'entry_date',
+                             'systolic', 'diastolic', **options)
+    bmis = series(timeline.bmis, 'weight_date', 'bmi', **options)
+    heart_rate = [{'date': d, 'value': v} for d, v in
+                  zip(datetimes(pulse.entry_date), pulse.value.tolist())]
+    respiratory_rate = [{'date': d, 'value': v} for d, v in
+                        zip(datetimes(resp.entry_date), resp.value.tolist())]
+    blood_pressure = [{'date': e['entry_date'],
+                       'status': e['status'],
+                       'systolic': e['systolic'],
+                       'diastolic': e['diastolic']}
+                      for e in blood_pressures.rows()]
+    bmi = [{'date': e['weight_date'],
+            'value': e['bmi'],
+            'weightDate': e['weight_date'],
+            'weight': e['weight'],
+            'heightDate': e['height_date'],
+            'height': e['height']}
+           for e in bmis.rows()]
+    return {'heartRate': heart_rate,
+            'respiratoryRate': respiratory_rate,
+            'bloodPressure': blood_pressure,
+            'bmi': bmi}
 
 
 @add_dategrid
-def cpts(patient):
-    events = (patient
-              .cptinstance_set
-              .filter(date__range=grid_range)
-              .annotate(cat=F('code__category'),
-                        subcat=F('code__subcategory'),
-                        cpt=F('code__code'),
-                        desc=F('code__description'))
-              .values()
-              .order_by('cat', 'subcat', 'cpt', 'date')
-              .distinct())
-    key = itemgetter('cat', 'subcat', 'cpt', 'desc')
+def cpts(patient, timeline=None):
+    cpts = timeline.cpts
     codes = []
-    for (cat, subcat, cpt, desc), evts in groupby(events, key=key):
+    for begin, stop in spans(group_starts(cpts.cpt), len(cpts)):
+        cat, subcat, cpt, desc = cpts.info['cpt'][cpts.cpt[begin]]
         datum = dict(cpt=cpt,
                      category=cat,
                      subcategory=subcat,
                      description=desc)
-        datum['events'] = sorted(d['date'] for d in evts)
+        datum['events'] = dates(cpts.date[begin:stop])
         codes.append(datum)
     return {'cpts': codes}
 
 
 @add_dategrid
-def condition(patient, phecode, relevance=0.75):
+def condition(patient, phecode, relevance=0.75, timeline=None):
     """Returns all the stuff needed for a phecode tab"""
+    phecode = int(phecode)
     rdata = defaultdict(list)
 
     # Handle the ICD codes that constutue the Phecodes
-    ids = set()
+    all_icds = timeline.icds
+    icds = all_icds[all_icds.phecode == phecode]
     codes = set()
-    dates = set()
-    events = (patient.icdinstance_set
-                .filter(date__range=grid_range,
-                        code__phecode=phecode)
-                .annotate(icd_code=F('code__code'),
-                        icd_desc=F('code__description'),
-                        icd_id=F('code__id'))
-                .values('icd_code', 'icd_desc', 'icd_id', 'date')
-                .order_by('icd_code', 'date'))
-    key = itemgetter('icd_code', 'icd_desc', 'icd_id')
-    for (code, description, id_), evts in groupby(events, key=key):
-        ids.add(id_)
+    for begin, stop in spans(group_starts(icds.icd), len(icds)):
+        code, description = icds.info['icd'][icds.icd[begin]]
         codes.add(code)
-        datum = {
+        rdata['base_icds'].append({
             'code': code,
             'description': description,
-            'dates': [e['date'] for e in evts],
+            'dates': dates(icds.date[begin:stop]),
             'relevance': 1.0
-        }
-        dates |= set(datum['dates'])
-        rdata['base_icds'].append(datum)
+        })
 
     # Run fast intensity over the base codes
-    rdata['intensity'] = infer_intensity(dates)
+    rdata['intensity'] = infer_intensity(set(dates(icds.date)),
+                                         timeline.window)
 
     # Generate the codes identified as relevant and keep highest relevancy
     # score per code
@@ -238,39 +279,37 @@ def condition(patient, phecode, relevance=0.75):
             extras_scores[code] = score
 
     # Get the relevant lab instances
-    lab_raw = (patient.labinstance_set
-               .filter(datetime__date__range=grid_range,
-                       code__code__in=extras['LAB']))
-    rdata['labs'] = rollup_labs(lab_raw)
+    labs = timeline.labs
+    lab_ids = [id_ for id_, (code, _) in labs.info['lab'].items()
+               if code in extras['LAB']]
+    labs = labs[np.isin(labs.code, lab_ids)]
+    rdata['labs'] = rollup_labs(labs)
     for labset in rdata['labs'].values():
         for lab in labset:
             lab['relevance'] = extras_scores.get(lab['code'], 0)
 
     # Get the relevant medication instances
-    meds_raw = patient.meds.filter(date__range=grid_range,
-                                   name__in=extras['MED'])
-    rdata['meds'] = rollup_meds(meds_raw)
+    meds = timeline.meds
+    relevant_sigs = np.array([sig['name'] in extras['MED']
+                              for sig in meds.info['sig']], dtype=bool)
+    meds = meds[relevant_sigs[meds.sig]]
+    rdata['meds'] = rollup_meds(meds)
     for med in rdata['meds']:
         med['relevance'] = extras_scores[med['name']]
 
     # Get the relevant non-constituent ICD codes
     extra_icd_codes = extras['ICD'] - codes
-    extra_icds_insts = (patient.icdinstance_set
-                        .filter(date__range=grid_range,
-                                code__code__in=extra_icd_codes,
-                                code__phecode__isnull=False)
-                        .annotate(phecode_id=F('code__phecode_id'),
-                                  icd_code=F('code__code'),
-                                  icd_desc=F('code__description'))
-                        .values('phecode_id', 'icd_code', 'icd_desc', 'date')
-                        .order_by('phecode_id', 'icd_code', 'date'))
-    key = itemgetter('phecode_id', 'icd_code', 'icd_desc')
-    for (id_, code, description), evts in groupby(extra_icds_insts, key=key):
+    extra_ids = [id_ for id_, (code, _) in all_icds.info['icd'].items()
+                 if code in extra_icd_codes]
+    extra_icds = all_icds[np.isin(all_icds.icd, extra_ids)]
+    starts = group_starts(extra_icds.phecode, extra_icds.icd)
+    for begin, stop in spans(starts, len(extra_icds)):
+        code, description = extra_icds.info['icd'][extra_icds.icd[begin]]
         rdata['extra_icds'].append({
-            'phecode_id': id_,
+            'phecode_id': extra_icds.phecode[begin].item(),
             'code': code,
             'description': description,
-            'dates': [e['date'] for e in evts],
+            'dates': dates(extra_icds.date[begin:stop]),
             'relevance': extras_scores[code],
         })
 
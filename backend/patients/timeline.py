@@ -0,0 +1,412 @@
+"""
+A patient's event history held in memory as columns of NumPy arrays, so that
+it can be shared between tabs and grouped without per-event Python objects
+"""
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from django.db import models
+from django.db.models.functions import DenseRank
+from django.utils.dateparse import parse_date
+from django.utils.functional import cached_property
+
+from taxonomies.models import Lab
+
+# Medications are grouped by sig
+MED_KEYS = ('name', 'strength', 'route', 'frequency',
+            'description', 'strength_num')
+# Percentiles of each lab's values across all patients (LabPercentiles)
+PERC_KEYS = ('perc_10', 'perc_25', 'perc_50', 'perc_75', 'perc_90')
+# Lab fields that only apply to a given instance
+INST_KEYS = ('datetime', 'value', 'unit', 'normal_min', 'normal_max')
+
+
+# The default window: from the start of our records to today
+DEFAULT_START = date(2000, 1, 1)
+DEFAULT_RESOLUTION = 100
+# The zoom levels: requested resolutions are rounded up to one of these, so
+# only a few grids (and cached tabs) exist per window
+RESOLUTIONS = (25, 50, 100, 200, 400, 800)
+
+
+class Window(namedtuple('Window', ('start', 'end', 'resolution'))):
+    """
+    The date range (inclusive) a timeline covers, and the number of points in
+    the grid intensities are inferred on over it
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, start=None, end=None, resolution=None):
+        """
+        Builds a window from optional ISO date & integer strings (as given in
+        a query), defaulting to the whole history at the default resolution.
+        Raises ValueError for malformed or empty windows.
+        """
+        start = parse_date(start) if start else DEFAULT_START
+        end = parse_date(end) if end else date.today()
+        if start is None or end is None:
+            raise ValueError('start and end must be dates (YYYY-MM-DD)')
+        if start >= end:
+            raise ValueError('start must be before end')
+        resolution = int(resolution or DEFAULT_RESOLUTION)
+        levels = [r for r in RESOLUTIONS if r >= resolution]
+        if resolution < 2 or not levels:
+            raise ValueError(f'resolution must be from 2 to {RESOLUTIONS[-1]}')
+        return cls(start, end, levels[0])
+
+    @property
+    def grid(self):
+        return make_grid(*self)
+
+    @property
+    def grid_days(self):
+        """
+        Grid points as day offsets from the grid start; a copy of the cached
+        array, as fast_intensity needs a writable buffer
+        """
+        return grid_days(*self).copy()
+
+    @property
+    def date_range(self):
+        return (self.start, self.end)
+
+    @property
+    def datetime_range(self):
+        """The window as aware datetimes, [start, end + 1 day)"""
+        return tuple(datetime.combine(d, time(), timezone.utc)
+                     for d in (self.start, self.end + timedelta(days=1)))
+
+
+@lru_cache(maxsize=256)
+def make_grid(start, end, resolution):
+    return pd.date_range(start, end, periods=resolution)
+
+
+@lru_cache(maxsize=256)
+def grid_days(start, end, resolution):
+    grid = make_grid(start, end, resolution)
+    days = (grid - grid.min()).days.values.astype(float)
+    # Shared by every caller; Window.grid_days hands out copies
+    days.flags.writeable = False
+    return days
+
+
+class Columns:
+    """
+    Equal length arrays by name, one element per row, plus `info`: lookup
+    tables (e.g. code id -> code & description) shared by all the rows.
+    Indexing with a mask, slice or index array selects those rows from every
+    column.
+    """
+
+    def __init__(self, info=None, **columns):
+        self.info = info or {}
+        self.names = tuple(columns)
+        self.__dict__.update(columns)
+
+    def __len__(self):
+        return len(getattr(self, self.names[0]))
+
+    def __getitem__(self, index):
+        return Columns(self.info, **{name: getattr(self, name)[index]
+                                     for name in self.names})
+
+    def rows(self):
+        """The rows as a list of dicts of python values"""
+        columns = [python(getattr(self, name)) for name in self.names]
+        return [dict(zip(self.names, row)) for row in zip(*columns)]
+
+    @classmethod
+    def from_rows(cls, rows, info=None, **kinds):
+        """
+        Builds columns from a sequence of tuples; `kinds` maps each column
+        name, in row order, to its dtype or one of the special kinds 'id'
+        (integer, NULL as -1) and 'datetime' (aware datetimes, stored as naive
+        UTC datetime64)
+        """
+        values = list(zip(*rows)) or [()] * len(kinds)
+        return cls(info, **{name: column(vals, kind) for (name, kind), vals
+                            in zip(kinds.items(), values)})
+
+
+def column(values, kind):
+    """Converts a sequence of values from the db to an array"""
+    if kind == 'id':
+        return np.array([-1 if v is None else v for v in values],
+                        dtype=np.int64)
+    if kind == 'datetime':
+        return (pd.to_datetime(list(values), utc=True)
+                .tz_convert(None)
+                .values)
+    if kind is object:
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+    # N.B. float columns get NaN for NULL
+    return np.array(values, dtype=kind)
+
+
+def same(a, b):
+    """Elementwise equality treating NaN as equal to NaN"""
+    eq = a == b
+    if a.dtype.kind == 'f':
+        eq |= np.isnan(a) & np.isnan(b)
+    return eq
+
+
+def group_starts(*keys):
+    """Indices at which runs of equal keys start in (sorted) key arrays"""
+    n = len(keys[0])
+    change = np.zeros(n, dtype=bool)
+    change[:1] = True
+    for key in keys:
+        change[1:] |= ~same(key[1:], key[:-1])
+    return np.flatnonzero(change)
+
+
+def spans(starts, n):
+    """(start, stop) pairs for the groups beginning at `starts`"""
+    return zip(starts.tolist(), np.append(starts[1:], n).tolist())
+
+
+def dedupe(table, *keys):
+    """The rows of `table` that don't repeat the previous row's `keys`"""
+    keep = np.ones(len(table), dtype=bool)
+    if len(table):
+        keep[1:] = np.zeros(len(table) - 1, dtype=bool)
+        for key in keys:
+            col = getattr(table, key)
+            keep[1:] |= ~same(col[1:], col[:-1])
+    return table[keep]
+
+
+def nest(items, inner_starts, outer_starts):
+    """
+    Splits `items`, one per group starting at `inner_starts`, into a list per
+    enclosing group starting at `outer_starts`
+    """
+    bounds = np.searchsorted(inner_starts, outer_starts).tolist()
+    return [items[begin:stop] for begin, stop
+            in zip(bounds, bounds[1:] + [len(items)])]
+
+
+def code_rank(field):
+    """
+    The rank of each row's `field` among the query's rows, as the database
+    sorts it (its collation, which Python's string order needn't match)
+    """
+    # N.B. models.Window, the SQL window function, not this module's Window
+    return models.Window(DenseRank(), order_by=models.F(field).asc())
+
+
+def in_range(values, value_range):
+    """Mask of the datetime64 `values` in the inclusive range of dates"""
+    first, last = (np.datetime64(d, 'D') for d in value_range)
+    days = values.astype('datetime64[D]')
+    return (first <= days) & (days <= last)
+
+
+def dates(values):
+    """datetime64 array -> list of dates"""
+    return values.astype('datetime64[D]').tolist()
+
+
+def datetimes(values):
+    """Naive UTC datetime64 array -> list of aware datetimes"""
+    return list(pd.DatetimeIndex(values).tz_localize('UTC').to_pydatetime())
+
+
+def nullable(values):
+    """Float array -> list of floats, with NaN (NULL) & infinities as None"""
+    out = values.astype(object)
+    out[~np.isfinite(values)] = None
+    return out.tolist()
+
+
+def python(values):
+    """Array -> list of the equivalent python values (as the db returns)"""
+    if values.dtype.kind == 'M':
+        if np.datetime_data(values.dtype)[0] == 'D':
+            return dates(values)
+        return datetimes(values)
+    if values.dtype.kind == 'f':
+        return nullable(values)
+    return values.tolist()
+
+
+class PatientTimeline:
+    """
+    All of a patient's events in a window, each table fetched with one query
+    the first time it is needed and then shared by every tab computed from
+    this object.
+    Each table is a Columns ordered the way the tabs group it (the db does
+    the sorting, so strings sort by its collation), so that filtered subsets
+    keep the same order.
+    Events are stored unshifted (see Patient.date_offset): the queries cover
+    the window moved back by the patient's offset, and the dates fetched are
+    moved forward by it.
+    """
+
+    def __init__(self, patient, window=None):
+        self.patient = patient
+        self.window = window or Window.parse()
+        self.offset = patient.date_offset
+        shift = timedelta(days=self.offset)
+        self.stored = self.window._replace(start=self.window.start - shift,
+                                           end=self.window.end - shift)
+
+    def shifted(self, table, *names):
+        """`table`, with its datetime64 columns `names` shifted"""
+        if self.offset:
+            step = np.timedelta64(self.offset, 'D')
+            for name in names:
+                setattr(table, name, getattr(table, name) + step)
+        return table
+
+    @cached_property
+    def icds(self):
+        """
+        ICD instances with a phecode, by phecode, ICD code and date.  Columns
+        phecode, chapter (-1 for none) and icd are ids; info['phecode'] and
+        info['icd'] map them to (code, description).  phecode_rank and
+        icd_rank are the ranks of the codes in the database's collation, to
+        sort by code as an ORDER BY would.
+        """
+        return self.icd_columns()
+
+    def icd_columns(self, phecodes=None):
+        """The icds table, only for the given phecode ids if any (uncached)"""
+        rows = (self.patient.icdinstance_set
+                .filter(code__phecode__isnull=False,
+                        date__range=self.stored.date_range))
+        if phecodes is not None:
+            rows = rows.filter(code__phecode__in=phecodes)
+        rows = (rows
+                .annotate(phecode_rank=code_rank('code__phecode__code'),
+                          icd_rank=code_rank('code__code'))
+                .values_list('code__phecode', 'code__chapter', 'code', 'date',
+                             'phecode_rank', 'icd_rank',
+                             'code__phecode__code',
+                             'code__phecode__description',
+                             'code__code', 'code__description')
+                .order_by('code__phecode', 'code__code', 'code__description',
+                          'date'))
+        rows = list(rows)
+        info = {'phecode': {r[0]: (r[6], r[7]) for r in rows},
+                'icd': {r[2]: (r[8], r[9]) for r in rows}}
+        table = Columns.from_rows(rows, info, phecode=np.int64, chapter='id',
+                                  icd=np.int64, date='datetime64[D]',
+                                  phecode_rank=np.int64, icd_rank=np.int64)
+        return self.shifted(table, 'date')
+
+    @cached_property
+    def labs(self):
+        """
+        Lab instances, by lab code, datetime and then the rest of the result
+        (so repeated results are adjacent).  info['lab'] maps the code ids to
+        (code, description) and info['percentiles'] to the lab's percentiles
+        (see LabPercentiles), in PERC_KEYS order.
+        """
+        order = ('code__code', 'code__description', *INST_KEYS)
+        first, last = self.stored.datetime_range
+        rows = list(self.patient.labinstance_set
+                    .filter(datetime__gte=first, datetime__lt=last)
+                    .values_list('code', *INST_KEYS,
+                                 'code__code', 'code__description')
+                    .order_by(*order))
+        info = {'lab': {r[0]: (r[6], r[7]) for r in rows}, 'percentiles': {}}
+        if rows:
+            # One row per lab, rather than the same values on every result
+            percentiles = (Lab.objects
+                           .filter(pk__in=list(info['lab']))
+                           .values_list('pk', *(f'percentiles__{key}'
+                                                for key in PERC_KEYS)))
+            info['percentiles'] = {r[0]: r[1:] for r in percentiles}
+        table = Columns.from_rows(rows, info, code=np.int64,
+                                  datetime='datetime', value=np.float64,
+                                  unit=object, normal_min=np.float64,
+                                  normal_max=np.float64)
+        return self.shifted(table, 'datetime')
+
+    @cached_property
+    def meds(self):
+        """
+        Medications, by sig and date.  sig numbers the distinct sigs in order;
+        info['sig'] holds each one's fields as a dict.
+        """
+        rows = list(self.patient.meds
+                    .filter(date__range=self.stored.date_range)
+                    .values_list(*MED_KEYS, 'date')
+                    .order_by(*MED_KEYS, 'date'))
+        sigs = []
+        sig_ids = []
+        for row in rows:
+            if not sigs or tuple(sigs[-1].values()) != row[:-1]:
+                sigs.append(dict(zip(MED_KEYS, row[:-1])))
+            sig_ids.append(len(sigs) - 1)
+        table = Columns({'sig': sigs},
+                        sig=np.array(sig_ids, dtype=np.int64),
+                        date=column([r[-1] for r in rows], 'datetime64[D]'))
+        return self.shifted(table, 'date')
+
+    @cached_property
+    def cpts(self):
+        """
+        CPT instances, by category, subcategory, code and date.  info['cpt']
+        maps the code ids to (category, subcategory, code, description).
+        """
+        rows = list(self.patient.cptinstance_set
+                    .filter(date__range=self.stored.date_range)
+                    .values_list('code', 'date', 'code__category',
+                                 'code__subcategory', 'code__code',
+                                 'code__description')
+                    .order_by('code__category', 'code__subcategory',
+                              'code__code', 'date'))
+        info = {'cpt': {r[0]: r[2:] for r in rows}}
+        table = Columns.from_rows(rows, info, cpt=np.int64,
+                                  date='datetime64[D]')
+        return self.shifted(table, 'date')
+
+    @cached_property
+    def heart_rates(self):
+        """Pulse & respiratory rate measurements, by date"""
+        first, last = self.stored.datetime_range
+        rows = (self.patient.vitals_hr
+                .filter(entry_date__gte=first, entry_date__lt=last)
+                .values_list('name', 'entry_date', 'value')
+                .order_by('entry_date'))
+        table = Columns.from_rows(rows, name=object, entry_date='datetime',
+                                  value=np.int64)
+        return self.shifted(table, 'entry_date')
+
+    @cached_property
+    def blood_pressures(self):
+        """Blood pressure measurements, by date"""
+        first, last = self.stored.datetime_range
+        rows = (self.patient.vitals_bp
+                .filter(entry_date__gte=first, entry_date__lt=last)
+                .values_list('entry_date', 'value', 'status',
+                             'systolic', 'diastolic')
+                .order_by('entry_date'))
+        table = Columns.from_rows(rows, entry_date='datetime', value=object,
+                                  status=object, systolic=np.int64,
+                                  diastolic=np.int64)
+        return self.shifted(table, 'entry_date')
+
+    @cached_property
+    def bmis(self):
+        """Height, weight & BMI measurements, by weight then height date"""
+        first, last = self.stored.datetime_range
+        rows = (self.patient.vitals_bmi
+                .filter(weight_date__gte=first, weight_date__lt=last)
+                .values_list('weight', 'weight_date', 'height',
+                             'height_date', 'bmi')
+                .order_by('weight_date', 'height_date'))
+        table = Columns.from_rows(rows, weight=np.float64,
+                                  weight_date='datetime', height=np.float64,
+                                  height_date='datetime', bmi=np.float64)
+        return self.shifted(table, 'weight_date', 'height_date')
@@ -1,57 +1,95 @@
 """
 Miscellaneous operations
 """
-from datetime import date
 from functools import wraps
-from itertools import groupby
 from operator import itemgetter
 
 import pandas as pd
 import numpy as np
 import fast_intensity
-from django.db.models import F
 
-from taxonomies.models import Chapter, Phecode
-
-
-# Dategrid constants and data
-grid = pd.date_range(date(2000, 1, 1), date.today(), periods=100)
-start, end = grid.min(), grid.max()
-grid_range = (start, end)
+from .downsample import days, downsample
+from .timeline import (PatientTimeline, Window, PERC_KEYS, INST_KEYS, dates,
+                       datetimes, dedupe, group_starts, nest, nullable,
+                       spans)
 
 
 def add_dategrid(func):
-    """Wraps a function returning a dict to add the grid to the output"""
+    """
+    Wraps a tab function to add its window's grid to the output.  The
+    function is always passed a timeline: one for `window` (by default the
+    whole history) if none is given.
+    """
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        rdict = func(*args, **kwargs)
-        rdict['dategrid'] = grid
+    def wrapper(patient, *args, timeline=None, window=None, **kwargs):
+        timeline = timeline or PatientTimeline(patient, window)
+        rdict = func(patient, *args, timeline=timeline, **kwargs)
+        rdict['dategrid'] = timeline.window.grid
         return rdict
     return wrapper
 
 
-def infer_intensity(dates, grid=grid):
+def infer_intensity(dates, window=None):
     """Given a set of (unique) dates, returns an intensity array"""
+    window = window or Window.parse()
+    grid = window.grid
     offset = grid.min()
     evts = pd.to_datetime(sorted(dates))
     fi = fast_intensity.infer_intensity(
         (evts - offset).days.values.astype(float),
-        (grid - offset).days.values.astype(float)
+        window.grid_days
     )
     return fi
 
 
-def rollup_meds(raw):
-    """Take a flat qset of medications and group by sig"""
-    meds = []
-    keys = ('name', 'strength', 'route', 'frequency',
-            'description', 'strength_num')
-    raw = raw.order_by(*keys).values().distinct()
-    for sig, evts in groupby(raw, key=itemgetter(*keys)):
-        datum = dict(zip(keys, sig))
-        datum['events'] = sorted(d['date'] for d in evts)
-        meds.append(datum)
-    return meds
+def to_days(dates, window=None):
+    """
+    Converts an iterable of dates to an array of day offsets (floats) from
+    the start of the window
+    """
+    start = (window or Window.parse()).start
+    dates = np.asarray(list(dates), dtype='datetime64[D]')
+    return (dates - np.datetime64(start, 'D')).astype(float)
+
+
+def infer_intensities(days, groups, window=None):
+    """
+    infer_intensity of many groups at once.  Accepts parallel arrays of event
+    day offsets (relative to the window start, see `to_days`) and group ids,
+    and returns a tuple (ids, intensities) where `ids` are the sorted unique
+    group ids and `intensities` is a 2D array with one intensity row per id.
+    Repeated (group, day) pairs are counted once, just as infer_intensity
+    expects a set of unique dates.
+
+    The grouping and dedupe are vectorized, but fast_intensity only has a 1D
+    entry point, so it is still called once per group; that call is nearly
+    all of the time (see the bench_intensity command).
+    """
+    grid_days = (window or Window.parse()).grid_days
+    days = np.asarray(days, dtype=float)
+    groups = np.asarray(groups)
+    # Sort by group, then day, and drop the duplicate events in one pass
+    order = np.lexsort((days, groups))
+    days, groups = days[order], groups[order]
+    keep = np.ones(len(days), dtype=bool)
+    keep[1:] = (days[1:] != days[:-1]) | (groups[1:] != groups[:-1])
+    days, groups = days[keep], groups[keep]
+    ids, bounds = np.unique(groups, return_index=True)
+    if not len(ids):
+        return ids, np.empty((0, len(grid_days)))
+    rows = [fast_intensity.infer_intensity(evts, grid_days)
+            for evts in np.split(days, bounds[1:])]
+    return ids, np.vstack(rows)
+
+
+def rollup_meds(meds):
+    """Take rows of PatientTimeline.meds and group by sig"""
+    rollup = []
+    for begin, stop in spans(group_starts(meds.sig), len(meds)):
+        datum = dict(meds.info['sig'][meds.sig[begin]])
+        datum['events'] = dates(np.sort(meds.date[begin:stop]))
+        rollup.append(datum)
+    return rollup
 
 
 # Lab Category data
@@ -71,32 +109,44 @@ CBC = []
 CHEM_CODES = {x['code'] for x in CHEM}
 CBC_CODES = {x['code'] for x in CBC}
 
-def rollup_labs(raw):
-    """Take a flat qset of lab results and group by kind and code"""
-    # Fields that should be same for all instances of a lab
-    lab_keys = ('code__code', 'code__description')
-    # Percentiles calculated across the whole lab instance set per lab
-    perc_keys = ('perc_10', 'perc_25', 'perc_50', 'perc_75', 'perc_90')
-    # Keys that only apply to a given instance
-    inst_keys = ('datetime', 'value', 'unit', 'normal_min', 'normal_max')
-    raw = (raw.values(*lab_keys, *perc_keys, *inst_keys)
-           .order_by(*lab_keys, *perc_keys, 'datetime')
-           .distinct())
-    lab_groups = groupby(raw, key=itemgetter(*lab_keys, *perc_keys))
+def rollup_labs(labs, max_points=None, method='minmax'):
+    """
+    Take rows of PatientTimeline.labs and group by kind and code, with each
+    lab's events downsampled to about `max_points` if given (see
+    patients.downsample)
+    """
+    # Drop repeated results
+    labs = dedupe(labs, 'code', *INST_KEYS)
+    starts = group_starts(labs.code)
+    if max_points:
+        x = days(labs.datetime)
+        keep = [begin + downsample(x[begin:stop], labs.value[begin:stop],
+                                   max_points, method,
+                                   labs.normal_min[begin:stop],
+                                   labs.normal_max[begin:stop])
+                for begin, stop in spans(starts, len(labs))]
+        labs = labs[np.concatenate(keep) if keep else slice(0)]
+        starts = group_starts(labs.code)
+    # Convert each event column to python values in one go
+    events = list(zip(datetimes(labs.datetime),
+                      nullable(labs.value),
+                      labs.unit.tolist(),
+                      nullable(labs.normal_min),
+                      nullable(labs.normal_max)))
+    no_percentiles = (None,) * len(PERC_KEYS)
 
     _chem = {}
     _cbc = {}
     other = []
 
-    for (code, description, *perc_vals), evts in lab_groups:
-        lab = {'code': code, 'description': description, 'events': []}
-        lab.update(zip(perc_keys, perc_vals))
-        for event in evts:
-            lab['events'].append({
-                key: (None if val in (float('inf'), -float('inf')) else val)
-                for key, val in event.items()
-                if key in inst_keys
-            })
+    for begin, stop in spans(starts, len(labs)):
+        id_ = labs.code[begin]
+        code, description = labs.info['lab'][id_]
+        perc_vals = labs.info['percentiles'].get(id_, no_percentiles)
+        lab = {'code': code, 'description': description}
+        lab['events'] = [dict(zip(INST_KEYS, event))
+                         for event in events[begin:stop]]
+        lab.update(zip(PERC_KEYS, perc_vals))
         if code in CHEM_CODES:
             _chem[code] = lab
         elif code in CBC_CODES:
@@ -115,46 +165,62 @@ def rollup_labs(raw):
     }
 
 
-def problem_list(patient):
+# Phecodes whose final intensity is below this are left off the problem list
+PROBLEM_CUTOFF = 0.0018
+
+
+def summarize_phecodes(icds, window):
     """
-    For each phecode represented in the patient's ICD instance history,
-    calculate an intensity curve and the area under that curve.  Then return
-    the top quartile of phecodes sorted by AUC.
+    For each phecode in a PatientTimeline.icds table: its ICDs' events, the
+    date range they span, and an intensity curve on the window's grid with
+    its final value and the area under it.  Returns a list of dicts, by
+    phecode id.
     """
-    evts = (patient.icdinstance_set
-            .filter(code__phecode__isnull=False)
-            .annotate(phecode=F('code__phecode'),
-                      icd_code=F('code__code'),
-                      icd_desc=F('code__description'))
-            .values('phecode', 'date', 'icd_code', 'icd_desc')
-            .order_by('phecode', 'icd_code', 'icd_desc', 'date')
-            .distinct())
-    raw = (Phecode.objects
-           .filter(pk__in=evts.values('phecode'))
-           .values())
+    # Each ICD's events are its distinct dates
+    icds = dedupe(icds, 'phecode', 'icd', 'date')
+    starts = group_starts(icds.phecode)
+    if not len(starts):
+        return []
+    days = icds.date.astype(np.int64)
+    firsts = np.minimum.reduceat(days, starts)
+    lasts = np.maximum.reduceat(days, starts)
+    first_dates = dates(firsts.astype('datetime64[D]'))
+    last_dates = dates(lasts.astype('datetime64[D]'))
+    spreads = (lasts - firsts).tolist()
+    ids, intensities = infer_intensities(to_days(icds.date, window),
+                                         icds.phecode, window)
+
+    icd_starts = group_starts(icds.phecode, icds.icd)
+    icd_data = []
+    for begin, stop in spans(icd_starts, len(icds)):
+        code, description = icds.info['icd'][icds.icd[begin]]
+        icd_data.append({'code': code,
+                         'description': description,
+                         'events': dates(icds.date[begin:stop])})
+    icd_data = nest(icd_data, icd_starts, starts)
+
     phecodes = []
-    # For each Phecode, generate the group of constituent ICD codes, then
-    # generate the date range and intensity in that date range for the code
-    for _id, events in groupby(evts, key=itemgetter('phecode')):
-        event_dates = set()
-        data = raw.get(pk=_id)
-        data['icds'] = []
-        byICD = itemgetter('icd_code', 'icd_desc')
-        for (code, description), icd_events in groupby(events, key=byICD):
-            dates = {e['date'] for e in icd_events}
-            event_dates |= dates
-            datum = {'code': code,
-                     'description': description,
-                     'events': sorted(dates)}
-            data['icds'].append(datum)
-        first, last = min(event_dates), max(event_dates)
-        intensity = infer_intensity(event_dates)
+    for i, (_id, intensity) in enumerate(zip(ids.tolist(), intensities)):
+        code, description = icds.info['phecode'][_id]
+        data = {'id': _id, 'code': code, 'description': description}
+        data['icds'] = icd_data[i]
+        data['date_range'] = (first_dates[i], last_dates[i])
+        data['date_spread'] = spreads[i]
         data['intensity'] = intensity
         data['final_intensity'] = intensity[-1]
         data['auc'] = np.trapz(intensity)
-        data['date_range'] = (first, last)
-        data['date_spread'] = (last - first).days
         phecodes.append(data)
+    return phecodes
+
+
+def problem_list(patient, timeline=None):
+    """
+    For each phecode represented in the patient's ICD instance history,
+    calculate an intensity curve and the area under that curve.  Then return
+    the phecodes with a high enough final intensity, highest first.
+    """
+    timeline = timeline or PatientTimeline(patient)
+    phecodes = summarize_phecodes(timeline.icds, timeline.window)
 
     # Alternate implementation: sort by AUC and return quartile
     # auc_75 = np.quantile(sorted((d['auc'] for d in phecodes)), 0.75)
@@ -162,9 +228,8 @@ def problem_list(patient):
     #                   key=itemgetter('auc'),
     #                   reverse=True)
 
-    cutoff = 0.0018
     phecodes = sorted((ph for ph in phecodes
-                       if ph['final_intensity'] > cutoff),
+                       if ph['final_intensity'] > PROBLEM_CUTOFF),
                       key=itemgetter('final_intensity'),
                       reverse=True)
     return phecodes
@@ -3,7 +3,8 @@ from rest_framework.response import Response
 from rest_framework.serializers import ModelSerializer
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
-from .models import Phecode, ICD
+from chartviz.conditional import conditional
+from .models import Phecode, ICD, TaxonomyVersion
 
 class PhecodeSerializer(ModelSerializer):
     class Meta:
@@ -19,6 +20,21 @@ class ICDSerializer(ModelSerializer):
         fields = ('id', 'code', 'description', 'phecode')
 
 
+def taxonomy_version(view, request):
+    version = TaxonomyVersion.current()
+    return version.version, version.modified
+
+
 class ICDViewSet(ReadOnlyModelViewSet):
-    queryset = ICD.objects.all()
+    # The phecodes are serialized with each ICD
+    queryset = ICD.objects.select_related('phecode')
     serializer_class = ICDSerializer
+    query_budgets = {'list': 5, 'retrieve': 4}
+
+    @conditional(taxonomy_version)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional(taxonomy_version)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
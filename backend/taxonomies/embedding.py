@@ -1,37 +1,132 @@
 import re
 from functools import lru_cache
-from os.path import abspath, dirname, join
+from os.path import abspath, dirname, exists, join
 
-from gensim.models.word2vec import Word2Vec
+import numpy as np
 
 from .models import ICD
 
 prefix_re = re.compile(r'^(LAB: [+-]?\d|ICD:|MED:)')
-fpath = join(dirname(abspath(__file__)),
-             'resources',
-             'icdmedlab_embedding.gen')
-model = Word2Vec.load(fpath)
+resources = join(dirname(abspath(__file__)), 'resources')
+fpath = join(resources, 'icdmedlab_embedding.gen')
+# The model's word vectors as written by the export_embedding command
+vectors_path = join(resources, 'icdmedlab_embedding.vectors.npy')
+vocab_path = join(resources, 'icdmedlab_embedding.vocab.txt')
+# The precomputed nearest neighbours of the ICD vocabulary items, as written
+# by the build_neighbours command: the vocabulary index of each table row's
+# word, and per row the neighbours' vocabulary indices & similarities
+rows_path = join(resources, 'icdmedlab_embedding.rows.npy')
+neighbours_path = join(resources, 'icdmedlab_embedding.neighbours.npy')
+scores_path = join(resources, 'icdmedlab_embedding.scores.npy')
+neighbour_paths = (rows_path, neighbours_path, scores_path)
+
+
+class Embedding:
+    """
+    Read only word vectors, unit normalized and memory-mapped from disk so
+    that every worker process shares a single page-cache copy.  Provides the
+    parts of gensim's KeyedVectors interface we use.  If a neighbour table is
+    given, similarity queries it covers are answered by lookup instead of a
+    scan over the whole vocabulary.
+    """
+
+    def __init__(self, vectors, words, rows=None, neighbours=None,
+                 scores=None):
+        self.vectors = vectors
+        self.words = words
+        self.index = {word: i for i, word in enumerate(words)}
+        self.neighbours = neighbours
+        self.scores = scores
+        self.rows = {}
+        if rows is not None:
+            self.rows = {words[i]: row for row, i in enumerate(rows)}
+
+    @classmethod
+    def load(cls, vectors_path=vectors_path, vocab_path=vocab_path):
+        vectors = np.load(vectors_path, mmap_mode='r')
+        with open(vocab_path) as fd:
+            words = fd.read().splitlines()
+        table = {}
+        if all(exists(path) for path in neighbour_paths):
+            table = dict(zip(('rows', 'neighbours', 'scores'),
+                             (np.load(path, mmap_mode='r')
+                              for path in neighbour_paths)))
+        return cls(vectors, words, **table)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def similar_by_word(self, word, topn=10):
+        """
+        Returns the `topn` (word, cosine similarity) pairs closest to `word`,
+        most similar first.  Raises KeyError for out of vocabulary words.
+        """
+        row = self.rows.get(word)
+        if row is not None and topn <= self.neighbours.shape[1]:
+            return [(self.words[j], float(score)) for j, score in
+                    zip(self.neighbours[row, :topn], self.scores[row, :topn])]
+        i = self.index[word]
+        sims = self.vectors @ self.vectors[i]
+        sims[i] = -np.inf
+        topn = min(topn, len(sims) - 1)
+        best = top_indices(sims, topn)
+        return [(self.words[j], float(sims[j])) for j in best]
+
+
+def top_indices(sims, topn):
+    """
+    Indices of the `topn` largest values along the last axis of `sims`, in
+    descending order of value
+    """
+    best = np.argpartition(-sims, topn, axis=-1)[..., :topn]
+    values = np.take_along_axis(sims, best, axis=-1)
+    order = np.argsort(-values, axis=-1, kind='stable')
+    return np.take_along_axis(best, order, axis=-1)
+
+
+@lru_cache()
+def word_vectors():
+    """
+    Loads the exported vectors if present, else the full gensim model (once
+    per process)
+    """
+    if exists(vectors_path) and exists(vocab_path):
+        return Embedding.load()
+    from gensim.models.word2vec import Word2Vec
+    return Word2Vec.load(fpath).wv
+
+
+@lru_cache()
+def parent_map():
+    """
+    Maps each ICD parent code to the best ranked ICD code with that parent
+    which is in the embedding vocabulary (built once per process)
+    """
+    wv = word_vectors()
+    best = {}
+    ranked = (ICD.objects
+              .filter(rank__isnull=False)
+              .order_by('rank')
+              .values_list('code', flat=True))
+    for code in ranked:
+        parent = ICD(code=code).parent
+        if parent not in best and f'ICD: {code}' in wv:
+            best[parent] = code
+    return best
 
 
 @lru_cache()
 def most_similar(code):
     """ Accepts an ICD code (str) and returns the top 1000 similar items"""
-    try:
-        similar = model.wv.similar_by_word(f'ICD: {code}', topn=1000)
-    except KeyError:
-        # word is not in vocabulary - get the highest ranking result with
-        # the same parent
-        icd = ICD.objects.get(code=code)
-        hasrank = ICD.objects.filter(rank__isnull=False).order_by('rank')
-        candidates = (obj for obj in hasrank if obj.parent == icd.parent)
-        new_icd = next(candidates)
-        code = f'ICD: {new_icd.code}'
-        try:
-            similar = model.wv.similar_by_word(f'ICD: {code}', topn=1000)
-        except KeyError:
+    wv = word_vectors()
+    if f'ICD: {code}' not in wv:
+        # word is not in vocabulary - use the highest ranking code with the
+        # same parent that is
+        code = parent_map().get(ICD(code=code).parent)
+        if code is None:
             # Give up
-            similar = []
-    return similar
+            return []
+    return wv.similar_by_word(f'ICD: {code}', topn=1000)
 
 
 def disjoin_word(word):
@@ -0,0 +1,83 @@
+"""
+Precompute the nearest neighbours of every ICD item in the embedding
+vocabulary, so that taxonomies.embedding.most_similar is a table lookup rather
+than a scan of the whole vocabulary.  Requires the vectors written by the
+export_embedding command; rerun this whenever they are re-exported.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from tqdm import tqdm
+
+from taxonomies import embedding
+
+
+def neighbours_of(rows):
+    """
+    Top neighbours (vocabulary indices & similarities) of the vocabulary items
+    at `rows`, computed as one matrix product.  Module level so it can run in
+    a worker process.
+    """
+    vectors = np.load(embedding.vectors_path, mmap_mode='r')
+    sims = vectors[rows] @ vectors.T
+    # An item is not its own neighbour
+    sims[np.arange(len(rows)), rows] = -np.inf
+    best = embedding.top_indices(sims, neighbours_of.topn)
+    return best.astype(np.int32), np.take_along_axis(sims, best, axis=-1)
+
+
+def init_worker(topn):
+    neighbours_of.topn = topn
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--topn',
+            type=int,
+            default=1000,
+            help='Neighbours stored per ICD item; most_similar needs 1000'
+        )
+        parser.add_argument(
+            '--block',
+            type=int,
+            default=512,
+            help='ICD items per matrix product'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1,
+            help='Worker processes computing blocks in parallel '
+                 f'(0 for one per core, {cpu_count()} here)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            vocab = embedding.Embedding.load()
+        except FileNotFoundError:
+            raise CommandError('No exported vectors, run export_embedding')
+        rows = np.array([i for i, word in enumerate(vocab.words)
+                         if word.startswith('ICD:')], dtype=np.int32)
+        topn = min(options['topn'], len(vocab.words) - 1)
+        blocks = [rows[i:i + options['block']]
+                  for i in range(0, len(rows), options['block'])]
+        jobs = options['jobs'] or cpu_count()
+
+        self.stdout.write(f'Computing {topn} neighbours for {len(rows)} '
+                          f'ICD items in {len(blocks)} blocks...')
+        with ProcessPoolExecutor(jobs, initializer=init_worker,
+                                 initargs=(topn,)) as pool:
+            results = list(tqdm(pool.map(neighbours_of, blocks),
+                                total=len(blocks)))
+        neighbours = np.concatenate([r[0] for r in results])
+        scores = np.concatenate([r[1] for r in results]).astype(np.float32)
+
+        np.save(embedding.rows_path, rows)
+        np.save(embedding.neighbours_path, neighbours)
+        np.save(embedding.scores_path, scores)
+        self.stdout.write(self.style.SUCCESS('DONE'))
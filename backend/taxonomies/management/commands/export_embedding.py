@@ -0,0 +1,89 @@
+"""
+Export the word vectors of the gensim embedding model to a read only float32
+array (unit normalized) plus a vocabulary listing.  When present these are
+memory-mapped by taxonomies.embedding in place of loading the full model, so
+worker processes share one copy of the vectors and start up in constant time.
+"""
+import subprocess
+import sys
+from os import remove
+from os.path import exists
+from textwrap import dedent
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from taxonomies import embedding
+
+# Run in a fresh interpreter to measure what a worker pays to get the vectors
+# ready for a similarity query: wall time, plus resident memory split into
+# private (anonymous) and file backed pages, the latter being shareable
+# between processes via the page cache
+PROBE = dedent("""\
+    import time
+    t0 = time.perf_counter()
+    import numpy as np
+    {load}
+    np.asarray(vectors @ vectors[0])
+    elapsed = time.perf_counter() - t0
+    with open('/proc/self/status') as fd:
+        status = dict(line.split(':', 1) for line in fd)
+    print(elapsed, status['RssAnon'].split()[0], status['RssFile'].split()[0])
+""")
+
+LOADERS = {
+    'gensim': (
+        'from gensim.models.word2vec import Word2Vec\n'
+        f'vectors = Word2Vec.load({embedding.fpath!r}).wv.vectors'
+    ),
+    'mmap': (
+        f'vectors = np.load({embedding.vectors_path!r}, mmap_mode="r")\n'
+        f'words = open({embedding.vocab_path!r}).read().splitlines()'
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--report',
+            action='store_true',
+            help='Compare worker startup time & RSS for the gensim model '
+                 'and the exported vectors after exporting'
+        )
+
+    def handle(self, *args, **options):
+        from gensim.models.word2vec import Word2Vec
+
+        self.stdout.write('Loading model...')
+        wv = Word2Vec.load(embedding.fpath).wv
+        # gensim >= 4 renamed index2word
+        words = getattr(wv, 'index_to_key', None) or wv.index2word
+        if any('\n' in word for word in words):
+            raise CommandError('Vocabulary items may not contain newlines')
+
+        self.stdout.write(f'Exporting {len(words)} vectors...')
+        vectors = np.asarray(wv.vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        np.save(embedding.vectors_path, vectors)
+        with open(embedding.vocab_path, 'w') as fd:
+            fd.write('\n'.join(words) + '\n')
+        # Any neighbour table was computed from the old vectors
+        for path in embedding.neighbour_paths:
+            if exists(path):
+                remove(path)
+        self.stdout.write(self.style.SUCCESS('DONE'))
+
+        if options['report']:
+            for name, load in LOADERS.items():
+                out = subprocess.run([sys.executable, '-c',
+                                      PROBE.format(load=load)],
+                                     check=True, stdout=subprocess.PIPE,
+                                     universal_newlines=True).stdout
+                elapsed, private, shared = out.split()
+                self.stdout.write(f'{name:>8}: startup {float(elapsed):.2f}s, '
+                                  f'private RSS {int(private) / 1024:.1f} MiB, '
+                                  f'shared RSS {int(shared) / 1024:.1f} MiB')
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taxonomies', '0004_auto_20181217_2346'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxonomyVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField(default=0)),
+                ('modified', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
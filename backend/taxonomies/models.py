@@ -8,7 +8,7 @@ For the most part these should be considered read only.
 The models are populated by the initial_data application.
 """
 from django.db.models import (
-    Model, CharField, IntegerField,
+    Model, CharField, DateTimeField, IntegerField,
     ForeignKey, CASCADE, SET_NULL,
 )
 
@@ -65,3 +65,17 @@ class CPT(CodeType):
     @property
     def expired(self):
         return 'EXPIRED' in self.description
+
+
+class TaxonomyVersion(Model):
+    """
+    A single row whose version is bumped (and modified time set) by triggers
+    whenever the ICD or phecode tables are written; see
+    initial_data/migrations/0007_conditional_requests.py
+    """
+    version = IntegerField(default=0)
+    modified = DateTimeField(null=True)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.get(pk=1)